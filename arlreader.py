@@ -0,0 +1,271 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+from optparse import OptionParser
+import os
+import sys
+import mmap
+import json
+import datetime
+
+"""
+MODULE: reads ARL files.
+
+PYTHON 3.x
+
+ABSTRACT: finds the time periods in an ARL file (as written by era52arl or
+arlwriter.py) from their index records. Only the index records are read.
+The length of the records and the number of records in a time period are
+taken from the first index record and are the same for all the time periods.
+
+ARLReader memory maps the file and decodes single records on demand with
+arlwriter.unpack. The index records are only read the first time. The time
+periods and the layout of the records are saved in a sidecar file
+(FILE.idx.json) from which the offset of any (time, variable, level) is
+offset of the time period + reclen * position of the record in the period.
+When the file has grown (e.g. get_era5_cds.py --catchup) only the new time
+periods are read.
+
+    with arlreader.ARLReader('ERA5_201701.ARL') as arl:
+        temp = arl.record(datetime.datetime(2017, 1, 5, 12), 'TEMP', 3)
+
+python arlreader.py ERA5_201701.ARL lists the time periods and
+python arlreader.py ERA5_201701.ARL -v TEMP -l 3 -t 2017010512 prints one record.
+"""
+
+
+def parse_label(label):
+    """returns dictionary with date (without the minutes), level, kvar, nexp, var1
+       from the 50 character label of a record. level is None for levels from 100 up (**).
+    """
+    year = int(label[0:2])
+    # two digit years. ERA5 starts in 1940.
+    year += 2000 if year < 40 else 1900
+    level = None if label[10:12] == '**' else int(label[10:12])
+    return {'date': datetime.datetime(year, int(label[2:4]), int(label[4:6]), int(label[6:8])),
+            'ic': int(label[8:10]), 'level': level, 'grid': label[12:14],
+            'kvar': label[14:18], 'nexp': int(label[18:22]), 'prec': float(label[22:36]),
+            'var1': float(label[36:50])}
+
+
+def grid_thousands(gstr):
+    """returns the thousands of nx and ny from the grid characters of the label.
+       See arlwriter.grid_str.
+    """
+    if gstr[0].isalpha() or gstr[1].isalpha():
+        return [1000 * (ord(x) - ord('A') + 1) if x.isalpha() else 0 for x in gstr]
+    return [0, 0]
+
+
+def read_index(fid, offset=0):
+    """reads the index record at offset. Returns dictionary with
+       date, nx, ny, reclen (bytes in one record), nrec (records in the time period
+       including the index record), coord and levels (list of (height, variable names)).
+       Returns None at the end of the file. Raises ValueError if it is not an index record.
+    """
+    fid.seek(offset)
+    head = fid.read(50 + 108)
+    if len(head) < 50 + 108:
+        return None
+    head = head.decode('ascii')
+    label = parse_label(head[0:50])
+    if label['kvar'] != 'INDX':
+        raise ValueError('no index record at byte {}'.format(offset))
+    index = head[50:]
+    thousands = grid_thousands(label['grid'])
+    nx = int(index[93:96]) + thousands[0]
+    ny = int(index[96:99]) + thousands[1]
+    nz = int(index[99:102])
+    lenh = int(index[104:108])
+    text = fid.read(lenh - 108).decode('ascii')
+    levels = []
+    pos = 0
+    for nnn in range(nz):
+        height = float(text[pos:pos + 6])
+        nvar = int(text[pos + 6:pos + 8])
+        pos += 8
+        names = [text[pos + 8 * x:pos + 8 * x + 4] for x in range(nvar)]
+        pos += 8 * nvar
+        levels.append((height, names))
+    date = label['date'] + datetime.timedelta(minutes=int(index[7:9]))
+    return {'date': date, 'nx': nx, 'ny': ny, 'reclen': 50 + nx * ny, 'coord': int(index[102:104]),
+            'nrec': 1 + sum(len(x[1]) for x in levels), 'levels': levels,
+            'model': index[0:4], 'grids': [float(index[9 + 7 * x:16 + 7 * x]) for x in range(12)]}
+
+
+def read_times(fname, start=0):
+    """returns list of (date, offset) for each time period in the file.
+       start : offset of the first time period to read.
+    """
+    times = []
+    with open(fname, 'rb') as fid:
+        first = read_index(fid, 0)
+        if first is None:
+            return times
+        step = first['nrec'] * first['reclen']
+        size = os.path.getsize(fname)
+        for offset in range(start, size - step + 1, step):
+            times.append((read_index(fid, offset)['date'], offset))
+    return times
+
+
+def last_time(fname):
+    """returns the time of the last complete time period in the file or None.
+    """
+    times = read_times(fname)
+    if not times:
+        return None
+    return times[-1][0]
+
+
+def index_name(fname):
+    return fname + '.idx.json'
+
+
+class ARLReader:
+
+    def __init__(self, fname, save=True):
+        """fname : name of ARL file.
+           save : if True write the sidecar index file when it is new or out of date.
+        """
+        self.fname = fname
+        self.fid = open(fname, 'rb')
+        self.mm = mmap.mmap(self.fid.fileno(), 0, access=mmap.ACCESS_READ)
+        first = read_index(self.fid, 0)
+        if first is None:
+            raise ValueError('{} has no index record'.format(fname))
+        self.nx = first['nx']
+        self.ny = first['ny']
+        self.reclen = first['reclen']
+        self.nrec = first['nrec']
+        self.coord = first['coord']
+        self.model = first['model']
+        self.grids = first['grids']
+        self.levels = first['levels']
+        # position of each record in the time period. 0 is the index record.
+        self.recnum = {}
+        nnn = 1
+        for level, (height, names) in enumerate(self.levels):
+            for kvar in names:
+                self.recnum[(level, kvar)] = nnn
+                nnn += 1
+        self.times = self.read_sidecar(save)
+        self.offsets = dict(self.times)
+
+    def layout(self):
+        """what the sidecar index has to match besides the times.
+        """
+        return {'nx': self.nx, 'ny': self.ny, 'reclen': self.reclen, 'nrec': self.nrec,
+                'levels': [[h, n] for h, n in self.levels]}
+
+    def read_sidecar(self, save=True):
+        """returns list of (date, offset) from the sidecar index.
+           Only the time periods after the ones in the sidecar are read from the file.
+        """
+        size = len(self.mm)
+        times = []
+        try:
+            with open(index_name(self.fname), 'r') as fid:
+                sidecar = json.load(fid)
+            if sidecar['layout'] == self.layout() and sidecar['size'] <= size:
+                times = [(datetime.datetime.strptime(x, '%Y%m%d%H%M'), y)
+                         for x, y in sidecar['times']]
+        except (IOError, ValueError, KeyError):
+            times = []
+        # the file may have been replaced or truncated and written again.
+        if times and self.read_date(times[-1][1]) != times[-1][0]:
+            times = []
+        start = times[-1][1] + self.nrec * self.reclen if times else 0
+        new = read_times(self.fname, start=start)
+        times.extend(new)
+        if save and (new or not os.path.isfile(index_name(self.fname))):
+            self.write_sidecar(times, size)
+        return times
+
+    def write_sidecar(self, times, size):
+        sidecar = {'layout': self.layout(), 'size': size,
+                   'times': [(x.strftime('%Y%m%d%H%M'), y) for x, y in times]}
+        tmpname = index_name(self.fname) + '.tmp'
+        try:
+            with open(tmpname, 'w') as fid:
+                json.dump(sidecar, fid)
+            os.replace(tmpname, index_name(self.fname))
+        except OSError as err:
+            # the index is only kept to save time. e.g. directory is not writable.
+            print('Warning: could not write {} : {}'.format(index_name(self.fname), err))
+
+    def read_date(self, offset):
+        """date of the index record at offset or None if it is not an index record.
+        """
+        label = self.mm[offset:offset + 50 + 9].decode('ascii')
+        if len(label) < 59 or label[14:18] != 'INDX':
+            return None
+        return parse_label(label[0:50])['date'] + datetime.timedelta(minutes=int(label[57:59]))
+
+    def dates(self):
+        return [x[0] for x in self.times]
+
+    def offset(self, date, kvar, level):
+        """returns offset of the record for date, kvar (4 character name) and level index
+           (0 is the surface). Raises KeyError if it is not in the file.
+        """
+        if date not in self.offsets:
+            raise KeyError('{} not in {}'.format(date, self.fname))
+        if (level, kvar) not in self.recnum:
+            raise KeyError('{} level {} not in {}'.format(kvar, level, self.fname))
+        return self.offsets[date] + self.recnum[(level, kvar)] * self.reclen
+
+    def label(self, date, kvar, level):
+        """returns dictionary from parse_label for the record.
+        """
+        offset = self.offset(date, kvar, level)
+        return parse_label(self.mm[offset:offset + 50].decode('ascii'))
+
+    def record(self, date, kvar, level):
+        """returns the unpacked record as an array with shape (ny, nx).
+        """
+        # numpy is only needed to unpack the records.
+        import arlwriter
+        offset = self.offset(date, kvar, level)
+        label = parse_label(self.mm[offset:offset + 50].decode('ascii'))
+        cvar = self.mm[offset + 50:offset + self.reclen]
+        return arlwriter.unpack(cvar, self.nx, self.ny, label['nexp'], label['var1'],
+                                prec=label['prec'])
+
+    def close(self):
+        self.mm.close()
+        self.fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog ARLFILE [options]')
+    parser.add_option("-v", type="string", dest="kvar", default='',
+                      help="variable to print e.g. TEMP")
+    parser.add_option("-l", type="int", dest="level", default=0,
+                      help="{0} level index of the variable. 0 is the surface.")
+    parser.add_option("-t", type="string", dest="time", default='',
+                      help="YYYYMMDDHH of the variable. Default is the first time.")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit()
+    with ARLReader(args[0]) as arl:
+        if not options.kvar:
+            print('{} x {} grid. {} levels. {} records in each time period.'.format(
+                  arl.nx, arl.ny, len(arl.levels), arl.nrec))
+            for level, (height, names) in enumerate(arl.levels):
+                print('{:3d} {:8.1f} {}'.format(level, height, ' '.join(names)))
+            for date, offset in arl.times:
+                print(date.strftime('%Y-%m-%d %H:%M'), offset)
+            sys.exit()
+        date = arl.times[0][0]
+        if options.time:
+            date = datetime.datetime.strptime(options.time, '%Y%m%d%H')
+        rvar = arl.record(date, options.kvar, options.level)
+        print('{} {} level {} min {} max {} mean {}'.format(
+              date.strftime('%Y-%m-%d %H:%M'), options.kvar, options.level,
+              rvar.min(), rvar.max(), rvar.mean()))
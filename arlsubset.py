@@ -0,0 +1,184 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+from optparse import OptionParser
+import sys
+import numpy as np
+import arlreader
+import arlwriter
+
+"""
+MAIN PROGRAM: writes a smaller ARL file from an existing one.
+
+PYTHON 3.x
+
+ABSTRACT: cuts a latitude longitude box out of an ARL file, drops the levels
+above a top pressure and keeps only some of the variables so that a regional
+file can be made from a global one without retrieving the data from the CDS again.
+
+The file is read one record at a time with arlreader.ARLReader and each record
+is cropped and packed again with arlwriter. The index records are written by
+arlwriter.ARLWriter for the new grid, levels and variables.
+
+Only regular latitude longitude grids (as written by era52arl and era5arl.py) can
+be cropped. A box which crosses the edge of a global grid wraps around.
+
+Packing again may change the values by up to the precision of the new record.
+The DIFW and DIFR records hold what the packing of WWND and the precipitation lost
+so they are added back to their field before it is packed again and then computed
+again for the new packing.
+
+    python arlsubset.py -i ERA5_201701.ARL -o EUROPE_201701.ARL --area 72/-25/30/45 -l 100
+"""
+
+# standard surface pressure used to find the pressure of sigma and hybrid levels.
+PSTD = 1013.25
+
+# difference records and the fields they belong to.
+DIFNAMES = {'DIFW': ['WWND'], 'DIFR': ['TPP1', 'TPP3', 'TPP6']}
+
+
+def difference_name(kvar, names):
+    """returns the name of the difference record of kvar if it is in names or None.
+    """
+    for difname, parents in DIFNAMES.items():
+        if kvar in parents and difname in names:
+            return difname
+    return None
+
+
+def level_pressure(height, coord):
+    """returns approximate pressure (hPa) of a level from its height in the index record.
+       coord : 1 sigma, 2 pressure, 4 hybrid (height is int(A/100 hPa) + B).
+       Returns None if it can not be computed (e.g. terrain following coordinate).
+    """
+    if coord == 2:
+        return height
+    if coord == 1:
+        return height * PSTD
+    if coord == 4:
+        return int(height) + (height - int(height)) * PSTD
+    return None
+
+
+def select_levels(levels, coord, toplevel=None, kvars=None):
+    """returns list of (old level index, height, names) for the levels to keep.
+       levels : list of (height, names) from the index record. The first is the surface.
+       toplevel : levels with pressure less than toplevel (hPa) are dropped.
+       kvars : list of variable names to keep. None keeps all of them.
+    """
+    keep = []
+    for level, (height, names) in enumerate(levels):
+        if level > 0 and toplevel:
+            pres = level_pressure(height, coord)
+            if pres is None:
+                raise ValueError('can not find pressure of levels with vertical coordinate {}'.format(coord))
+            if pres < toplevel:
+                continue
+        if kvars is not None:
+            names = [x for x in names if x in kvars]
+        # a difference record is only kept with its field.
+        names = [x for x in names if x not in DIFNAMES or
+                 any(y in names for y in DIFNAMES[x])]
+        # the surface is kept even without variables.
+        if names or level == 0:
+            keep.append((level, height, names))
+    return keep
+
+
+def crop_indices(grids, nx, ny, area):
+    """returns (ilist, jlist, clat, clon) for the area N/W/S/E.
+       ilist, jlist : arrays with the columns and rows to keep.
+       clat, clon : lower left corner of the new grid.
+    """
+    north, west, south, east = [float(x) for x in area.split('/')]
+    lat0, lon0, dlat, dlon = grids[9], grids[10], grids[2], grids[3]
+    # regular latitude longitude grid. See arlwriter.latlon_grids.
+    if grids[7] != 1.0 or grids[8] != 1.0 or abs(grids[0] - (lat0 + dlat * (ny - 1))) > dlat / 2:
+        raise ValueError('only latitude longitude grids can be cropped')
+    eps = 1e-4
+    j0 = max(0, int(np.ceil((south - lat0) / dlat - eps)))
+    j1 = min(ny - 1, int(np.floor((north - lat0) / dlat + eps)))
+    # longitudes from the west edge of the grid.
+    width = (east - west) % 360
+    if width == 0 and east != west:
+        width = 360.0
+    west0 = ((west - lon0) % 360) / dlon
+    i0 = int(np.ceil(west0 - eps))
+    isglobal = nx * dlon >= 360 - eps
+    if isglobal:
+        ncol = min(int(np.floor(width / dlon + eps)) + 1, nx)
+        ilist = np.arange(i0, i0 + ncol) % nx
+    else:
+        # box starts west of the grid. Keep the columns between the west edge
+        # of the grid and the east edge of the box.
+        if i0 >= nx:
+            west0 -= 360 / dlon
+        i0 = max(0, int(np.ceil(west0 - eps)))
+        i1 = min(nx - 1, int(np.floor(west0 + width / dlon + eps)))
+        ilist = np.arange(i0, i1 + 1)
+    if j1 < j0 or len(ilist) == 0:
+        raise ValueError('area {} is not in the grid'.format(area))
+    clat = lat0 + j0 * dlat
+    clon = (lon0 + ilist[0] * dlon) % 360
+    return ilist, np.arange(j0, j1 + 1), clat, clon
+
+
+def subset(inname, outname, area=None, toplevel=None, kvars=None):
+    """writes the subset of inname to outname. Returns number of time periods written.
+    """
+    with arlreader.ARLReader(inname) as arl:
+        keep = select_levels(arl.levels, arl.coord, toplevel, kvars)
+        if area:
+            ilist, jlist, clat, clon = crop_indices(arl.grids, arl.nx, arl.ny, area)
+            grids = arlwriter.latlon_grids(clat, clon, arl.grids[2], arl.grids[3],
+                                           len(ilist), len(jlist))
+        else:
+            ilist, jlist, grids = np.arange(arl.nx), np.arange(arl.ny), arl.grids
+        cfg = arlwriter.make_cfg(arl.model, len(ilist), len(jlist), grids,
+                                 [(h, n) for l, h, n in keep], coord=arl.coord)
+        writer = arlwriter.ARLWriter(outname, cfg)
+        for date in arl.dates():
+            for newlevel, (level, height, names) in enumerate(keep):
+                for kvar in names:
+                    # written with their field.
+                    if kvar in DIFNAMES:
+                        continue
+                    rvar = arl.record(date, kvar, level)
+                    ic = arl.label(date, kvar, level)['ic']
+                    # the values before they were packed.
+                    difin = difference_name(kvar, arl.levels[level][1])
+                    if difin:
+                        rvar = rvar + arl.record(date, difin, level)
+                    writer.write(kvar, newlevel, rvar[np.ix_(jlist, ilist)], date, ic=ic,
+                                 difname=difference_name(kvar, names))
+        writer.close()
+        return len(arl.times)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-i", type="string", dest="inname", default='',
+                      help="ARL file to read.")
+    parser.add_option("-o", type="string", dest="outname", default='',
+                      help="ARL file to write.")
+    parser.add_option("--area", type="string", dest="area", default='',
+                      help="N/W/S/E box to keep, as in get_era5_cds.py --area. Default is the whole grid.")
+    parser.add_option("-l", type="float", dest="toplevel", default=0,
+                      help="drop levels with pressure less than this (hPa). For sigma and hybrid \
+                            levels the pressure is computed with a surface pressure of 1013.25 hPa.")
+    parser.add_option("-v", type="string", dest="kvars", default='',
+                      help="comma separated list of variables to keep e.g. TEMP,UWND,VWND,PRSS. \
+                            Default is all of them.")
+    (options, args) = parser.parse_args()
+    if not options.inname or not options.outname:
+        print('-i and -o must be given')
+        sys.exit()
+    kvars = None
+    if options.kvars:
+        kvars = [x.strip().upper() for x in options.kvars.split(',')]
+    try:
+        ntimes = subset(options.inname, options.outname, area=options.area,
+                        toplevel=options.toplevel, kvars=kvars)
+    except (KeyError, ValueError) as err:
+        print('Error : {}'.format(err))
+        sys.exit(1)
+    print('Wrote {} time periods to {}'.format(ntimes, options.outname))
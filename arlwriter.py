@@ -0,0 +1,372 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import numpy as np
+
+"""
+MODULE: writes meteorological data in the ARL packed format used by HYSPLIT.
+
+PYTHON 3.x
+
+ABSTRACT: python version of the packing routines in the HYSPLIT library
+(PAKSET, PAKREC, PAKOUT, PAKINP, PAKNDX) and of MAKNDX in era52arl.f.
+The records written are the same as those written by the fortran routines.
+
+The ARL file is a direct access file. Each record is a 50 byte label followed
+by nx*ny bytes of packed data. Each time period starts with an index record
+(variable INDX) which describes the grid, the levels and the variables and
+holds a checksum for each record. The records for the time period follow in
+the order given in the configuration file (level by level, variables in the order listed).
+
+Data arrays have shape (ny, nx) with the first row the southernmost latitude, which is
+the same as RVAR(NX,NY) in the fortran code.
+
+Packing: each value is stored as one byte which is the difference from the
+previous value (as it will be unpacked) scaled by 2**(7-NEXP). The first value in
+each row is the difference from the first value of the row below. The first
+column has to be done one value at a time but the rest of the array is packed one
+column at a time for all rows at once with numpy. float32 is used throughout
+so the result is the same as from the fortran REAL arithmetic.
+"""
+
+# length of the label at the start of each record.
+LABEL_LENGTH = 50
+
+
+def checksum(cvar):
+    """rotating checksum of the packed bytes used in the index record.
+       Same as adding each byte and subtracting 255 when the sum is 256 or more.
+    """
+    total = int(np.frombuffer(cvar, dtype=np.uint8).sum(dtype=np.int64))
+    if total == 0:
+        return 0
+    return (total - 1) % 255 + 1
+
+
+def pack(rvar):
+    """packs a 2d array. Same as PAKOUT.
+       rvar : array with shape (ny, nx).
+       Returns (cvar, prec, nexp, var1, ksum).
+       cvar : bytes. packed data.
+       prec : precision of the packed data.
+       nexp : packing scaling exponent.
+       var1 : value at the first grid point.
+       ksum : checksum.
+    """
+    rvar = np.ascontiguousarray(rvar, dtype=np.float32)
+    ny, nx = rvar.shape
+    var1 = rvar[0, 0]
+    # maximum difference between adjacent values along each row and down the first column.
+    rmax = np.float32(0.0)
+    if nx > 1:
+        rmax = max(rmax, np.abs(np.diff(rvar, axis=1)).max())
+    if ny > 1:
+        rmax = max(rmax, np.abs(np.diff(rvar[:, 0])).max())
+    sexp = np.float32(0.0)
+    if rmax != 0:
+        sexp = np.log(np.float32(rmax)) / np.log(np.float32(2.0))
+    nexp = int(sexp)
+    # positive or whole number scaling round up for lower precision
+    if sexp >= 0 or sexp % 1.0 == 0:
+        nexp += 1
+    scexp = np.float32(2.0**(7 - nexp))
+    half = np.float32(127.5)
+    prec = np.float32(2.0**nexp / 254.0)
+    cvar = np.empty((ny, nx), dtype=np.uint8)
+    # first column. each value depends on the unpacked value of the row below.
+    rcol = np.empty(ny, dtype=np.float32)
+    rold = var1
+    for jjj in range(ny):
+        icval = min(255, max(0, int((rvar[jjj, 0] - rold) * scexp + half)))
+        cvar[jjj, 0] = icval
+        rold = np.float32(icval - 127) / scexp + rold
+        rcol[jjj] = rold
+    # remaining columns for all the rows at once.
+    rold = rcol
+    for iii in range(1, nx):
+        icval = np.clip(np.trunc((rvar[:, iii] - rold) * scexp + half), 0, 255)
+        cvar[:, iii] = icval
+        rold = (icval - np.float32(127)) / scexp + rold
+    cvar = cvar.tobytes()
+    return cvar, prec, nexp, var1, checksum(cvar)
+
+
+def unpack(cvar, nx, ny, nexp, var1, prec=0.0):
+    """unpacks data. Same as PAKINP.
+       Values smaller than prec are set to zero.
+       Returns array with shape (ny, nx).
+    """
+    scale = np.float32(2.0**(7 - nexp))
+    diff = np.frombuffer(cvar, dtype=np.uint8, count=nx * ny).reshape(ny, nx)
+    diff = (diff.astype(np.float32) - np.float32(127)) / scale
+    # the first column is a running sum starting from var1
+    # and then each row is a running sum starting from the first column.
+    col = np.concatenate([np.array([var1], dtype=np.float32), diff[:, 0]])
+    diff[:, 0] = np.add.accumulate(col, dtype=np.float32)[1:]
+    rvar = np.add.accumulate(diff, axis=1, dtype=np.float32)
+    if prec:
+        rvar[np.abs(rvar) < prec] = 0.0
+    return rvar
+
+
+def fortran_e(value, width=14, digits=7):
+    """returns value in the fortran format E14.7 e.g. ' 0.2856500E+03'
+    """
+    value = float(np.float32(value))
+    if value == 0:
+        text = '0.' + '0' * digits + 'E+00'
+    else:
+        mant, exp = '{:.{}e}'.format(abs(value), digits - 1).split('e')
+        exp = int(exp) + 1
+        if abs(exp) < 100:
+            text = '0.{}E{:+03d}'.format(mant.replace('.', ''), exp)
+        else:
+            text = '0.{}{:+04d}'.format(mant.replace('.', ''), exp)
+        if value < 0:
+            text = '-' + text
+    return text.rjust(width)
+
+
+def fortran_f(value, width, decimals):
+    """returns value in the fortran format Fw.d. The leading zero is left
+       out if it does not fit, as gfortran does.
+    """
+    text = '{:.{}f}'.format(float(np.float32(value)), decimals)
+    if len(text) > width:
+        text = text.replace('0.', '.', 1)
+    if len(text) > width:
+        return '*' * width
+    return text.rjust(width)
+
+
+def fortran_i(value, width):
+    """returns value in the fortran format Iw. Filled with * if it does not fit.
+    """
+    text = '{:{}d}'.format(int(value), width)
+    if len(text) > width:
+        return '*' * width
+    return text
+
+
+def height_str(height):
+    """returns level height in 6 characters as written by MAKNDX and PAKNDX.
+    """
+    if height < 1.0:
+        return fortran_f(height, 6, 5)
+    elif height < 10.0:
+        return fortran_f(height, 6, 4)
+    elif height < 100.0:
+        return fortran_f(height, 6, 3)
+    elif height < 1000.0:
+        return fortran_f(height, 6, 2)
+    return fortran_f(height, 6, 1)
+
+
+def grid_str(nx, ny, gridnum=99):
+    """returns the two character grid identification for the label.
+       For grids with 1000 or more points in either direction the
+       thousands are written as letters (A=1000, B=2000 ...) and 9 for none.
+    """
+    if nx < 1000 and ny < 1000:
+        return '{:2d}'.format(gridnum)
+    gstr = ''
+    for nnn in [nx, ny]:
+        if nnn >= 1000:
+            gstr += chr(ord('A') + nnn // 1000 - 1)
+        else:
+            gstr += '9'
+    return gstr
+
+
+def make_label(date, ic, level, gstr, kvar, nexp, prec, var1):
+    """returns the 50 character label. format (7I2,A4,I4,2E14.7)
+       date : datetime for the record.
+       ic : forecast hour.
+       level : level index. 0 is the surface. Written with I2 as in PAKREC so it is
+               ** for the model levels from 100 up. HYSPLIT does not read the level
+               from the label. The records are found from their position after the index record.
+    """
+    label = '{:2d}{:2d}{:2d}{:2d}{:2d}'.format(date.year % 100, date.month, date.day,
+                                               date.hour, min(ic, 99)) + fortran_i(level, 2)
+    label += gstr + kvar.ljust(4)[0:4] + '{:4d}'.format(nexp)
+    label += fortran_e(prec) + fortran_e(var1)
+    return label
+
+
+def latlon_grids(clat, clon, dlat, dlon, nx, ny):
+    """returns the 12 grid parameters for a regular latitude longitude grid.
+       clat, clon : lower left corner. Same as MAKNDX.
+    """
+    f32 = np.float32
+    grids = [0.0] * 12
+    # sync x,y defines lower left grid point
+    grids[7] = 1.0
+    grids[8] = 1.0
+    grids[9] = f32(clat)
+    grids[10] = f32(clon)
+    # grid should be defined on a 0->360 coordinate
+    if grids[10] < 0:
+        grids[10] = f32(360.0) + grids[10]
+    # pole lat/lon is used to identify the latlon point of the max index
+    grids[0] = grids[9] + f32(dlat) * f32(ny - 1)
+    grids[1] = np.fmod(grids[10] + f32(dlon) * f32(nx - 1), f32(360.0))
+    # ref lat and ref lon define grid spacing
+    grids[2] = f32(dlat)
+    grids[3] = f32(dlon)
+    return [float(x) for x in grids]
+
+
+def make_cfg(model, nx, ny, grids, levels, coord=2, gridnum=99):
+    """returns dictionary describing the ARL file. Same information as the
+       configuration file written by MAKNDX and read by PAKSET.
+       levels : list of (height, list of variable names). The first is the surface.
+       coord : vertical coordinate (1:sigma 2:pressure 3:terrain 4:hybrid)
+    """
+    return {'model': model, 'gridnum': gridnum, 'coord': coord, 'grids': list(grids),
+            'nx': nx, 'ny': ny, 'levels': [(float(h), list(v)) for h, v in levels]}
+
+
+def read_cfg(fname):
+    """reads the configuration file written by MAKNDX (e.g. arldata.cfg).
+    """
+    with open(fname, 'r') as fid:
+        lines = [x.rstrip('\n') for x in fid.readlines()]
+    model = lines[0][20:24]
+    gridnum = int(lines[1][20:24])
+    coord = int(lines[2][20:24])
+    grids = [float(x[20:]) for x in lines[3:15]]
+    nx = int(lines[15][20:])
+    ny = int(lines[16][20:])
+    nz = int(lines[17][20:])
+    levels = []
+    for line in lines[18:18 + nz]:
+        height = float(line[20:26])
+        nvar = int(line[26:29])
+        names = [line[30 + 5 * n:34 + 5 * n] for n in range(nvar)]
+        levels.append((height, names))
+    return make_cfg(model, nx, ny, grids, levels, coord=coord, gridnum=gridnum)
+
+
+def write_cfg(fname, cfg):
+    """writes the configuration file in the same format as MAKNDX.
+    """
+    labels = ['Model Type:', 'Grid Numb:', 'Vert Coord:', 'Pole Lat:',
+              'Pole Lon:', 'Ref Lat:', 'Ref Lon:', 'Grid Size:', 'Orientation:',
+              'Cone Angle:', 'Sync X Pt:', 'Sync Y Pt:', 'Sync Lat:', 'Sync Lon:',
+              'Reserved:', 'Numb X pt:', 'Numb Y pt:', 'Numb Levels:']
+    with open(fname, 'w') as fid:
+        fid.write(labels[0].ljust(20) + cfg['model'] + '\n')
+        fid.write(labels[1].ljust(20) + '{:4d}'.format(cfg['gridnum']) + '\n')
+        fid.write(labels[2].ljust(20) + '{:4d}'.format(cfg['coord']) + '\n')
+        for label, value in zip(labels[3:15], cfg['grids']):
+            fid.write(label.ljust(20) + fortran_f(value, 10, 2) + '\n')
+        fid.write(labels[15].ljust(20) + '{:4d}'.format(cfg['nx']) + '\n')
+        fid.write(labels[16].ljust(20) + '{:4d}'.format(cfg['ny']) + '\n')
+        fid.write(labels[17].ljust(20) + '{:4d}'.format(len(cfg['levels'])) + '\n')
+        for nl, (height, names) in enumerate(cfg['levels']):
+            line = 'Level {:4d}:'.format(nl + 1).ljust(20)
+            line += height_str(height) + '{:3d}'.format(len(names))
+            line += ''.join(' ' + x for x in names)
+            fid.write(line + '\n')
+
+
+class ARLWriter:
+
+    def __init__(self, fname, cfg, append=False):
+        """fname : name of ARL file.
+           cfg : dictionary from make_cfg or read_cfg.
+           append : if True add time periods to the end of an existing file.
+        """
+        self.fname = fname
+        self.cfg = cfg
+        self.nx = cfg['nx']
+        self.ny = cfg['ny']
+        self.nxy = self.nx * self.ny
+        self.reclen = LABEL_LENGTH + self.nxy
+        self.gstr = grid_str(self.nx, self.ny, cfg['gridnum'])
+        # position of each record in the time period. 0 is the index record.
+        self.recnum = {}
+        nnn = 1
+        for level, (height, names) in enumerate(cfg['levels']):
+            for kvar in names:
+                self.recnum[(level, kvar)] = nnn
+                nnn += 1
+        self.nrec = nnn
+        if self.header_length() > self.nxy:
+            raise ValueError('grid is too small for the index record. {} {}'.format(
+                             self.header_length(), self.nxy))
+        if append and os.path.isfile(fname):
+            self.fid = open(fname, 'r+b')
+            self.fid.seek(0, 2)
+        else:
+            self.fid = open(fname, 'wb')
+        self.date = None
+        self.ic = 0
+        self.base = 0
+        self.checksums = {}
+
+    def header_length(self):
+        """length of the index information after the label.
+        """
+        return 108 + sum(8 + 8 * len(names) for height, names in self.cfg['levels'])
+
+    def write(self, kvar, level, rvar, date, ic=0, difname=None):
+        """packs and writes one record. Same as PAKREC.
+           kvar : 4 character variable name.
+           level : level index. 0 is the surface.
+           rvar : array with shape (ny, nx).
+           date : datetime of the record.
+           ic : forecast hour.
+           difname : if set also write the difference between rvar and the
+                     packed values as variable difname (e.g. DIFW or DIFR).
+        """
+        if (level, kvar) not in self.recnum:
+            raise ValueError('{} level {} is not in the configuration'.format(kvar, level))
+        if date != self.date:
+            self.flush()
+            self.date = date
+            self.ic = ic
+            self.fid.seek(0, 2)
+            self.base = self.fid.tell()
+            self.checksums = {}
+        rvar = np.asarray(rvar, dtype=np.float32)
+        if rvar.shape != (self.ny, self.nx):
+            raise ValueError('{} has shape {}. Expected {}'.format(kvar, rvar.shape,
+                             (self.ny, self.nx)))
+        cvar, prec, nexp, var1, ksum = pack(rvar)
+        label = make_label(date, ic, level, self.gstr, kvar, nexp, prec, var1)
+        self.fid.seek(self.base + self.recnum[(level, kvar)] * self.reclen)
+        self.fid.write(label.encode('ascii') + cvar)
+        self.checksums[(level, kvar)] = ksum
+        if difname:
+            diff = rvar - unpack(cvar, self.nx, self.ny, nexp, var1)
+            self.write(difname, level, diff, date, ic=ic)
+
+    def flush(self):
+        """writes the index record for the current time period. Same as PAKNDX.
+           Records which were not written are filled with zeros.
+        """
+        if self.date is None:
+            return
+        for (level, kvar), nnn in self.recnum.items():
+            if (level, kvar) not in self.checksums:
+                self.write(kvar, level, np.zeros((self.ny, self.nx), dtype=np.float32),
+                           self.date, ic=self.ic)
+        cfg = self.cfg
+        index = '{:4s}{:3d}{:2d}'.format(cfg['model'][0:4], self.ic, self.date.minute)
+        index += ''.join(fortran_f(x, 7, 2) for x in cfg['grids'])
+        index += '{:3d}{:3d}{:3d}{:2d}{:4d}'.format(self.nx % 1000, self.ny % 1000,
+                                                    len(cfg['levels']), cfg['coord'],
+                                                    self.header_length())
+        for level, (height, names) in enumerate(cfg['levels']):
+            index += height_str(height) + '{:2d}'.format(len(names))
+            for kvar in names:
+                index += '{:4s}{:3d} '.format(kvar, self.checksums[(level, kvar)])
+        label = make_label(self.date, self.ic, 0, self.gstr, 'INDX', 0, 0.0, 0.0)
+        record = (label + index).ljust(self.reclen)
+        self.fid.seek(self.base)
+        self.fid.write(record.encode('ascii'))
+        self.date = None
+
+    def close(self):
+        self.flush()
+        self.fid.close()
@@ -34,6 +34,7 @@
 !  -a[input grib1 surface fields {SFC.GRIB}]
 !  -f[input grib1 surface fields {SFC2.GRIB}]
 !  -o[output data file name {DATA.ARL}]
+!  -s[streaming mode {False}. Only the messages for one time period are in memory]
 !  -v[verbose mode {False}]
 !
 !
@@ -59,6 +60,12 @@
 !               01 FEB 2018(AMC) - added -p option to extract ensemble member
 !               01 FEB 2018(AMC) - started adding functionality to read model
 !                                  level grib file.
+!               18 OCT 2026      - surface messages are indexed by time period
+!                                  in the first pass instead of searching
+!                                  all of them for every time period.
+!               18 OCT 2026      - added -s option to read the messages for
+!                                  each time period from the file instead of
+!                                  keeping all of them in memory.
     
 !
 ! Input files 
@@ -91,10 +98,17 @@
 
 !call pakset to initialize the ARL file
 !
+!In streaming mode (-s) the first pass only keeps the position and length of
+!each message in the files. The messages for each time period are then read
+!from the files (see MSGLOAD) before the time period is packed and released
+!after it, so only one time period is in memory instead of the whole files.
+!
 !Loop for each time period which
 ! packs the 3d analysis data
 ! packs the 2d analysis data
-! loops through 2d forecast data until finds matching time period and packs it.
+! packs the 2d forecast data for the time period.
+!The 2d messages for each time period are found from an index (see MSGNDX)
+!built from the validity times read in the first pass.
 
 !--------------------------------------------------------------
 
@@ -114,6 +128,7 @@ PROGRAM era52arl
   logical                            ::  udif = .true.  !use the dif fields.
   logical                            ::  warn = .false.  !use the dif fields.
   logical                            ::  verbose = .false.!print more info
+  logical                            ::  stream = .false. !read messages for each time period
   logical                            ::  geopot = .false. !geopotential in file
   integer                            ::  ifile  !file identification
   integer                            ::  iret   !returned from ecCodes function.
@@ -160,6 +175,9 @@ PROGRAM era52arl
 
   integer, parameter :: lunit = 50  ! output unit for ARL packed data
   integer, parameter :: kunit = 60  ! log file unit
+  integer, parameter :: sunit = 70  ! 3d grib file in streaming mode
+  integer, parameter :: saunit = 71 ! 2d analysis grib file in streaming mode
+  integer, parameter :: sfunit = 72 ! 2d forecast grib file in streaming mode
   integer            :: ixx,iyy     ! check point
 
   integer               :: pimn
@@ -190,6 +208,26 @@ PROGRAM era52arl
   integer, dimension(:),allocatable  :: fmsglev  !for sfc forecast file
   integer, dimension(:),allocatable  :: fmsgvar  !for sfc forecast file
 
+  !Validity time (YYYYMMDDHH) and ensemble member of each surface message.
+  !These are read once in the first pass so that the loop through the
+  !time periods does not need to search through all the surface messages.
+  integer, dimension(:),allocatable  :: amsgtim, amsgmem  !for sfc analysis file
+  integer, dimension(:),allocatable  :: fmsgtim, fmsgmem  !for sfc forecast file
+  integer, dimension(:),allocatable  :: ptime    !validity time of each time period in 3d file
+  !Index of the surface messages for each time period.
+  !The messages for time period iii are andx(aptr(iii)) to andx(aptr(iii+1)-1)
+  integer, dimension(:),allocatable  :: aptr, andx  !for sfc analysis file
+  integer, dimension(:),allocatable  :: fptr, fndx  !for sfc forecast file
+  integer                            :: idate, ip
+
+  !Position in the file and length of each message for streaming mode.
+  integer(kind=8), dimension(:),allocatable :: msgoff, amsgoff, fmsgoff
+  integer,         dimension(:),allocatable :: msglen, amsglen, fmsglen
+  integer,         dimension(:),allocatable :: ilist   !messages to load
+  integer, parameter :: keep = 10  !message kept in memory to get the grid.
+  integer                            :: kgrid  !keep or the last message if there are fewer.
+  integer                            :: akgrid, fkgrid  !same for the surface files.
+
   integer                            :: numsfc, numatm, numlev ! actual number of variables
   integer         ,dimension(maxvar) :: atmcat, atmnum ! grib2 category and parameter for 3d variables
   integer         ,dimension(maxvar) :: sfccat, sfcnum ! grib2 category and parameter for 2d variables
@@ -322,6 +360,8 @@ PROGRAM era52arl
      WRITE(*,*)' -t[{1} integer. Extract every ith time period in the grib file]'
      WRITE(*,*)'  e.g. 1 extract all time periods. 2 extract every other time'
      WRITE(*,*)'  period.'
+     WRITE(*,*)' -s[streaming mode {False}. Read the messages for each time period'
+     WRITE(*,*)'  from the files instead of loading all the messages into memory.]'
      WRITE(*,*)' -v[verbose mode {False}]'
 !     WRITE(*,*)' -c[vertical coordinate. (2)- pressure levels. 4-model levels]'
      STOP
@@ -366,6 +406,8 @@ PROGRAM era52arl
         READ(message(3:),'(I2)' )tstep
 !     CASE ('-c','-C')
 !        READ(message(3:),'(I2)' )coord
+     CASE ('-s','-S')
+        stream=.TRUE.
      CASE ('-v','-V')
         verbose=.TRUE.
      END SELECT
@@ -477,10 +519,15 @@ PROGRAM era52arl
       allocate(igrib (num_msg))
       allocate(msglev(num_msg))
       allocate(msgvar(num_msg))
+      allocate(ptime(num_msg))
       igrib =-1
       msglev=-1
       msgvar=-1
+      allocate(msgoff(num_msg))
+      allocate(msglen(num_msg))
       !Load the messages into memory from file
+      !In streaming mode each message is loaded and released in the loop below.
+      IF(.NOT.stream)THEN
       DO i=1,num_msg
          call grib_new_from_file(ifile,igrib(i), iret)
          IF (iret.NE.grib_success) GOTO 900
@@ -488,9 +535,17 @@ PROGRAM era52arl
       ! close the file
       call grib_close_file(ifile,iret)
       IF (iret.NE.grib_success) GOTO 900
+      ENDIF
 
+      kgrid=min(keep,num_msg)
       ! coord is used in makndx subroutine
       DO i=1,num_msg  !loop through 3D file messages
+         IF(stream)THEN
+            call grib_new_from_file(ifile,igrib(i), iret)
+            IF (iret.NE.grib_success) GOTO 900
+            call grib_get(igrib(i),'offset',msgoff(i))
+            call grib_get(igrib(i),'totalLength',msglen(i))
+         ENDIF
          call grib_get(igrib(i),'levelType',ltype)
          IF(trim(ltype).EQ.'pl')THEN
              call grib_get(igrib(i),'perturbationNumber',pnum)
@@ -512,6 +567,8 @@ PROGRAM era52arl
          END IF
          pdate = value
          pimn = imn
+         READ(value,*) idate
+         ptime(fff) = idate*100 + imn/100
 
 
 !This block for processing grib file with model levels (grib2 file).
@@ -607,7 +664,12 @@ PROGRAM era52arl
             !uncomment
             WRITE(kunit,*)'levelType not defined: ',i,ltype,'X trim(ltype):',trim(ltype),'X'
          END IF     ! if trim(ltype)
+         IF(stream.and.i.ne.kgrid)THEN
+            call grib_release(igrib(i))
+            igrib(i)=-1
+         ENDIF
       END DO !end of loop through 3d file messages.
+      IF(stream) call grib_close_file(ifile,iret)
       WRITE(*,*) 'levels found in 3d file ' , ltype
 
       IF(UDIF) atmarl(numatm+1) = 'DIFW'
@@ -624,15 +686,23 @@ PROGRAM era52arl
 
     CASE (2) !2d analysis fields
       anum_msg = num_msg
+      akgrid=min(keep,anum_msg)
       write(*,*) "Allocating agrib", anum_msg, grib_name
       allocate(agrib(anum_msg))
       allocate(amsglev(anum_msg))
       allocate(amsgvar(anum_msg))
+      allocate(amsgtim(anum_msg))
+      allocate(amsgmem(anum_msg))
       agrib =-1
       amsglev=-1
       amsgvar=-1
+      amsgmem=0
 
+      allocate(amsgoff(num_msg))
+      allocate(amsglen(num_msg))
       !Load the messages into memory from file
+      !In streaming mode each message is loaded and released in the loop below.
+      IF(.NOT.stream)THEN
       DO i=1,num_msg
          call grib_new_from_file(ifile,agrib(i), iret)
          IF (iret.NE.grib_success) GOTO 900
@@ -640,8 +710,19 @@ PROGRAM era52arl
       ! close the file
       call grib_close_file(ifile,iret)
       IF (iret.NE.grib_success) GOTO 900
+      ENDIF
 
       DO i=1,num_msg
+         IF(stream)THEN
+            call grib_new_from_file(ifile,agrib(i), iret)
+            IF (iret.NE.grib_success) GOTO 900
+            call grib_get(agrib(i),'offset',amsgoff(i))
+            call grib_get(agrib(i),'totalLength',amsglen(i))
+         ENDIF
+         call grib_get(agrib(i),'validityDate',idate)
+         call grib_get(agrib(i),'validityTime',imn)
+         amsgtim(i) = idate*100 + imn/100
+         if(enum.ne.-1)call grib_get(agrib(i),'perturbationNumber',amsgmem(i))
          call grib_get(agrib(i),'levelType',ltype)
          IF(trim(ltype).EQ.'sfc') THEN
             call grib_get(agrib(i),'shortName',value)
@@ -674,20 +755,33 @@ PROGRAM era52arl
             END IF
          END IF ! if kv
          END IF
+         IF(stream.and.i.ne.akgrid)THEN
+            call grib_release(agrib(i))
+            agrib(i)=-1
+         ENDIF
       END DO !loop through messages
+      IF(stream) call grib_close_file(ifile,iret)
       IF(UDIF) sfcarl(numsfc+1) = 'DIFR'
    
     CASE (1) !2d forecast fields
       fnum_msg = num_msg
+      fkgrid=min(keep,fnum_msg)
       write(*,*) "Allocating fgrib", fnum_msg, fgrib_name
       allocate(fgrib (num_msg))
       allocate(fmsglev(num_msg))
       allocate(fmsgvar(num_msg))
+      allocate(fmsgtim(num_msg))
+      allocate(fmsgmem(num_msg))
       fgrib =-1
       fmsglev=-1
       fmsgvar=-1
+      fmsgmem=0
 
+      allocate(fmsgoff(num_msg))
+      allocate(fmsglen(num_msg))
       !Load the messages into memory from file
+      !In streaming mode each message is loaded and released in the loop below.
+      IF(.NOT.stream)THEN
       DO i=1,num_msg
          call grib_new_from_file(ifile,fgrib(i), iret)
          IF (iret.NE.grib_success) GOTO 900
@@ -695,9 +789,20 @@ PROGRAM era52arl
       ! close the file
       call grib_close_file(ifile,iret)
       IF (iret.NE.grib_success) GOTO 900
+      ENDIF
 
       !sfcvar= 0 ! surface variable counter
       DO i=1,num_msg
+         IF(stream)THEN
+            call grib_new_from_file(ifile,fgrib(i), iret)
+            IF (iret.NE.grib_success) GOTO 900
+            call grib_get(fgrib(i),'offset',fmsgoff(i))
+            call grib_get(fgrib(i),'totalLength',fmsglen(i))
+         ENDIF
+         call grib_get(fgrib(i),'validityDate',idate)
+         call grib_get(fgrib(i),'validityTime',imn)
+         fmsgtim(i) = idate*100 + imn/100
+         if(enum.ne.-1)call grib_get(fgrib(i),'perturbationNumber',fmsgmem(i))
          call grib_get(fgrib(i),'levelType',ltype)
          IF(trim(ltype).EQ.'sfc') THEN
             call grib_get(fgrib(i),'shortName',value)
@@ -724,7 +829,12 @@ PROGRAM era52arl
         !   write(kunit,*) i,kv,trim(value),' ',sfcarl(kv),sfcvar(kv)
          END IF ! if kv
          END IF
+         IF(stream.and.i.ne.fkgrid)THEN
+            call grib_release(fgrib(i))
+            fgrib(i)=-1
+         ENDIF
       END DO
+      IF(stream) call grib_close_file(ifile,iret)
       IF(UDIF) sfcarl(numsfc+1) = 'DIFR'
     
 
@@ -732,6 +842,21 @@ PROGRAM era52arl
 
   END DO !loop through files
 !  WRITE(*,*) "finished first loop through files"
+
+! index the surface messages by time period (and ensemble member) so that
+! each time period only reads its own messages.
+  IF(afile.eq.1)THEN
+     allocate(aptr(fff+1))
+     allocate(andx(anum_msg))
+     CALL MSGNDX(anum_msg,amsgtim,amsgmem,enum,fff,ptime,aptr,andx)
+     write(kunit,*) 'surface analysis messages indexed', aptr(fff+1)-1, anum_msg
+  ENDIF
+  IF(ffile.eq.1)THEN
+     allocate(fptr(fff+1))
+     allocate(fndx(fnum_msg))
+     CALL MSGNDX(fnum_msg,fmsgtim,fmsgmem,enum,fff,ptime,fptr,fndx)
+     write(kunit,*) 'surface forecast messages indexed', fptr(fff+1)-1, fnum_msg
+  ENDIF
 !------------------------------------------------------------
 ! create HYSPLIT packing configuration file
 
@@ -739,7 +864,7 @@ PROGRAM era52arl
 
   model='ERA5'
 
-  i=10   !arbitrary - all messages should have same grid.
+  i=kgrid   !arbitrary - all messages should have same grid.
   call grib_get(igrib(i),'gridType',project)
   write(kunit,*) 'PROJECTION ', trim(project)
   write(kunit,*) 'vertical coordinate=', coord
@@ -764,23 +889,23 @@ PROGRAM era52arl
   write(kunit,*) "number of atmospheric variables", NUMATM
   write(*,*) clat,clon,clat2,clon2,dlon,dlat
   if(afile.eq.1)THEN
-  call grib_get(agrib(i),'latitudeOfFirstGridPointInDegrees', aclat2)
-  call grib_get(agrib(i),'longitudeOfFirstGridPointInDegrees',aclon)
-  call grib_get(agrib(i), 'latitudeOfLastGridPointInDegrees', aclat)
-  call grib_get(agrib(i), 'longitudeOfLastGridPointInDegrees',aclon2)
-  call grib_get(agrib(i),'iDirectionIncrementInDegrees', adlon)
-  call grib_get(agrib(i),'jDirectionIncrementInDegrees', adlat)
-  call grib_get(agrib(i),'numberOfPointsAlongAParallel', anxp)
-  call grib_get(agrib(i),'numberOfPointsAlongAMeridian', anyp)
+  call grib_get(agrib(akgrid),'latitudeOfFirstGridPointInDegrees', aclat2)
+  call grib_get(agrib(akgrid),'longitudeOfFirstGridPointInDegrees',aclon)
+  call grib_get(agrib(akgrid), 'latitudeOfLastGridPointInDegrees', aclat)
+  call grib_get(agrib(akgrid), 'longitudeOfLastGridPointInDegrees',aclon2)
+  call grib_get(agrib(akgrid),'iDirectionIncrementInDegrees', adlon)
+  call grib_get(agrib(akgrid),'jDirectionIncrementInDegrees', adlat)
+  call grib_get(agrib(akgrid),'numberOfPointsAlongAParallel', anxp)
+  call grib_get(agrib(akgrid),'numberOfPointsAlongAMeridian', anyp)
   ELSE
-  call grib_get(fgrib(i),'latitudeOfFirstGridPointInDegrees', aclat2)
-  call grib_get(fgrib(i),'longitudeOfFirstGridPointInDegrees',aclon)
-  call grib_get(fgrib(i), 'latitudeOfLastGridPointInDegrees', aclat)
-  call grib_get(fgrib(i), 'longitudeOfLastGridPointInDegrees',aclon2)
-  call grib_get(fgrib(i),'iDirectionIncrementInDegrees', adlon)
-  call grib_get(fgrib(i),'jDirectionIncrementInDegrees', adlat)
-  call grib_get(fgrib(i),'numberOfPointsAlongAParallel', anxp)
-  call grib_get(fgrib(i),'numberOfPointsAlongAMeridian', anyp)
+  call grib_get(fgrib(fkgrid),'latitudeOfFirstGridPointInDegrees', aclat2)
+  call grib_get(fgrib(fkgrid),'longitudeOfFirstGridPointInDegrees',aclon)
+  call grib_get(fgrib(fkgrid), 'latitudeOfLastGridPointInDegrees', aclat)
+  call grib_get(fgrib(fkgrid), 'longitudeOfLastGridPointInDegrees',aclon2)
+  call grib_get(fgrib(fkgrid),'iDirectionIncrementInDegrees', adlon)
+  call grib_get(fgrib(fkgrid),'jDirectionIncrementInDegrees', adlat)
+  call grib_get(fgrib(fkgrid),'numberOfPointsAlongAParallel', anxp)
+  call grib_get(fgrib(fkgrid),'numberOfPointsAlongAMeridian', anyp)
   ENDIF
 
   !checking that 2d analysis and 3d pressure level have same grid.
@@ -870,6 +995,29 @@ PROGRAM era52arl
 !  deallocate(msglev)
 !  deallocate(msgvar)
   write(*,*) "Initialized packing routines"
+
+! in streaming mode the messages kept to get the grid are released
+! and the grib files are opened to read the messages for each time period.
+  IF(stream)THEN
+     call grib_release(igrib(kgrid))
+     igrib(kgrid)=-1
+     IF(afile.eq.1)THEN
+        call grib_release(agrib(akgrid))
+        agrib(akgrid)=-1
+     ENDIF
+     IF(ffile.eq.1)THEN
+        call grib_release(fgrib(fkgrid))
+        fgrib(fkgrid)=-1
+     ENDIF
+     OPEN(sunit,FILE=TRIM(tgrib_name),ACCESS='STREAM',FORM='UNFORMATTED',STATUS='OLD')
+     IF(afile.eq.1)THEN
+        OPEN(saunit,FILE=TRIM(agrib_name),ACCESS='STREAM',FORM='UNFORMATTED',STATUS='OLD')
+     ENDIF
+     IF(ffile.eq.1)THEN
+        OPEN(sfunit,FILE=TRIM(fgrib_name),ACCESS='STREAM',FORM='UNFORMATTED',STATUS='OLD')
+     ENDIF
+     allocate(ilist(num_msg/fff))
+  ENDIF
 !------------------------------------------------------------
 ! LOOP through all messages reading selected variables and
 ! writing data to the packed HYSPLIT output format
@@ -882,6 +1030,17 @@ PROGRAM era52arl
 
   WRITE(*,*) 'processing file ' , tgrib_name
   WRITE(*,*) 'TIME' , iii, fff, tstep
+  !read the messages for this time period from the files.
+  IF(stream)THEN
+     DO i=1,num_msg/fff
+        ilist(i)=(iii-1)*num_msg/(fff)+i
+     END DO
+     CALL MSGLOAD(sunit,num_msg/fff,ilist,1,num_msg/fff,num_msg,msgoff,msglen,igrib)
+     IF(afile.eq.1)CALL MSGLOAD(saunit,anum_msg,andx,aptr(iii),aptr(iii+1)-1,     &
+                                anum_msg,amsgoff,amsglen,agrib)
+     IF(ffile.eq.1)CALL MSGLOAD(sfunit,fnum_msg,fndx,fptr(iii),fptr(iii+1)-1,     &
+                                fnum_msg,fmsgoff,fmsglen,fgrib)
+  ENDIF
   !get the 3D variables for each time period.
   DO i=(iii-1) * num_msg  / (fff)+1, (iii-1)*num_msg/(fff) + num_msg/(fff) !number of 3D messages per time period.
      !If file with ensemble members 
@@ -949,27 +1108,9 @@ PROGRAM era52arl
   !
   IF(afile.eq.1)THEN
   WRITE(*,*) 'processing sfc file agrib ' , agrib_name
-  test2=0
-  DO i= 1,anum_msg   !number of 2D messages 
-  !DO i=(iii-1) * anum_msg  / (fff)+1, (iii-1)*anum_msg/(fff) + anum_msg/(fff)  !number of 2D messages per time period.
-     test1=0
-     if(enum.ne.-1)call grib_get(agrib(i),'perturbationNumber',pnum)
-     IF(enum.ne.-1.and.pnum.ne.enum)CYCLE
-     call grib_get(agrib(i),'validityDate',value)
-     READ(value,'(2X,3I2)') fiyr,fimo,fida
-     !call grib_get(agrib(i),'dataTime',imn)
-     call grib_get(agrib(i),'validityTime',fimn)
-     !call grib_get(fgrib(i),'endStep', step)
-     fihr=fimn/100
-     fimn=fimn-fihr*100
-     !If date does not match then cycle to next message 
-     if(fihr.ne.ihr) test1=test1+1
-     if(fida.ne.ida) test1=test1+1
-     if(fimo.ne.imo) test1=test1+1
-     IF(TEST1.GT.0)CYCLE
-     !IF((TEST1.GT.0).AND.(TEST2.GT.0))EXIT
-     !ipa = i
-     test2= test2+1
+  !only the messages with the date, time and ensemble member of this time period.
+  DO ip= aptr(iii), aptr(iii+1)-1
+     i = andx(ip)
      IF(amsgvar(i).LT.0)CYCLE
      ! define the variable string by the variable and level
      ! index values saved for each message number
@@ -1024,30 +1165,9 @@ PROGRAM era52arl
   IF(ffile.EQ.1)THEN
   WRITE(*,*) 'processing sfc file fgrib ', fgrib_name
   warn = .true.
-  !!search through all the messages. (possibly could start with the last
-  !message but not sure would save that much time.)
-  test2=0
-  DO i= 1,fnum_msg   !number of 2D messages 
-     !get the Date, time and step.
-     !calculate the date and time the data is for
-     !check to see if it matches date we are writing records for.
-     test1=0
-     if(enum.ne.-1)call grib_get(fgrib(i),'perturbationNumber',pnum)
-     IF(enum.ne.-1.and.pnum.ne.enum)CYCLE
-     call grib_get(fgrib(i),'validityDate',value)
-     READ(value,'(2X,3I2)') fiyr,fimo,fida
-     call grib_get(fgrib(i),'validityTime',fimn)
-     call grib_get(fgrib(i),'endStep', step)
-     fihr=fimn/100
-     fimn=fimn-fihr*100
-     !If date does not match then cycle to next message 
-     if(fihr.ne.ihr) test1=test1+1
-     if(fida.ne.ida) test1=test1+1
-     if(fimo.ne.imo) test1=test1+1
-     IF(TEST1.GT.0)CYCLE
-     !IF((TEST1.GT.0).AND.(TEST2.GT.0))EXIT
-     !ipp = i
-     !test2= test2+1
+  !the index has the messages which match the date we are writing records for.
+  DO ip= fptr(iii), fptr(iii+1)-1
+     i = fndx(ip)
      warn = .false.
      !!!If the message has data for the correct date then process.
      IF(fmsgvar(i).LT.0)CYCLE
@@ -1105,31 +1225,63 @@ PROGRAM era52arl
   CALL PAKNDX(lunit)
   WRITE(*,*)'Finished TIME: ',IYR,IMO,IDA,IHR,IMN
   WRITE(kunit,*)'Finished TIME: ',IYR,IMO,IDA,IHR,IMN
+  !free the messages for this time period.
+  IF(stream)THEN
+     CALL MSGFREE(num_msg/fff,ilist,1,num_msg/fff,num_msg,igrib)
+     IF(afile.eq.1)CALL MSGFREE(anum_msg,andx,aptr(iii),aptr(iii+1)-1,anum_msg,agrib)
+     IF(ffile.eq.1)CALL MSGFREE(fnum_msg,fndx,fptr(iii),fptr(iii+1)-1,fnum_msg,fgrib)
+  ENDIF
   END DO  !loop through time periods (iii).
 
 
+  IF(stream)THEN
+     CLOSE(sunit)
+     IF(afile.eq.1)CLOSE(saunit)
+     IF(ffile.eq.1)CLOSE(sfunit)
+     deallocate(ilist)
+  ELSE
   DO i=1,num_msg
     call grib_release(igrib(i))
   END DO
+  ENDIF
   deallocate(igrib)
+  deallocate(msgoff)
+  deallocate(msglen)
   deallocate(msglev)
   deallocate(msgvar)
+  deallocate(ptime)
 
   IF(afile.eq.1)THEN
+      IF(.NOT.stream)THEN
       DO i=1,anum_msg
         call grib_release(agrib(i))
       END DO
+      ENDIF
       deallocate(agrib)
+      deallocate(amsgoff)
+      deallocate(amsglen)
       deallocate(amsglev)
       deallocate(amsgvar)
+      deallocate(amsgtim)
+      deallocate(amsgmem)
+      deallocate(aptr)
+      deallocate(andx)
   ENDIF
   IF(ffile.eq.1)THEN
+      IF(.NOT.stream)THEN
       DO i=1,fnum_msg
         call grib_release(fgrib(i))
       END DO
+      ENDIF
       deallocate(fgrib)
+      deallocate(fmsgoff)
+      deallocate(fmsglen)
       deallocate(fmsglev)
       deallocate(fmsgvar)
+      deallocate(fmsgtim)
+      deallocate(fmsgmem)
+      deallocate(fptr)
+      deallocate(fndx)
   ENDIF
 
   deallocate(cvar)
@@ -1150,6 +1302,122 @@ PROGRAM era52arl
 
 END PROGRAM era52arl  
 
+!-------------------------------------------------------------
+! Index the messages of a surface file by time period.
+! A message belongs to time period p if its validity time is ptime(p)
+! and, when an ensemble member is extracted (enum not -1), it is for
+! that member. The messages for time period p are
+! ndx(ptr(p)) to ndx(ptr(p+1)-1) in the order they are in the file.
+
+SUBROUTINE MSGNDX(nmsg,msgtim,msgmem,enum,fff,ptime,ptr,ndx)
+
+  IMPLICIT NONE
+
+  INTEGER, INTENT(IN)  :: nmsg, enum, fff
+  INTEGER, INTENT(IN)  :: msgtim(nmsg), msgmem(nmsg)
+  INTEGER, INTENT(IN)  :: ptime(fff)
+  INTEGER, INTENT(OUT) :: ptr(fff+1), ndx(nmsg)
+
+  INTEGER, ALLOCATABLE :: msgper(:), next(:)
+  INTEGER :: i, k, p, lastp
+
+  ALLOCATE(msgper(nmsg), next(fff))
+
+! find the time period of each message. The messages are usually in
+! time order so start looking at the time period of the previous message.
+  ptr=0
+  lastp=1
+  DO i=1,nmsg
+     msgper(i)=0
+     IF(enum.NE.-1.AND.msgmem(i).NE.enum)CYCLE
+     p=lastp
+     DO k=1,fff
+        IF(ptime(p).EQ.msgtim(i))THEN
+           msgper(i)=p
+           lastp=p
+           EXIT
+        END IF
+        p=MOD(p,fff)+1
+     END DO
+     IF(msgper(i).GT.0) ptr(msgper(i)+1)=ptr(msgper(i)+1)+1
+  END DO
+
+! count of messages in each time period to start of each time period.
+  ptr(1)=1
+  DO p=1,fff
+     ptr(p+1)=ptr(p+1)+ptr(p)
+     next(p)=ptr(p)
+  END DO
+
+  DO i=1,nmsg
+     p=msgper(i)
+     IF(p.EQ.0)CYCLE
+     ndx(next(p))=i
+     next(p)=next(p)+1
+  END DO
+
+  DEALLOCATE(msgper, next)
+
+END SUBROUTINE msgndx
+
+!-------------------------------------------------------------
+! Streaming mode. Reads messages ilist(i1) to ilist(i2) from the grib file
+! open on iunit (stream access) using the position and length of each
+! message found in the first pass.
+
+SUBROUTINE MSGLOAD(iunit,nlist,ilist,i1,i2,nmsg,msgoff,msglen,handles)
+
+  USE eccodes
+  IMPLICIT NONE
+
+  INTEGER,         INTENT(IN)    :: iunit, nlist, i1, i2, nmsg
+  INTEGER,         INTENT(IN)    :: ilist(nlist)
+  INTEGER(KIND=8), INTENT(IN)    :: msgoff(nmsg)
+  INTEGER,         INTENT(IN)    :: msglen(nmsg)
+  INTEGER,         INTENT(INOUT) :: handles(nmsg)
+
+  CHARACTER(LEN=1), ALLOCATABLE  :: buffer(:)
+  CHARACTER(LEN=80)              :: message
+  INTEGER :: k, i, iret
+
+  DO k=i1,i2
+     i=ilist(k)
+     ALLOCATE(buffer(msglen(i)))
+     READ(iunit,POS=msgoff(i)+1) buffer
+     ! the message is copied so the buffer can be freed.
+     CALL grib_new_from_message(handles(i),buffer,iret)
+     IF(iret.NE.grib_success)THEN
+        CALL grib_get_error_string(iret,message)
+        WRITE(*,*) 'Could not read message ', i, message
+        STOP 900
+     END IF
+     DEALLOCATE(buffer)
+  END DO
+
+END SUBROUTINE msgload
+
+!-------------------------------------------------------------
+! Streaming mode. Releases messages ilist(i1) to ilist(i2).
+
+SUBROUTINE MSGFREE(nlist,ilist,i1,i2,nmsg,handles)
+
+  USE eccodes
+  IMPLICIT NONE
+
+  INTEGER, INTENT(IN)    :: nlist, i1, i2, nmsg
+  INTEGER, INTENT(IN)    :: ilist(nlist)
+  INTEGER, INTENT(INOUT) :: handles(nmsg)
+
+  INTEGER :: k, i
+
+  DO k=i1,i2
+     i=ilist(k)
+     CALL grib_release(handles(i))
+     handles(i)=-1
+  END DO
+
+END SUBROUTINE msgfree
+
 !-------------------------------------------------------------
 ! Create the configuration file for HYSPLIT library
 ! packing subroutines                                 
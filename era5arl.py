@@ -0,0 +1,556 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+from optparse import OptionParser
+import os
+import re
+import sys
+import datetime
+import numpy as np
+import eccodes
+import arlwriter
+import era5utils
+
+"""
+MAIN PROGRAM: converts ERA5 grib files to ARL format.
+
+PYTHON 3.x
+
+ABSTRACT: python version of era52arl.f using eccodes and arlwriter.py.
+It reads the same decoding configuration file (era52arl.cfg or new_era52arl.cfg
+written by get_era5_cds.py) and writes the same records.
+
+The first pass only reads the headers of the messages. The messages are then
+read from the files one time period at a time so only one message is in memory.
+
+With --members all the ensemble members in the files are converted in one pass.
+Each message is written to the ARL file for its member. The files are named
+with the member added after the first part of the name as in grib2arlscript,
+e.g. -o ERA5_20170101.ARL writes ERA5_e0_20170101.ARL to ERA5_e9_20170101.ARL
+and -o T1.ARL writes T1_e0.ARL to T1_e9.ARL.
+
+Model levels (get_era5_cds.py -t ml, mlnew_era52arl.cfg) are written with the
+hybrid vertical coordinate (4). The a and b coefficients of the levels are read
+from the pv array of the grib messages. lnsp and z are only on model level 1.
+The surface pressure (PRSS) is computed from lnsp if it is not in the surface
+file and the height of each level (HGTS) is integrated up from the surface
+geopotential with the virtual temperature. All the levels of a time period
+are done at once with numpy.
+
+With --tres N the times are N hours apart (get_era5_cds.py --tres) and the
+forecast files (-f) have the hourly accumulations for every hour. The
+accumulated fields (precipitation, fluxes) at time t are the sum of the hourly
+values from t-N+1 to t so that with the conversion factors in the configuration
+file (1/(3600 N) for the fluxes) they are the means over the N hours before t.
+Instantaneous fields in the forecast files are taken at t.
+
+With --store the fields are read from a Zarr store written by era5store.py
+(get_era5_cds.py --store) instead of the grib files. Only the chunks for
+--area and the times from --start to --end are read. The variables in the
+store are matched to the configuration file by their HYSPLIT names and the
+conversion factors of the configuration file are used. Fields which were not
+put in the store for a time are written as zeros. Only pressure levels can be
+converted from a store since it does not keep the coefficients of the model levels.
+
+example:
+python era5arl.py -iERA5_2017.Jan01.3denda.grib -aERA5_2017.Jan01.2denda.all.grib -oERA5_20170101.ARL --members
+python era5arl.py --store ERA5_2017Jan.zarr -d new_era52arl.cfg -o ERA5_20170101.ARL --start 2017010100 --end 2017010123
+
+for command line options run with --help
+"""
+
+# gas constant of dry air (J/kg/K) and Rv/Rd - 1 for the virtual temperature.
+RD = 287.06
+VIRTUAL = 0.609133
+
+
+def read_setup(fname):
+    """reads the SETUP namelist in the decoding configuration file.
+       Returns dictionary. Each value is a list.
+    """
+    with open(fname, 'r') as fid:
+        text = fid.read()
+    text = text.split('&SETUP', 1)[-1]
+    text = text[0:text.rfind('/')]
+    setup = {}
+    for match in re.finditer(r'(\w+)\s*=(.*?)(?=\w+\s*=|\Z)', text, re.S):
+        values = []
+        for value in match.group(2).replace('&', ' ').split(','):
+            value = value.strip().strip('\'"')
+            if not value:
+                continue
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+            values.append(value)
+        setup[match.group(1).lower()] = values
+    for key in ['plev', 'atmcat', 'sfccat']:
+        setup[key] = [int(x) for x in setup.get(key, [])]
+    return setup
+
+
+def get_member(gid):
+    if eccodes.codes_is_defined(gid, 'perturbationNumber'):
+        return eccodes.codes_get(gid, 'perturbationNumber')
+    return 0
+
+
+def get_date(gid):
+    vdate = eccodes.codes_get(gid, 'validityDate')
+    vtime = eccodes.codes_get(gid, 'validityTime')
+    return datetime.datetime.strptime('{:08d}{:04d}'.format(vdate, vtime), '%Y%m%d%H%M')
+
+
+def match_message(setup, gid):
+    """returns (ARL name, level index, conversion factor) for the message
+       or None if it is not in the configuration. Level index 0 is the surface.
+       lnsp and z on model levels are only on level 1 and are returned with level index 0.
+    """
+    ltype = eccodes.codes_get(gid, 'levelType')
+    sname = eccodes.codes_get(gid, 'shortName')
+    if ltype == 'ml' and sname in ['lnsp', 'z']:
+        for grb, arl, cnv in zip(setup['atmgrb'], setup['atmarl'], setup['atmcnv']):
+            if sname == grb:
+                return arl, 0, cnv
+        return None
+    if ltype in ['pl', 'ml']:
+        level = eccodes.codes_get(gid, 'level')
+        if level not in setup['plev']:
+            return None
+        for grb, arl, cnv in zip(setup['atmgrb'], setup['atmarl'], setup['atmcnv']):
+            if sname == grb:
+                return arl, setup['plev'].index(level) + 1, cnv
+    elif ltype == 'sfc':
+        param = eccodes.codes_get(gid, 'indicatorOfParameter')
+        for grb, cat, arl, cnv in zip(setup['sfcgrb'], setup['sfccat'], setup['sfcarl'],
+                                      setup['sfccnv']):
+            if sname == grb or (sname == 'unknown' and param == cat):
+                return arl, 0, cnv
+    return None
+
+
+def get_grid(gid):
+    """returns (nx, ny, clat, clon, dlat, dlon) with clat, clon the lower left corner.
+    """
+    nx = eccodes.codes_get(gid, 'Ni')
+    ny = eccodes.codes_get(gid, 'Nj')
+    lat1 = eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees')
+    lat2 = eccodes.codes_get(gid, 'latitudeOfLastGridPointInDegrees')
+    clon = eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees')
+    dlon = eccodes.codes_get(gid, 'iDirectionIncrementInDegrees')
+    dlat = eccodes.codes_get(gid, 'jDirectionIncrementInDegrees')
+    return nx, ny, min(lat1, lat2), clon, dlat, dlon
+
+
+def scan_file(fname, setup, messages):
+    """first pass. Reads the headers of the messages in the file and adds
+       a dictionary for each message in the configuration to messages.
+       Returns the grid of the first message.
+    """
+    grid = None
+    with open(fname, 'rb') as fid:
+        while True:
+            offset = fid.tell()
+            gid = eccodes.codes_grib_new_from_file(fid, headers_only=True)
+            if gid is None:
+                break
+            try:
+                if grid is None:
+                    grid = get_grid(gid)
+                found = match_message(setup, gid)
+                if found:
+                    messages.append({'fname': fname, 'offset': offset, 'date': get_date(gid),
+                                     'member': get_member(gid), 'kvar': found[0],
+                                     'ltype': eccodes.codes_get(gid, 'levelType'),
+                                     'level': found[1], 'cnv': found[2],
+                                     'accum': eccodes.codes_get(gid, 'stepType') == 'accum'})
+            finally:
+                eccodes.codes_release(gid)
+    return grid
+
+
+def get_pv(fname):
+    """returns the a (Pa) and b coefficients of the half levels from the pv
+       array of the first model level message in the file.
+    """
+    with open(fname, 'rb') as fid:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(fid, headers_only=True)
+            if gid is None:
+                break
+            try:
+                if eccodes.codes_get(gid, 'levelType') == 'ml' and eccodes.codes_get(gid, 'NV'):
+                    pv = eccodes.codes_get_array(gid, 'pv')
+                    nhalf = len(pv) // 2
+                    return pv[0:nhalf], pv[nhalf:]
+            finally:
+                eccodes.codes_release(gid)
+    raise ValueError('no model level message with pv array in {}'.format(fname))
+
+
+def full_levels(ahalf, bhalf, levels):
+    """returns a and b of the model levels. Model level n is halfway between
+       half levels n-1 and n.
+    """
+    levels = np.asarray(levels, dtype=int)
+    afull = 0.5 * (ahalf[levels - 1] + ahalf[levels])
+    bfull = 0.5 * (bhalf[levels - 1] + bhalf[levels])
+    return afull, bfull
+
+
+def hybrid_heights(afull, bfull):
+    """returns the level heights for the ARL index record. HYSPLIT reads a hybrid
+       level as the pressure offset in hPa (integer part) plus sigma (fraction).
+    """
+    return [round(a / 100.0) + b for a, b in zip(afull, bfull)]
+
+
+def model_level_fields(fields, afull, bfull, hcnv):
+    """returns dictionary with the fields computed from the model level data.
+       key is (level index, ARL name). PRSS from lnsp and HGTS on every level.
+       fields : dictionary with lnsp, zs (surface height) and dictionaries
+                TEMP and SPHU with the data for each level index.
+       afull, bfull : a and b of the levels in the order of the level indices.
+       hcnv : conversion factor from geopotential to HGTS.
+    """
+    derived = {}
+    if 'lnsp' not in fields:
+        return derived
+    psfc = np.exp(fields['lnsp'])
+    derived[(0, 'PRSS')] = psfc * np.float32(0.01)
+    temp = fields.get('TEMP', {})
+    if 'zs' not in fields or len(temp) != len(afull):
+        return derived
+    # from the bottom level up.
+    order = np.argsort(-(afull + bfull * 101325.0))
+    tv = np.stack([temp[x + 1] for x in order])
+    sphu = fields.get('SPHU', {})
+    if len(sphu) == len(afull):
+        tv *= 1 + np.float32(VIRTUAL) * np.stack([sphu[x + 1] for x in order])
+    pres = (afull[order].astype(np.float32)[:, None, None] +
+            bfull[order].astype(np.float32)[:, None, None] * psfc)
+    logp = np.log(np.concatenate([psfc[None], pres]))
+    # mean virtual temperature of each layer. The first layer is from the
+    # surface to the bottom level.
+    tmean = np.concatenate([tv[0:1], 0.5 * (tv[1:] + tv[:-1])])
+    heights = fields['zs'] + np.cumsum((logp[:-1] - logp[1:]) * tmean, axis=0) * np.float32(RD * hcnv)
+    for nnn, lev in enumerate(order):
+        derived[(lev + 1, 'HGTS')] = heights[nnn]
+    return derived
+
+
+def keep_field(fields, msg, values):
+    """keeps the fields needed by model_level_fields.
+    """
+    kvar = msg['kvar']
+    if kvar == 'LNSP':
+        fields['lnsp'] = values
+    elif kvar == 'HGTS' and msg['level'] == 0:
+        fields['zs'] = values
+    elif kvar == 'SHGT' and 'zs' not in fields:
+        fields['zs'] = values
+    elif kvar in ['TEMP', 'SPHU'] and msg['level'] > 0:
+        fields.setdefault(kvar, {})[msg['level']] = values
+
+
+def make_levels(setup, found, udif=True, heights=None):
+    """returns the levels for arlwriter.make_cfg. Same as MAKNDX.
+       found : set of (level index, ARL name) in the files.
+       heights : heights of the levels. Default is plev.
+    """
+    if heights is None:
+        heights = setup['plev']
+    names = [x for x in setup['sfcarl'] if (0, x) in found]
+    if udif and any(x.startswith('TPP') for x in names):
+        names.append('DIFR')
+    levels = [(0.0, names)]
+    for nnn in range(len(setup['plev'])):
+        names = [x for x in setup['atmarl'] if (nnn + 1, x) in found]
+        if udif and 'WWND' in names:
+            names.append('DIFW')
+        levels.append((float(heights[nnn]), names))
+    return levels
+
+
+def read_values(fid, msg, nx, ny):
+    """returns data for the message as array with shape (ny, nx) with the
+       first row the southernmost latitude.
+    """
+    fid.seek(msg['offset'])
+    gid = eccodes.codes_grib_new_from_file(fid)
+    try:
+        values = eccodes.codes_get_values(gid).astype(np.float32)
+        north_to_south = not eccodes.codes_get(gid, 'jScansPositively')
+    finally:
+        eccodes.codes_release(gid)
+    values = values.reshape(ny, nx)
+    if north_to_south:
+        values = values[::-1]
+    # missing values over the ocean and over the mountains.
+    if msg['kvar'] == 'RGHS':
+        values[values == 9999.0] = 0.01
+    elif msg['kvar'] == 'WWND':
+        values[values == 9999.0] = 0.0
+    return values * np.float32(msg['cnv'])
+
+
+def window_sums(fids, window, nx, ny):
+    """returns dictionary. key is (member, ARL name) and value is the sum of the
+       hourly accumulations in window (list of messages).
+    """
+    sums = {}
+    for msg in window:
+        key = (msg['member'], msg['kvar'])
+        values = read_values(fids[msg['fname']], msg, nx, ny)
+        if key in sums:
+            sums[key] += values
+        else:
+            sums[key] = values
+    return sums
+
+
+def convert(fnames, setup, outname, member=None, members=False, udif=True,
+            arlcfg='arldata.cfg', coord=2, tres=1):
+    """converts the grib files to ARL format.
+       fnames : list of grib files. The first is the file with the 3d fields.
+                The time periods in the ARL file are those in this file.
+       member : ensemble member to convert. If None and there are several
+                members in the files member 0 is converted.
+       members : if True convert all the members. Each member is written to its own file.
+       tres : hours between the times. The hourly accumulations are added up over tres hours.
+       Returns list of the ARL files written.
+    """
+    messages = []
+    grid = None
+    for fname in fnames:
+        fgrid = scan_file(fname, setup, messages)
+        if grid is None:
+            grid = fgrid
+        elif fgrid and fgrid != grid:
+            print('Warning: grid in {} is not the same as in {}'.format(fname, fnames[0]))
+    if not messages:
+        raise ValueError('no messages in the configuration found in {}'.format(' '.join(fnames)))
+    nx, ny, clat, clon, dlat, dlon = grid
+    allmembers = sorted(set(x['member'] for x in messages))
+    if members:
+        keep = allmembers
+    else:
+        if member is None:
+            member = allmembers[0]
+            if len(allmembers) > 1:
+                print('Warning: file may contain ensemble data and no member chosen. '
+                      'Extracting member {}'.format(member))
+        keep = [member]
+    messages = [x for x in messages if x['member'] in keep]
+    found = set((x['level'], x['kvar']) for x in messages)
+    heights = None
+    hybrid = any(x['ltype'] == 'ml' for x in messages)
+    if hybrid:
+        coord = 4
+        ahalf, bhalf = get_pv(fnames[0])
+        afull, bfull = full_levels(ahalf, bhalf, setup['plev'])
+        heights = hybrid_heights(afull, bfull)
+        hcnv = 1.0
+        if 'HGTS' in setup['atmarl']:
+            hcnv = setup['atmcnv'][setup['atmarl'].index('HGTS')]
+        # fields which are computed and not read from the files.
+        derived = set()
+        if (0, 'LNSP') in found:
+            if 'PRSS' in setup['sfcarl']:
+                derived.add((0, 'PRSS'))
+            nlev = len(setup['plev'])
+            if 'HGTS' in setup['atmarl'] and ((0, 'HGTS') in found or (0, 'SHGT') in found) and \
+               all((x + 1, 'TEMP') in found for x in range(nlev)):
+                derived |= set((x + 1, 'HGTS') for x in range(nlev))
+        derived -= found
+        found |= derived
+    cfg = arlwriter.make_cfg('ERA5', nx, ny, arlwriter.latlon_grids(clat, clon, dlat, dlon, nx, ny),
+                             make_levels(setup, found, udif, heights), coord=coord)
+    if arlcfg:
+        arlwriter.write_cfg(arlcfg, cfg)
+    # records in the ARL file. lnsp and z on level 1 are only used to compute other fields.
+    records = set((nnn, x) for nnn, (height, names) in enumerate(cfg['levels']) for x in names)
+    writers = {}
+    for mem in keep:
+        if members:
+            writers[mem] = arlwriter.ARLWriter(era5utils.member_name(outname, mem), cfg)
+        else:
+            writers[mem] = arlwriter.ARLWriter(outname, cfg)
+    # time periods in the file with the 3d fields.
+    dates = sorted(set(x['date'] for x in messages if x['fname'] == fnames[0]))
+    # hourly accumulations which are added up for each time.
+    accums = []
+    if tres > 1:
+        accums = [x for x in messages if x['accum'] and x['level'] == 0]
+        messages = [x for x in messages if not (x['accum'] and x['level'] == 0)]
+    bydate = {}
+    for msg in messages:
+        bydate.setdefault(msg['date'], []).append(msg)
+    fids = dict((x, open(x, 'rb')) for x in fnames)
+    try:
+        for date in dates:
+            fields = dict((x, {}) for x in keep)
+            # the messages for each member are written to its own file.
+            for msg in bydate[date]:
+                difname = None
+                if udif and msg['kvar'] == 'WWND':
+                    difname = 'DIFW'
+                elif udif and msg['kvar'].startswith('TPP'):
+                    difname = 'DIFR'
+                values = read_values(fids[msg['fname']], msg, nx, ny)
+                if hybrid:
+                    keep_field(fields[msg['member']], msg, values)
+                if (msg['level'], msg['kvar']) not in records:
+                    continue
+                writers[msg['member']].write(msg['kvar'], msg['level'], values, date,
+                                             difname=difname)
+            if accums:
+                start = date - datetime.timedelta(hours=tres)
+                window = [x for x in accums if start < x['date'] <= date]
+                for (mem, kvar), values in window_sums(fids, window, nx, ny).items():
+                    nhours = len([x for x in window if (x['member'], x['kvar']) == (mem, kvar)])
+                    if nhours != tres:
+                        print('Warning: {} at {} is the sum of {} hours not {}'.format(
+                              kvar, date, nhours, tres))
+                    difname = 'DIFR' if udif and kvar.startswith('TPP') else None
+                    writers[mem].write(kvar, 0, values, date, difname=difname)
+            if hybrid:
+                for mem in keep:
+                    for key, values in model_level_fields(fields[mem], afull, bfull, hcnv).items():
+                        if key in derived:
+                            writers[mem].write(key[1], key[0], values, date)
+            print('Finished TIME: {}'.format(date.strftime('%Y %m %d %H %M')))
+    finally:
+        for fid in fids.values():
+            fid.close()
+        for writer in writers.values():
+            writer.close()
+    return [x.fname for x in writers.values()]
+
+
+def convert_store(path, setup, outname, start=None, end=None, area=None, udif=True,
+                  arlcfg='arldata.cfg'):
+    """converts the fields in a Zarr store written by era5store.py to ARL format.
+       start, end : datetimes of the first and last time. Default is all the times.
+       area : N/W/S/E box to convert. Default is the whole grid.
+       Returns name of the ARL file written.
+    """
+    import era5store
+    group = era5store.open_store(path, mode='r')
+    variables = group.attrs.get('variables', [])
+    if not variables:
+        raise ValueError('no variables in the store {}'.format(path))
+    stored = []
+    if 'level' in group:
+        if group['level'].attrs['type'] != 'pl':
+            raise ValueError('only pressure levels can be converted from a store')
+        stored = [int(x) for x in group['level'][:]]
+    # (level index, ARL name) and conversion factor of the fields in the store.
+    cnv = {}
+    for kvar, factor in zip(setup['sfcarl'], setup['sfccnv']):
+        if kvar in variables and len(group[kvar].shape) == 3:
+            cnv[(0, kvar)] = factor
+    for nnn, level in enumerate(setup['plev']):
+        if level not in stored:
+            continue
+        for kvar, factor in zip(setup['atmarl'], setup['atmcnv']):
+            if kvar in variables and len(group[kvar].shape) == 4:
+                cnv[(nnn + 1, kvar)] = factor
+    if not cnv:
+        raise ValueError('no variables in the configuration found in {}'.format(path))
+    times = era5store.store_times(group)
+    dates = [x for x in times if (start is None or x >= start) and (end is None or x <= end)]
+    if not dates:
+        raise ValueError('no times from {} to {} in {}'.format(start, end, path))
+    jslice, islice = era5store.area_slices(group, area)
+    lats = group['latitude'][jslice]
+    lons = group['longitude'][islice]
+    nx, ny, clat, clon, dlat, dlon = group.attrs['grid']
+    nx, ny = len(lons), len(lats)
+    cfg = arlwriter.make_cfg('ERA5', nx, ny,
+                             arlwriter.latlon_grids(lats[0], lons[0], dlat, dlon, nx, ny),
+                             make_levels(setup, set(cnv.keys()), udif))
+    if arlcfg:
+        arlwriter.write_cfg(arlcfg, cfg)
+    writer = arlwriter.ARLWriter(outname, cfg)
+    try:
+        for date in dates:
+            tnum = times.index(date)
+            for (level, kvar), factor in sorted(cnv.items()):
+                if level == 0:
+                    values = group[kvar][tnum, jslice, islice]
+                else:
+                    values = group[kvar][tnum, stored.index(setup['plev'][level - 1]),
+                                         jslice, islice]
+                # not put in the store for this time.
+                if np.isnan(values).all():
+                    continue
+                difname = None
+                if udif and kvar == 'WWND':
+                    difname = 'DIFW'
+                elif udif and kvar.startswith('TPP'):
+                    difname = 'DIFR'
+                writer.write(kvar, level, values.astype(np.float32) * np.float32(factor), date,
+                             difname=difname)
+            print('Finished TIME: {}'.format(date.strftime('%Y %m %d %H %M')))
+    finally:
+        writer.close()
+    return outname
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-i", type="string", dest="grib3d", default='DATA.GRIB',
+                      help="{DATA.GRIB} grib file with pressure level fields.")
+    parser.add_option("-a", type="string", dest="grib2d", default='SFC.GRIB',
+                      help="{SFC.GRIB} grib file with surface fields.")
+    parser.add_option("-f", type="string", dest="grib2df", action="append", default=[],
+                      help="grib file with surface forecast fields (optional). \
+                            May be given more than once.")
+    parser.add_option("-d", type="string", dest="cfg", default='era52arl.cfg',
+                      help="{era52arl.cfg} decoding configuration file.")
+    parser.add_option("-o", type="string", dest="outname", default='DATA.ARL',
+                      help="{DATA.ARL} output ARL file.")
+    parser.add_option("-p", type="int", dest="member", default=None,
+                      help="ensemble member to extract.")
+    parser.add_option("--members", action="store_true", dest="members", default=False,
+                      help="convert all the ensemble members in one pass. \
+                            Each member is written to its own file.")
+    parser.add_option("--tres", type="int", dest="tres", default=1,
+                      help="{1} hours between the times. The hourly accumulations in the \
+                            forecast files are added up over tres hours.")
+    parser.add_option("--store", type="string", dest="store", default='',
+                      help="Zarr store written by era5store.py to convert instead of the grib files.")
+    parser.add_option("--start", type="string", dest="start", default='',
+                      help="YYYYMMDDHH first time to convert from the store. Default is the first one.")
+    parser.add_option("--end", type="string", dest="end", default='',
+                      help="YYYYMMDDHH last time to convert from the store. Default is the last one.")
+    parser.add_option("--area", type="string", dest="area", default='',
+                      help="N/W/S/E box to convert from the store. Default is the whole grid.")
+    (options, args) = parser.parse_args()
+    if not os.path.isfile(options.cfg):
+        print('Decoding configuration file not found ' + options.cfg)
+        sys.exit(1)
+    if options.store:
+        start, end = [datetime.datetime.strptime(x, '%Y%m%d%H') if x else None
+                      for x in (options.start, options.end)]
+        try:
+            print('Wrote ' + convert_store(options.store, read_setup(options.cfg), options.outname,
+                                           start=start, end=end, area=options.area))
+        except (KeyError, ValueError) as err:
+            print('Error : {}'.format(err))
+            sys.exit(1)
+        sys.exit()
+    if not os.path.isfile(options.grib3d):
+        print('FILE NOT FOUND ' + options.grib3d)
+        sys.exit(1)
+    fnames = [options.grib3d]
+    for fname in [options.grib2d] + options.grib2df:
+        if not fname:
+            continue
+        if os.path.isfile(fname):
+            fnames.append(fname)
+        else:
+            print('FILE NOT FOUND ' + fname)
+    for outname in convert(fnames, read_setup(options.cfg), options.outname,
+                           member=options.member, members=options.members, tres=options.tres):
+        print('Wrote ' + outname)
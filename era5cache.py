@@ -0,0 +1,230 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import json
+import time
+import shutil
+import hashlib
+import fcntl
+
+"""
+MODULE: local cache of retrieved grib files which can be shared by several users.
+
+PYTHON 3.x
+
+ABSTRACT: Files are stored in the cache under a hash of the normalized request
+(dataset, variables, levels, date, time, area, grid) so the same request made
+from a different directory, or with the variables in a different order, is found.
+On a hit the file is hard linked (or copied if the cache is on another file system)
+to the target and no request is sent to the CDS.
+
+The cache directory contains
+    index.json  : key -> name, request, size, time of last use.
+    objects/    : the grib files.
+    lock        : lock file so several processes can use the cache at once.
+When the total size is larger than maxsize the least recently used files are removed.
+
+If a request is not in the cache but a file for a larger area (e.g. global) with the
+same dataset, dates, times, variables and levels is, the smaller area can be cut from
+it locally (see fetch_superset and gribtools.crop_file).
+"""
+
+
+def _normalize_value(key, value):
+    if isinstance(value, (list, tuple)):
+        items = [str(x) for x in value]
+    else:
+        items = str(value).split('/')
+    items = [x.strip() for x in items]
+    # the order of area and grid values matters.
+    if key in ['area', 'grid']:
+        return [float(x) for x in items]
+    norm = []
+    for item in items:
+        try:
+            norm.append(str(int(item)))
+        except ValueError:
+            norm.append(item.lower())
+    return sorted(norm)
+
+
+def normalize_request(name, request):
+    """returns dictionary which is the same for requests that retrieve the same data.
+    """
+    norm = {'dataset': name}
+    for key in request:
+        norm[key.lower()] = _normalize_value(key.lower(), request[key])
+    return norm
+
+
+def request_key(name, request):
+    text = json.dumps(normalize_request(name, request), sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _on_grid(value, start, inc):
+    nnn = (value - start) / inc
+    return abs(nnn - round(nnn)) < 1e-3
+
+
+def contains(big, small):
+    """returns True if the normalized request big retrieves a larger area
+       than the normalized request small and is otherwise the same.
+       The grid spacing of small must be a multiple of the grid spacing of big
+       and the points of small must be on the grid of big.
+    """
+    if 'area' not in big or 'grid' not in big:
+        return False
+    others = set(big.keys()) | set(small.keys())
+    others -= set(['area', 'grid'])
+    if any(big.get(x) != small.get(x) for x in others):
+        return False
+    bnorth, bwest, bsouth, beast = big['area']
+    north, west, south, east = small['area']
+    bdlon, bdlat = big['grid']
+    dlon, dlat = small['grid']
+    if not _on_grid(dlon, 0, bdlon) or not _on_grid(dlat, 0, bdlat):
+        return False
+    if north > bnorth or south < bsouth:
+        return False
+    if not _on_grid(north, bnorth, bdlat):
+        return False
+    if not _on_grid(west, bwest, bdlon):
+        return False
+    # global files contain any range of longitudes.
+    if beast - bwest + bdlon >= 360:
+        return True
+    return west >= bwest and east <= beast
+
+
+def link_or_copy(src, dst):
+    if os.path.isfile(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class GribCache:
+
+    def __init__(self, cachedir, maxsize=500e9):
+        """cachedir : directory for the cache.
+           maxsize : maximum size of the cache in bytes.
+        """
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.objdir = os.path.join(cachedir, 'objects')
+        if not os.path.isdir(self.objdir):
+            os.makedirs(self.objdir)
+        self.indexname = os.path.join(cachedir, 'index.json')
+        self.lockname = os.path.join(cachedir, 'lock')
+
+    def objname(self, key):
+        return os.path.join(self.objdir, key[0:2], key + '.grib')
+
+    def _locked(self, func, *args):
+        # the index is read and written while holding the lock so that
+        # several processes (or users) can share the cache.
+        with open(self.lockname, 'a') as lockfid:
+            fcntl.flock(lockfid, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                result = func(index, *args)
+                return result
+            finally:
+                fcntl.flock(lockfid, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not os.path.isfile(self.indexname):
+            return {}
+        try:
+            with open(self.indexname, 'r') as fid:
+                return json.load(fid)
+        except ValueError:
+            print('Warning: could not read cache index {}'.format(self.indexname))
+            return {}
+
+    def _write_index(self, index):
+        tmpname = self.indexname + '.tmp'
+        with open(tmpname, 'w') as fid:
+            json.dump(index, fid, indent=1, sort_keys=True)
+        os.replace(tmpname, self.indexname)
+
+    def fetch(self, rtv, target):
+        """if the request for the retrieval is in the cache, link it to target
+           and return True. Otherwise return False.
+        """
+        key = request_key(rtv['name'], rtv['request'])
+        return self._locked(self._fetch, key, target)
+
+    def _fetch(self, index, key, target):
+        entry = index.get(key)
+        objname = self.objname(key)
+        if not entry:
+            return False
+        if not os.path.isfile(objname) or os.path.getsize(objname) != entry['size']:
+            index.pop(key)
+            self._write_index(index)
+            return False
+        link_or_copy(objname, target)
+        entry['atime'] = time.time()
+        self._write_index(index)
+        return True
+
+    def fetch_superset(self, rtv, target):
+        """if the cache has a file which covers a larger area than the request
+           and is otherwise the same, link it to target and return True.
+           The area in target must then be cut out with gribtools.crop_file.
+        """
+        return self._locked(self._fetch_superset, rtv, target)
+
+    def _fetch_superset(self, index, rtv, target):
+        norm = normalize_request(rtv['name'], rtv['request'])
+        if 'area' not in norm or 'grid' not in norm:
+            return False
+        # prefer the smallest file.
+        for key in sorted(index.keys(), key=lambda x: index[x]['size']):
+            entry = index[key]
+            if not contains(entry['request'], norm):
+                continue
+            objname = self.objname(key)
+            if not os.path.isfile(objname) or os.path.getsize(objname) != entry['size']:
+                continue
+            link_or_copy(objname, target)
+            entry['atime'] = time.time()
+            self._write_index(index)
+            return True
+        return False
+
+    def store(self, rtv, fname):
+        """adds the file retrieved for rtv to the cache.
+        """
+        key = request_key(rtv['name'], rtv['request'])
+        return self._locked(self._store, key, rtv, fname)
+
+    def _store(self, index, key, rtv, fname):
+        objname = self.objname(key)
+        if not os.path.isdir(os.path.dirname(objname)):
+            os.makedirs(os.path.dirname(objname))
+        link_or_copy(fname, objname + '.tmp')
+        os.replace(objname + '.tmp', objname)
+        index[key] = {'name': rtv['name'],
+                      'request': normalize_request(rtv['name'], rtv['request']),
+                      'size': os.path.getsize(objname),
+                      'atime': time.time()}
+        self._evict(index)
+        self._write_index(index)
+
+    def _evict(self, index):
+        """removes least recently used files until the cache is smaller than maxsize.
+        """
+        total = sum(x['size'] for x in index.values())
+        for key in sorted(index.keys(), key=lambda x: index[x]['atime']):
+            if total <= self.maxsize:
+                break
+            print('Removing from cache ' + key)
+            objname = self.objname(key)
+            if os.path.isfile(objname):
+                os.remove(objname)
+            total -= index[key]['size']
+            index.pop(key)
@@ -0,0 +1,285 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+from optparse import OptionParser
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import arlreader
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+"""
+MAIN PROGRAM: converts the grib files retrieved by get_era5_cds.py to ARL format.
+
+PYTHON 3.x
+
+ABSTRACT: runs era52arl for each time period (T1, T2 ...) in its own scratch
+directory so that the conversions can run at the same time. era52arl always
+writes DATA.ARL and ERA52ARL.MESSAGE in the working directory which is why
+the shell script written by get_era5_cds.py -g has to run them one after another.
+When all the time periods of a day are converted they are concatenated in time
+order into the daily file e.g. ERA5_20170101.ARL.
+If --exe is a python file (era5arl.py, which is needed for the model levels)
+it is run with the python interpreter. Jobs which era52arl can not convert
+(model levels and tres) are always run with era5arl.py.
+
+get_era5_cds.py -g writes a job file (e.g. 2017Jan_ecm2arl.json) next to the shell script.
+Each job is a dictionary with the keys
+    files : list of the 3d, 2d and (optional) 2d forecast grib files.
+    tstr  : time period e.g. T1.
+    arl   : name of the daily ARL file.
+    tres  : (optional) hours between the times when the accumulations are added up.
+    levtype : (optional) ml for the model levels.
+    cfg   : (optional) decoding configuration file written for the files.
+
+example:
+python era5convert.py -j 2017Jan_ecm2arl.json --exe $HOME/hysplit/exec/era52arl --nproc 8
+
+for command line options run with --help
+"""
+
+
+def read_jobs(jobfile):
+    with open(jobfile, 'r') as fid:
+        return json.load(fid)
+
+
+def add_jobs(jobfile, jobs):
+    """adds jobs to the job file. Jobs which are already in it are replaced.
+    """
+    old = []
+    if os.path.isfile(jobfile):
+        old = read_jobs(jobfile)
+    newkeys = set((x['arl'], x['tstr']) for x in jobs)
+    old = [x for x in old if (x['arl'], x['tstr']) not in newkeys]
+    with open(jobfile + '.tmp', 'w') as fid:
+        json.dump(old + jobs, fid, indent=1)
+    os.replace(jobfile + '.tmp', jobfile)
+
+
+def tnum(tstr):
+    """returns number of the time period for sorting. T10 comes after T9.
+    """
+    try:
+        return int(tstr.lstrip('T'))
+    except ValueError:
+        return 0
+
+
+def default_exe():
+    """returns $MDL/era52arl if MDL is set otherwise era52arl.
+    """
+    if 'MDL' in os.environ:
+        return os.path.join(os.environ['MDL'], 'era52arl')
+    return 'era52arl'
+
+
+def python_exe():
+    """returns era5arl.py in the same directory as this module. Used for the
+       model levels which era52arl can not convert.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'era5arl.py')
+
+
+def job_exe(job, exe):
+    """returns the program which converts the job. era52arl can not convert
+       the model levels or add up the hourly accumulations for tres so those
+       jobs are run with era5arl.py.
+    """
+    if exe.endswith('.py'):
+        return exe
+    if job.get('levtype') == 'ml' or job.get('tres', 1) > 1:
+        return python_exe()
+    return exe
+
+
+def run_era52arl(job, exe, cfgname, outdir, workdir=None, stream=False):
+    """runs era52arl for one job in a scratch directory.
+       Returns name of the ARL file for the time period.
+       Raises RuntimeError if era52arl fails or does not write DATA.ARL.
+       cfgname : decoding configuration file. If None the cfg of the job is used
+                 or era52arl.cfg.
+       stream : if True use the streaming mode of era52arl (-s) which only
+                keeps one time period in memory.
+    """
+    exe = job_exe(job, exe)
+    cfgname = cfgname or job.get('cfg', 'era52arl.cfg')
+    scratch = tempfile.mkdtemp(prefix='era52arl.', dir=workdir)
+    try:
+        cmd = [exe]
+        # era5arl.py takes the same options as era52arl.
+        if exe.endswith('.py'):
+            cmd = [sys.executable, exe]
+        cmd.append('-i' + os.path.abspath(job['files'][0]))
+        cmd.append('-a' + os.path.abspath(job['files'][1]))
+        for fname in job['files'][2:]:
+            cmd.append('-f' + os.path.abspath(fname))
+        # era5arl.py adds up the hourly accumulations.
+        if job.get('tres', 1) > 1:
+            cmd.extend(['--tres', str(job['tres'])])
+        if cfgname and os.path.isfile(cfgname):
+            cmd.append('-d' + os.path.abspath(cfgname))
+        # era5arl.py always reads one time period at a time.
+        if stream and not exe.endswith('.py'):
+            cmd.append('-s')
+        result = subprocess.run(cmd, cwd=scratch, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        # keep the message file as the shell script does.
+        message = os.path.join(scratch, 'ERA52ARL.MESSAGE')
+        if os.path.isfile(message):
+            shutil.move(message, os.path.join(outdir, 'MESSAGE.' + job['arl'] + '.' + job['tstr']))
+        dataname = os.path.join(scratch, 'DATA.ARL')
+        if result.returncode != 0 or not os.path.isfile(dataname):
+            raise RuntimeError('{} failed for {} : {}'.format(' '.join(cmd), job['tstr'],
+                               result.stdout.decode(errors='replace')[-1000:]))
+        tempname = os.path.join(outdir, job['arl'] + '.' + job['tstr'])
+        shutil.move(dataname, tempname)
+        return tempname
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def concatenate(arlname, partnames, keep=False):
+    """writes the time period files into the daily file in time order.
+       keep : if False the time period files are removed.
+    """
+    with open(arlname + '.part', 'wb') as outfid:
+        for fname in partnames:
+            with open(fname, 'rb') as fid:
+                shutil.copyfileobj(fid, outfid, 2**24)
+    os.replace(arlname + '.part', arlname)
+    if not keep:
+        for fname in partnames:
+            os.remove(fname)
+
+
+def append_arl(target, fnames):
+    """appends the ARL files to the end of target in the order given.
+       The grid and the records of each time period must be the same as in target
+       and the times must be after the last time in target.
+       An incomplete time period at the end of target (from a write which did not
+       finish) is removed first.
+    """
+    times = arlreader.read_times(target)
+    with open(target, 'rb') as fid:
+        first = arlreader.read_index(fid, 0)
+    step = first['nrec'] * first['reclen']
+    lasttime = times[-1][0]
+    for fname in fnames:
+        with open(fname, 'rb') as fid:
+            index = arlreader.read_index(fid, 0)
+        for key in ['nx', 'ny', 'nrec', 'levels', 'grids']:
+            if index[key] != first[key]:
+                raise ValueError('{} does not match {} ({})'.format(fname, target, key))
+        if index['date'] <= lasttime:
+            raise ValueError('{} starts at {} which is not after {} in {}'.format(
+                             fname, index['date'], lasttime, target))
+        lasttime = arlreader.last_time(fname)
+    with open(target, 'r+b') as outfid:
+        outfid.truncate(len(times) * step)
+        outfid.seek(0, 2)
+        for fname in fnames:
+            with open(fname, 'rb') as fid:
+                shutil.copyfileobj(fid, outfid, 2**24)
+
+
+def catchup_jobs(jobs, target, exe='era52arl', cfgname=None, nproc=None,
+                 stream=False):
+    """converts the jobs in a scratch directory and appends the daily files to target.
+       Nothing is appended if any of the conversions fail.
+       Returns list of the jobs which failed.
+    """
+    scratch = tempfile.mkdtemp(prefix='catchup.', dir=os.path.dirname(os.path.abspath(target)))
+    try:
+        failed = convert_jobs(jobs, exe=exe, cfgname=cfgname, outdir=scratch, nproc=nproc,
+                              stream=stream)
+        if failed:
+            return failed
+        # daily files in the order of the jobs.
+        arlnames = []
+        for job in jobs:
+            if job['arl'] not in arlnames:
+                arlnames.append(job['arl'])
+        append_arl(target, [os.path.join(scratch, x) for x in arlnames])
+        print('Appended {} days to {}. Last time {}'.format(len(arlnames), target,
+              arlreader.last_time(target)))
+        return failed
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def convert_jobs(jobs, exe='era52arl', cfgname=None, outdir='./',
+                 nproc=None, workdir=None, keep=False, stream=False):
+    """runs all the jobs with a pool of processes and creates the daily files
+       when all the time periods of a day are done.
+       nproc : number of conversions at the same time. Default is number of cores.
+       keep : if True keep the files for each time period.
+       stream : if True run era52arl in streaming mode.
+       Returns list of the jobs which failed.
+    """
+    if not nproc:
+        nproc = os.cpu_count()
+    days = {}
+    for job in jobs:
+        days.setdefault(job['arl'], []).append(job)
+    done = {}
+    failed = []
+    print('Converting {} time periods for {} days. {} at a time'.format(len(jobs), len(days), nproc))
+    npython = len([x for x in jobs if job_exe(x, exe) != exe])
+    if npython:
+        print('{} time periods are converted with {}'.format(npython, python_exe()))
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        futures = {}
+        for job in jobs:
+            futures[pool.submit(run_era52arl, job, exe, cfgname, outdir, workdir, stream)] = job
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                done[(job['arl'], job['tstr'])] = future.result()
+                print('Converted {} {}'.format(job['arl'], job['tstr']))
+            except Exception as err:
+                print('Conversion failed {} {} : {}'.format(job['arl'], job['tstr'], err))
+                failed.append(job)
+                continue
+            # write the daily file as soon as all its time periods are done.
+            arl = job['arl']
+            daylist = sorted(days[arl], key=lambda x: tnum(x['tstr']))
+            if all((arl, x['tstr']) in done for x in daylist):
+                partnames = [done[(arl, x['tstr'])] for x in daylist]
+                concatenate(os.path.join(outdir, arl), partnames, keep=keep)
+                print('Wrote ' + os.path.join(outdir, arl))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-j", type="string", dest="jobfile", default='',
+                      help="job file written by get_era5_cds.py -g")
+    parser.add_option("--exe", type="string", dest="exe", default='',
+                      help="era52arl executable. Default is $MDL/era52arl if MDL is set \
+                            otherwise era52arl.")
+    parser.add_option("--cfg", type="string", dest="cfg", default='',
+                      help="configuration file for era52arl (-d option). Default is the \
+                            cfg in the job file or era52arl.cfg.")
+    parser.add_option("--outdir", type="string", dest="outdir", default='./',
+                      help="{./} directory to write the ARL files to.")
+    parser.add_option("--nproc", type="int", dest="nproc", default=0,
+                      help="number of conversions to run at once. Default is number of cores.")
+    parser.add_option("--keep", action="store_true", dest="keep", default=False,
+                      help="keep the ARL file for each time period as well as the daily file.")
+    parser.add_option("--stream", action="store_true", dest="stream", default=False,
+                      help="run era52arl in streaming mode (-s) so that only one time period \
+                            is in memory. Use for files which are not split (--split 1).")
+    (options, args) = parser.parse_args()
+    if not options.jobfile:
+        print('A job file must be given with -j')
+        sys.exit()
+    exe = options.exe
+    if not exe:
+        exe = default_exe()
+    jobs = read_jobs(options.jobfile)
+    failed = convert_jobs(jobs, exe=exe, cfgname=options.cfg or None, outdir=options.outdir,
+                          nproc=options.nproc, keep=options.keep, stream=options.stream)
+    for job in failed:
+        print('FAILED {} {}'.format(job['arl'], job['tstr']))
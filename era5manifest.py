@@ -0,0 +1,85 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import json
+import datetime
+import threading
+import gribtools
+
+"""
+MODULE: ledger of the grib files which have been retrieved.
+
+PYTHON 3.x
+
+ABSTRACT: The manifest is a json file kept in the output directory.
+For each retrieved file it records the request, the size of the file in bytes
+and the number of grib messages. When get_era5_cds.py is run again the
+retrievals which are already complete are skipped. A file is complete if
+it is in the manifest with the same request and the size and number of
+messages on disk still match.
+"""
+
+
+class Manifest:
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'r') as fid:
+                    self.entries = json.load(fid)
+            except ValueError:
+                print('Warning: could not read manifest {}. Starting new one.'.format(fname))
+                self.entries = {}
+
+    def key(self, target):
+        return os.path.abspath(target)
+
+    def is_complete(self, rtv):
+        """returns True if the target of the retrieval is already on disk and valid.
+        """
+        entry = self.entries.get(self.key(rtv['target']))
+        if not entry:
+            return False
+        if entry['name'] != rtv['name'] or entry['request'] != normalize(rtv['request']):
+            return False
+        if not os.path.isfile(rtv['target']):
+            return False
+        if os.path.getsize(rtv['target']) != entry['bytes']:
+            return False
+        try:
+            nmsg = gribtools.count_messages(rtv['target'])
+        except IOError as err:
+            print(err)
+            return False
+        return nmsg == entry['messages']
+
+    def record(self, rtv, nbytes, nmsg):
+        entry = {'name': rtv['name'],
+                 'request': normalize(rtv['request']),
+                 'target': rtv['target'],
+                 'bytes': nbytes,
+                 'messages': nmsg,
+                 'date': datetime.datetime.now().isoformat(timespec='seconds')}
+        with self.lock:
+            self.entries[self.key(rtv['target'])] = entry
+            self.save()
+
+    def remove(self, target):
+        with self.lock:
+            self.entries.pop(self.key(target), None)
+            self.save()
+
+    def save(self):
+        # write to temporary file and rename so the manifest is never half written.
+        tmpname = self.fname + '.tmp'
+        with open(tmpname, 'w') as fid:
+            json.dump(self.entries, fid, indent=1, sort_keys=True)
+        os.replace(tmpname, self.fname)
+
+
+def normalize(request):
+    """returns copy of the request which compares equal after a json round trip.
+    """
+    return json.loads(json.dumps(request, sort_keys=True))
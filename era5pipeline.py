@@ -0,0 +1,239 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import gzip
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import era5retrieve
+import era5convert
+
+"""
+MODULE: retrieves and converts the data one day at a time.
+
+PYTHON 3.x
+
+ABSTRACT: get_era5_cds.py --pipeline. Instead of retrieving all the days and
+converting afterwards, each time period is converted with era52arl (see era5convert.py)
+as soon as its 3d and 2d files have been retrieved and checked. When all the
+time periods of a day are converted the daily ARL file is written and the
+grib files for the day can be removed or compressed.
+
+Only maxdays days are retrieved or converted at the same time. The retrievals
+for the next day are sent when a day is finished, so the grib files of at most
+maxdays days are on disk at once.
+
+Retrievals which cover several days (--coalesce) are sent at the start and are
+not counted in maxdays since the days can not be converted without them.
+Days which already have a daily ARL file in outdir are not retrieved again.
+A day which needs a file that is not retrieved and is not on disk is not converted.
+"""
+
+
+def compress(fname):
+    """replaces fname with fname.gz
+    """
+    with open(fname, 'rb') as fid:
+        with gzip.open(fname + '.gz', 'wb') as gid:
+            shutil.copyfileobj(fid, gid, 2**24)
+    os.remove(fname)
+
+
+def retrieval_files(rtv):
+    """returns list of the files written by a retrieval.
+    """
+    files = [rtv['target']]
+    if rtv.get('split'):
+        files.extend(sorted(set(rtv['split'].values())))
+    return files
+
+
+class Pipeline:
+
+    def __init__(self, jobs, exe='era52arl', cfgname='new_era52arl.cfg', outdir='./',
+                 maxdays=2, nproc=None, cleanup='keep'):
+        """jobs : list of conversions. See era5convert.py.
+           maxdays : number of days which are retrieved or converted at once.
+           nproc : number of conversions at once. Default is number of cores.
+           cleanup : keep, delete or gzip. What is done with the grib files of
+                     a day after the daily ARL file is written.
+        """
+        self.exe = exe
+        self.cfgname = cfgname
+        self.outdir = outdir
+        self.maxdays = max(1, int(maxdays))
+        self.nproc = nproc or os.cpu_count()
+        self.cleanup = cleanup
+        # jobs for each day in the order of the days.
+        self.days = {}
+        self.daylist = []
+        for job in jobs:
+            if job['arl'] not in self.days:
+                self.daylist.append(job['arl'])
+            self.days.setdefault(job['arl'], []).append(job)
+        # days which use each grib file.
+        self.filedays = {}
+        for job in jobs:
+            for fname in job['files']:
+                self.filedays.setdefault(fname, set()).add(job['arl'])
+        self.ready = set()
+        self.active = set()
+        self.started = set()
+        self.converted = {}
+        self.failed = []
+
+    def rtv_days(self, rtv):
+        days = set()
+        for fname in retrieval_files(rtv):
+            days |= self.filedays.get(fname, set())
+        return days
+
+    def arlpath(self, day):
+        return os.path.join(self.outdir, day)
+
+    def is_done(self, day):
+        return os.path.isfile(self.arlpath(day))
+
+    def run(self, server, retrievals, maxworkers=4, manifest=None, cache=None, retry=None,
+            timing=None):
+        """retrieves and converts. Returns list of the retrievals which failed.
+           The arguments are the same as for era5retrieve.retrieve_all.
+        """
+        failed = []
+        for day in self.daylist:
+            if self.is_done(day):
+                print('Already converted. Skipping {}'.format(day))
+                self.started.add(day)
+        # nothing to do for the days which are already converted.
+        retrievals = [x for x in retrievals
+                      if not self.rtv_days(x) or self.rtv_days(x) - self.started]
+        if manifest:
+            retrievals, complete = era5retrieve.skip_complete(retrievals, manifest)
+            for rtv in complete:
+                self.ready.update(retrieval_files(rtv))
+        # retrievals for one day wait until the day is started.
+        waiting = [x for x in retrievals if len(self.rtv_days(x)) == 1]
+        first = [x for x in retrievals if len(self.rtv_days(x)) != 1]
+        print('Pipeline for {} days. {} days at a time'.format(len(self.daylist), self.maxdays))
+        with ThreadPoolExecutor(max_workers=max(1, int(maxworkers))) as rpool, \
+             ThreadPoolExecutor(max_workers=self.nproc) as cpool:
+            futures = {}
+
+            def submit_retrieval(rtv):
+                future = rpool.submit(era5retrieve.retrieve_one, server, rtv, manifest, cache,
+                                      retry, timing, time.time())
+                futures[future] = ('retrieve', rtv)
+
+            def start_days():
+                for day in self.daylist:
+                    if len(self.active) >= self.maxdays:
+                        break
+                    if day in self.started:
+                        continue
+                    self.started.add(day)
+                    self.active.add(day)
+                    for rtv in [x for x in waiting if self.rtv_days(x) == set([day])]:
+                        submit_retrieval(rtv)
+                    if not check_files(day):
+                        continue
+                    start_jobs(day)
+
+            def check_files(day):
+                # a day whose files are not retrieved would keep its place for ever.
+                pending = set()
+                for kind, item in futures.values():
+                    if kind == 'retrieve':
+                        pending.update(retrieval_files(item))
+                for job in self.days[day]:
+                    for fname in job['files']:
+                        if fname in self.ready or fname in pending:
+                            continue
+                        if os.path.isfile(fname):
+                            self.ready.add(fname)
+                            continue
+                        print('No retrieval for {}. Can not convert {}'.format(fname, day))
+                        stop_day(day)
+                        return False
+                return True
+
+            def start_jobs(day):
+                if day not in self.active:
+                    return
+                for job in self.days[day]:
+                    key = (day, job['tstr'])
+                    if key in self.converted:
+                        continue
+                    if all(x in self.ready for x in job['files']):
+                        self.converted[key] = None
+                        future = cpool.submit(era5convert.run_era52arl, job, self.exe,
+                                              self.cfgname, self.outdir)
+                        futures[future] = ('convert', job)
+
+            def stop_day(day):
+                self.active.discard(day)
+                self.failed.append(day)
+
+            for rtv in first:
+                submit_retrieval(rtv)
+            start_days()
+            while futures:
+                done, notdone = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, item = futures.pop(future)
+                    if kind == 'retrieve':
+                        try:
+                            future.result()
+                            print('Finished retrieving ' + item['target'])
+                            self.ready.update(retrieval_files(item))
+                            for day in self.rtv_days(item):
+                                start_jobs(day)
+                        except Exception as err:
+                            print('Retrieval failed {} : {}'.format(item['target'], err))
+                            failed.append(item)
+                            # the days which need it can not be converted.
+                            for day in self.rtv_days(item):
+                                if day not in self.failed and not self.is_done(day):
+                                    self.started.add(day)
+                                    stop_day(day)
+                    else:
+                        day = item['arl']
+                        try:
+                            self.converted[(day, item['tstr'])] = future.result()
+                            print('Converted {} {}'.format(day, item['tstr']))
+                        except Exception as err:
+                            print('Conversion failed {} {} : {}'.format(day, item['tstr'], err))
+                            if day in self.active:
+                                stop_day(day)
+                            continue
+                        if day in self.active:
+                            self.finish_day(day)
+                start_days()
+        for day in self.failed:
+            print('Day not converted {}'.format(day))
+        return failed
+
+    def finish_day(self, day):
+        """writes the daily file if all its time periods are converted and
+           then removes or compresses the grib files.
+        """
+        jobs = sorted(self.days[day], key=lambda x: era5convert.tnum(x['tstr']))
+        if not all(self.converted.get((day, x['tstr'])) for x in jobs):
+            return
+        partnames = [self.converted[(day, x['tstr'])] for x in jobs]
+        era5convert.concatenate(self.arlpath(day), partnames)
+        print('Wrote ' + self.arlpath(day))
+        self.active.discard(day)
+        if self.cleanup not in ['delete', 'gzip']:
+            return
+        for job in jobs:
+            for fname in job['files']:
+                # files which are used by a day which is not finished are kept.
+                if any(x not in self.started or x in self.active for x in self.filedays[fname]):
+                    continue
+                if not os.path.isfile(fname):
+                    continue
+                if self.cleanup == 'delete':
+                    print('Removing ' + fname)
+                    os.remove(fname)
+                else:
+                    print('Compressing ' + fname)
+                    compress(fname)
@@ -0,0 +1,88 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import era5utils
+
+"""
+MODULE: estimates the size of a run before anything is sent to the CDS.
+
+PYTHON 3.x
+
+ABSTRACT: get_era5_cds.py --plan builds the same retrievals as a normal run
+and then prints, instead of retrieving them,
+    the number of requests for each dataset.
+    the number of fields in each request compared with --maxfields and --maxsize.
+    the size of the grib files (estimated as in era5utils.estimate_bytes).
+    the size of the ARL files written by era52arl.
+    the disk space needed at the peak of the run.
+Use it with --end or --months to size a whole backfill before it is queued.
+"""
+
+
+def arl_records(param3d, param2d, nlevs, udif=True):
+    """returns number of records for one time period in the ARL file
+       including the index record. DIFW and DIFR are added as in era52arl.
+    """
+    # LNSP is only used to compute the pressure of the model levels.
+    n3d = len([x for x in param3d if x != 'LNSP'])
+    if udif and 'WWND' in param3d:
+        n3d += 1
+    nsfc = len(set(param2d))
+    if udif and any(x.startswith('TPP') for x in param2d):
+        nsfc += 1
+    return 1 + nsfc + nlevs * n3d
+
+
+def arl_bytes(nrec, nx, ny, ntimes):
+    """returns size of an ARL file with ntimes time periods.
+    """
+    return ntimes * nrec * (50 + nx * ny)
+
+
+def gb(nbytes):
+    return '{:.2f}'.format(nbytes / 1e9)
+
+
+def plan(retrievals, ndays, arlbytes, maxfields, maxbytes, pipeline=False, maxdays=2):
+    """returns list of lines describing the run.
+       retrievals : list of retrievals (see era5retrieve.py) with expect set.
+       ndays : number of days in the run.
+       arlbytes : size of the ARL files for one day (all ensemble members).
+       maxfields, maxbytes : limits for one request.
+       pipeline, maxdays : the grib files of only maxdays days are on disk at once.
+    """
+    datasets = {}
+    for rtv in retrievals:
+        datasets.setdefault(rtv['name'], []).append(rtv)
+    lines = []
+    fmt = '{:40s} {:>8s} {:>10s} {:>10s} {:>10s} {:>8s} {:>8s}'
+    lines.append(fmt.format('dataset', 'requests', 'min fields', 'max fields',
+                            'max MB', 'GB', 'too big'))
+    gribtotal = 0
+    # split retrievals keep the combined file as well as the daily files.
+    splitbytes = 0
+    for name in sorted(datasets.keys()):
+        rlist = datasets[name]
+        nfields = []
+        nbytes = []
+        for rtv in rlist:
+            expect = rtv.get('expect', {})
+            nfields.append(expect.get('messages', 0))
+            nbytes.append(era5utils.estimate_bytes(nfields[-1], expect.get('nx', 0),
+                                                   expect.get('ny', 0)))
+            if rtv.get('split'):
+                splitbytes += nbytes[-1]
+        toobig = len([x for x, y in zip(nfields, nbytes) if x > maxfields or y > maxbytes])
+        gribtotal += sum(nbytes)
+        lines.append(fmt.format(name, str(len(rlist)), str(min(nfields)), str(max(nfields)),
+                                '{:.0f}'.format(max(nbytes) / 1e6), gb(sum(nbytes)), str(toobig)))
+    lines.append('limits for one request: {} fields and {:.0f} MB'.format(maxfields, maxbytes / 1e6))
+    lines.append('{} requests for {} days'.format(len(retrievals), ndays))
+    lines.append('grib files  {:>10s} GB'.format(gb(gribtotal + splitbytes)))
+    lines.append('ARL files   {:>10s} GB ({} GB per day)'.format(gb(arlbytes * ndays), gb(arlbytes)))
+    peak = gribtotal + splitbytes + arlbytes * ndays
+    lines.append('disk peak   {:>10s} GB keeping the grib files'.format(gb(peak)))
+    if pipeline:
+        # grib files of maxdays days. The files retrieved for several days are kept.
+        perday = (gribtotal - splitbytes) / max(1, ndays)
+        peak = min(maxdays, ndays) * perday + 2 * splitbytes + arlbytes * ndays
+        lines.append('disk peak   {:>10s} GB with --pipeline --cleanup delete'.format(gb(peak)))
+    return lines
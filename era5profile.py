@@ -0,0 +1,125 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import era5utils
+
+"""
+MODULE: reads request profiles for get_era5_cds.py
+
+PYTHON 3.x
+
+ABSTRACT: a profile says which HYSPLIT variables, levels and times a job needs so
+that the retrievals (and the era52arl.cfg written for them) can be trimmed without
+editing get_era5_cds.py, e.g. no stratospheric levels or no CAPE.
+
+Profiles are written in TOML (read with tomllib which is in python 3.11 and later)
+or YAML (needs pyyaml which is only imported for .yaml or .yml files).
+Each table in the file is a profile. A file with only one profile may also have
+the keys at the top level. See era5_profiles.toml for examples.
+
+    [troposphere]
+    levtype = 'pl'                  # pl or ml. optional.
+    atm = ['TEMP', 'UWND', 'VWND', 'WWND', 'RELH', 'HGTS']
+    sfc = ['T02M', 'V10M', 'U10M', 'PRSS', 'PBLH', 'SHGT', 'MSLP']
+    sfcf = ['TPP1', 'SHTF', 'DSWF', 'LTHF']
+    toplevel = 100                  # or levels = [1000, 975, ...]
+    tres = 1                        # hours between the times retrieved. 1, 3 or 6.
+
+get_era5_cds.py --profile era5_profiles.toml:troposphere
+The name may be left out if the file has only one profile.
+
+The profile is checked and compiled once into the lists of variables and levels
+used for era52arl.cfg and for the request templates (get_era5_cds.request_templates)
+which are copied for each day.
+"""
+
+# keys which a profile may have.
+KEYS = ['description', 'levtype', 'atm', 'sfc', 'sfcf', 'levels', 'toplevel', 'tres']
+
+
+def read_profiles(fname):
+    """returns dictionary. key is name of profile and value is dictionary.
+    """
+    if fname.endswith('.yaml') or fname.endswith('.yml'):
+        import yaml
+        with open(fname, 'r') as fid:
+            data = yaml.safe_load(fid)
+    else:
+        import tomllib
+        with open(fname, 'rb') as fid:
+            data = tomllib.load(fid)
+    if not isinstance(data, dict):
+        raise ValueError('{} : no profiles found'.format(fname))
+    # one profile with the keys at the top level.
+    if 'atm' in data or 'sfc' in data:
+        name = os.path.splitext(os.path.basename(fname))[0]
+        return {name: data}
+    return data
+
+
+def get_profile(spec):
+    """returns (name, profile). spec is FILE:NAME or FILE.
+    """
+    fname, name = spec, None
+    if not os.path.isfile(spec) and ':' in spec:
+        fname, name = spec.rsplit(':', 1)
+    profiles = read_profiles(fname)
+    if name is None:
+        if len(profiles) != 1:
+            raise ValueError('{} has several profiles. Use {}:NAME with NAME one of {}'.format(
+                             fname, fname, ', '.join(sorted(profiles.keys()))))
+        name = list(profiles.keys())[0]
+    if name not in profiles:
+        raise ValueError('profile {} not in {}. Profiles are {}'.format(
+                         name, fname, ', '.join(sorted(profiles.keys()))))
+    return name, profiles[name]
+
+
+def compile_profile(profile, levtype='pl', means=False):
+    """checks the profile and returns dictionary with
+       levtype : pl or ml.
+       param3d, param2da, param2df : lists of HYSPLIT names. None if not in the profile.
+       levs : levels from the bottom up. None if not in the profile.
+       tres : hours between the times retrieved.
+       Raises ValueError if the profile has names or levels which are not known.
+    """
+    unknown = [x for x in profile.keys() if x not in KEYS]
+    if unknown:
+        raise ValueError('unknown keys in profile: {}'.format(' '.join(unknown)))
+    levtype = profile.get('levtype', levtype)
+    if levtype not in ['pl', 'ml']:
+        raise ValueError('levtype in profile must be pl or ml not {}'.format(levtype))
+    sname = era5utils.getvars(means=means)
+    compiled = {'levtype': levtype}
+    for key, pname in [('atm', 'param3d'), ('sfc', 'param2da'), ('sfcf', 'param2df')]:
+        names = profile.get(key)
+        if names is not None:
+            names = [str(x).upper() for x in names]
+            bad = [x for x in names if x not in sname]
+            if bad:
+                raise ValueError('no ERA5 code for {} in {}'.format(' '.join(bad), key))
+        compiled[pname] = names
+    if levtype == 'pl':
+        allowed = era5utils.pressure_levels()
+    else:
+        allowed = list(range(1, 138))
+    levs = profile.get('levels')
+    if levs is not None:
+        levs = [int(x) for x in levs]
+        bad = [x for x in levs if x not in allowed]
+        if bad:
+            raise ValueError('{} levels not available: {}'.format(levtype, ' '.join(map(str, bad))))
+    elif 'toplevel' in profile:
+        if levtype == 'pl':
+            levs = era5utils.pressure_levels(int(profile['toplevel']))
+        else:
+            levs = [x for x in era5utils.model_levels_default() if x >= int(profile['toplevel'])]
+    if levs is not None:
+        # from the bottom up. Pressure and model level numbers both decrease upwards.
+        levs = sorted(set(levs), reverse=True)
+        if not levs:
+            raise ValueError('no levels in profile')
+    compiled['levs'] = levs
+    compiled['tres'] = int(profile.get('tres', 1))
+    if compiled['tres'] not in [1, 3, 6]:
+        raise ValueError('tres must be 1, 3 or 6 hours not {}'.format(compiled['tres']))
+    return compiled
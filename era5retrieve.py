@@ -0,0 +1,354 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import glob
+import time
+import random
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import gribtools
+
+"""
+MODULE: schedules retrievals from the CDS (Copernicus Data Service) API.
+
+PYTHON 3.x
+
+ABSTRACT: get_era5_cds.py builds a list of retrievals instead of calling
+server.retrieve for each one in turn. The retrievals are then submitted
+together so that the time spent waiting in the CDS queue overlaps.
+
+A retrieval is a dictionary with the keys
+    name    : name of the CDS dataset e.g. reanalysis-era5-pressure-levels
+    request : dictionary which is passed to server.retrieve
+    target  : name of the output file.
+
+Files are downloaded to a temporary file, target.part, and only renamed to
+the target when the download is finished and the grib messages are complete.
+If a manifest (see era5manifest.py) is given, retrievals which are already
+complete are skipped and finished retrievals are recorded in it.
+If a cache (see era5cache.py) is given, it is checked before the request is
+sent to the CDS and downloaded files are added to it. If the cache has a file
+for a larger area with the same dates, variables and levels, the requested area
+is cut out of it instead.
+
+A retrieval may also have the key
+    split   : dictionary. key is validity time YYYYMMDDHH and value is a file name.
+              Used when several days are retrieved in one request. After the
+              download the messages are written to the file for their validity time.
+
+    expect  : dictionary with the number of messages and the grid size (nx, ny)
+              expected in the file. Each file is checked as soon as it is downloaded
+              and is retrieved again if it does not match. pertime is the number
+              of messages for each time in split.
+
+Failed or incomplete downloads are retried with exponential backoff (see Retry).
+"""
+
+
+class Retry:
+
+    def __init__(self, attempts=5, backoff=60, maxbackoff=3600, timeout=0, logname=None):
+        """attempts : maximum number of times a request is sent.
+           backoff : wait in seconds before the second attempt. The wait is
+                     doubled for each attempt after that up to maxbackoff.
+                     A random jitter is applied so that requests which failed together
+                     are not all sent again at the same time.
+           timeout : maximum time in seconds for one attempt. 0 for no limit.
+           logname : every attempt is appended to this file.
+        """
+        self.attempts = max(1, int(attempts))
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.timeout = timeout
+        self.logname = logname
+        self.lock = threading.Lock()
+
+    def delay(self, attempt):
+        """returns time to wait in seconds after attempt failed.
+        """
+        wait = min(self.maxbackoff, self.backoff * 2**(attempt - 1))
+        return random.uniform(0.5, 1.0) * wait
+
+    def log(self, rtv, attempt, message):
+        text = '{} {} attempt {}/{} {}'.format(datetime.datetime.now().isoformat(timespec='seconds'),
+                                              rtv['target'], attempt, self.attempts, message)
+        with self.lock:
+            print(text)
+            if self.logname:
+                with open(self.logname, 'a') as mid:
+                    mid.write(text + '\n')
+
+    def call(self, func, *args):
+        """calls func(*args). If timeout is set, the call is made in another
+           thread and TimeoutError is raised if it has not returned in time.
+           The thread is left running since the cdsapi call can not be interrupted.
+        """
+        if not self.timeout:
+            return func(*args)
+        result = {}
+
+        def run():
+            try:
+                result['value'] = func(*args)
+            except Exception as err:
+                result['error'] = err
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            raise TimeoutError('no result after {:.0f} s'.format(self.timeout))
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+
+def make_retrieval(name, request, target, split=None, expect=None):
+    """returns dictionary describing one call to server.retrieve
+    """
+    rtv = {'name': name, 'request': request, 'target': target}
+    if split:
+        rtv['split'] = split
+    if expect:
+        rtv['expect'] = expect
+    return rtv
+
+
+def split_retrieval(rtv):
+    """writes the messages of a retrieval which covers several days into the
+       files given by rtv['split'].
+    """
+    counts = gribtools.split_by_validity(rtv['target'], rtv['split'])
+    for outname in sorted(counts.keys()):
+        print('Wrote {} messages to {}'.format(counts[outname], outname))
+    missing = set(rtv['split'].values()) - set(counts.keys())
+    if missing:
+        raise IOError('{} : no messages for {}'.format(rtv['target'], ' '.join(sorted(missing))))
+    expect = rtv.get('expect', {})
+    if expect.get('messages'):
+        # each time in the split dictionary should have the same number of messages.
+        # the combined request may have times which are not in it (--catchup).
+        pertime = expect.get('pertime', expect['messages'] // len(rtv['split']))
+        for outname in counts:
+            ntimes = list(rtv['split'].values()).count(outname)
+            if counts[outname] != pertime * ntimes:
+                raise IOError('{} : {} messages. Expected {}'.format(outname, counts[outname],
+                                                                     pertime * ntimes))
+
+
+def crop_from_cache(cache, rtv, tmpname):
+    """cuts the area of the request out of a file in the cache which covers a
+       larger area. Returns False if there is no such file or it can not be cropped.
+    """
+    srcname = tmpname + '.src'
+    if not cache.fetch_superset(rtv, srcname):
+        return False
+    try:
+        gribtools.crop_file(srcname, tmpname, rtv['request']['area'], rtv['request']['grid'])
+        print('Cropped from file in cache ' + rtv['target'])
+        return True
+    except Exception as err:
+        # eccodes or numpy missing, or the file can not be cropped.
+        # retrieve from the CDS instead.
+        print('Could not crop from file in cache {} : {}'.format(rtv['target'], err))
+        if os.path.isfile(tmpname):
+            os.remove(tmpname)
+        return False
+    finally:
+        os.remove(srcname)
+
+
+def check_file(fname, expect=None):
+    """returns number of messages. Raises IOError if the file is truncated or empty
+       or does not match expect. Only the headers of the messages are read.
+       expect : dictionary with optional keys
+                messages : number of messages
+                nx, ny : size of the grid.
+    """
+    if not expect:
+        expect = {}
+    nmsg = 0
+    for offset, length, shape in gribtools.iter_grids(fname):
+        nmsg += 1
+        if shape and expect.get('nx') and shape != (expect['nx'], expect['ny']):
+            raise IOError('{} : grid of message {} is {} x {}. Expected {} x {}'.format(
+                          fname, nmsg, shape[0], shape[1], expect['nx'], expect['ny']))
+    if nmsg == 0:
+        raise IOError('{} : no grib messages in file'.format(fname))
+    if expect.get('messages') and nmsg != expect['messages']:
+        raise IOError('{} : {} messages. Expected {}'.format(fname, nmsg, expect['messages']))
+    return nmsg
+
+
+def _retrieve_and_download(server, rtv, partname, times, abandoned=()):
+    # server.retrieve without a target returns when the result is ready
+    # so the time in the CDS queue and the download can be timed separately.
+    start = time.time()
+    result = server.retrieve(rtv['name'], rtv['request'])
+    times['cds_queue'] = time.time() - start
+    start = time.time()
+    result.download(partname)
+    times['download'] = time.time() - start
+    # the attempt timed out while this thread was still running.
+    if partname in abandoned and os.path.isfile(partname):
+        os.remove(partname)
+
+
+def download(server, rtv, tmpname, retry=None, record=None):
+    """retrieves rtv into tmpname. Each attempt is written to its own file,
+       tmpname.N, so that an attempt which timed out and is still running
+       can not write into the file of the next attempt.
+       An attempt which timed out removes its file when it finishes and
+       any tmpname.N files left are removed after the last attempt.
+       record : dictionary. The times of the last attempt and number of retries are added.
+       Returns number of messages in the file.
+    """
+    if not retry:
+        retry = Retry(attempts=1)
+    if record is None:
+        record = {}
+    abandoned = set()
+    try:
+        for attempt in range(1, retry.attempts + 1):
+            partname = '{}.{}'.format(tmpname, attempt)
+            start = time.time()
+            record['retries'] = attempt - 1
+            retry.log(rtv, attempt, 'started')
+            try:
+                times = {}
+                retry.call(_retrieve_and_download, server, rtv, partname, times, abandoned)
+                record.update(times)
+                nmsg = check_file(partname, rtv.get('expect'))
+                os.replace(partname, tmpname)
+                retry.log(rtv, attempt, 'finished after {:.0f} s'.format(time.time() - start))
+                return nmsg
+            except Exception as err:
+                if isinstance(err, TimeoutError):
+                    abandoned.add(partname)
+                retry.log(rtv, attempt, 'failed after {:.0f} s : {}'.format(time.time() - start, err))
+                if os.path.isfile(partname):
+                    os.remove(partname)
+                if attempt == retry.attempts:
+                    raise
+                wait = retry.delay(attempt)
+                retry.log(rtv, attempt, 'waiting {:.0f} s before next attempt'.format(wait))
+                time.sleep(wait)
+    finally:
+        # files written by attempts which timed out and finished since.
+        for partname in glob.glob(glob.escape(tmpname) + '.*'):
+            os.remove(partname)
+
+
+def retrieve_one(server, rtv, manifest=None, cache=None, retry=None, timing=None, queued=None):
+    record = {'target': rtv['target'], 'dataset': rtv['name'], 'source': 'cds',
+              'status': 'failed', 'retries': 0}
+    if queued is None:
+        queued = time.time()
+    record['queued'] = datetime.datetime.fromtimestamp(queued).isoformat(timespec='seconds')
+    record['wait'] = time.time() - queued
+    try:
+        _retrieve_one(server, rtv, manifest, cache, retry, record)
+        record['status'] = 'ok'
+    finally:
+        if timing:
+            timing.write(record)
+    return rtv
+
+
+def _retrieve_one(server, rtv, manifest, cache, retry, record):
+    tmpname = rtv['target'] + '.part'
+    if os.path.isfile(tmpname):
+        os.remove(tmpname)
+    incache = False
+    cropped = False
+    if cache:
+        incache = cache.fetch(rtv, tmpname)
+        if incache:
+            print('Found in cache ' + rtv['target'])
+        else:
+            cropped = crop_from_cache(cache, rtv, tmpname)
+    if incache or cropped:
+        record['source'] = 'cache' if incache else 'crop'
+        start = time.time()
+        try:
+            nmsg = check_file(tmpname, rtv.get('expect'))
+        except IOError as err:
+            print('File from cache is not valid. Retrieving from CDS. {}'.format(err))
+            os.remove(tmpname)
+            incache = False
+            cropped = False
+            record['source'] = 'cds'
+    if not incache and not cropped:
+        nmsg = download(server, rtv, tmpname, retry, record)
+        start = time.time()
+    nbytes = os.path.getsize(tmpname)
+    record['bytes'] = nbytes
+    if record.get('download'):
+        record['mbps'] = nbytes / 1e6 / record['download']
+    os.replace(tmpname, rtv['target'])
+    if cache and not incache:
+        cache.store(rtv, rtv['target'])
+    if rtv.get('split'):
+        split_retrieval(rtv)
+    # only complete when the split files are written too.
+    if manifest:
+        manifest.record(rtv, nbytes, nmsg)
+    record['check'] = time.time() - start
+
+
+def skip_complete(retrievals, manifest):
+    """returns list of the retrievals which still need to be done and
+       list of the retrievals which are already complete in the manifest.
+    """
+    todo = []
+    complete = []
+    for rtv in retrievals:
+        if manifest.is_complete(rtv):
+            print('Already complete. Skipping ' + rtv['target'])
+            # the files split from it may have been removed.
+            if rtv.get('split'):
+                if not all(os.path.isfile(x) for x in rtv['split'].values()):
+                    try:
+                        split_retrieval(rtv)
+                    except IOError as err:
+                        print('Could not split {}. Retrieving again. {}'.format(rtv['target'], err))
+                        todo.append(rtv)
+                        continue
+            complete.append(rtv)
+        else:
+            todo.append(rtv)
+    return todo, complete
+
+
+def retrieve_all(server, retrievals, maxworkers=4, manifest=None, cache=None, retry=None,
+                 timing=None):
+    """submits all the retrievals at once.
+       server : cdsapi.Client object. It is shared by all the threads.
+       maxworkers : maximum number of requests which are queued or downloading
+                    at the same time.
+       manifest : era5manifest.Manifest object or None.
+       cache : era5cache.GribCache object or None.
+       retry : Retry object or None to send each request only once.
+       timing : era5timing.TimingLog object or None.
+       Returns list of the retrievals which failed.
+    """
+    failed = []
+    if manifest:
+        retrievals, complete = skip_complete(retrievals, manifest)
+    if not retrievals:
+        return failed
+    maxworkers = max(1, int(maxworkers))
+    print('Submitting {} retrievals. {} at a time'.format(len(retrievals), maxworkers))
+    with ThreadPoolExecutor(max_workers=maxworkers) as pool:
+        futures = {}
+        for rtv in retrievals:
+            futures[pool.submit(retrieve_one, server, rtv, manifest, cache, retry,
+                                timing, time.time())] = rtv
+        for future in as_completed(futures):
+            rtv = futures[future]
+            try:
+                future.result()
+                print('Finished retrieving ' + rtv['target'])
+            except Exception as err:
+                print('Retrieval failed {} : {}'.format(rtv['target'], err))
+                failed.append(rtv)
+    return failed
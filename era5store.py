@@ -0,0 +1,313 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+from optparse import OptionParser
+import sys
+import datetime
+import numpy as np
+import eccodes
+import era5arl
+import era5utils
+
+"""
+MODULE: keeps the retrieved grib fields in a chunked, compressed Zarr store.
+
+PYTHON 3.x
+
+ABSTRACT: the grib files retrieved by get_era5_cds.py are named by day and
+time period so reading the data again (converting again, cutting out a region,
+checking it) means decoding the grib files again. ingest() copies the fields
+into a Zarr store (zarr must be installed. It is only imported here) where
+    each variable is an array named by its HYSPLIT name (era5utils.getvars).
+    3d variables have shape (time, level, latitude, longitude).
+    surface variables have shape (time, latitude, longitude).
+    the chunks are one time, one level and tile x tile grid points so reading a
+    small region or a few times only decompresses the chunks which are needed.
+    time, level, latitude and longitude arrays hold the coordinates.
+The rows are from south to north as in the ARL files. The values are in the
+units of the grib files. The conversion factor for HYSPLIT is kept in the
+attributes of each array (cnv). Zarr arrays can be read by several processes at once.
+
+The grid and the levels are set by the first files put in the store. New times
+are put in the time array in order (the later times of each variable are moved
+along) and times already in the store are written again.
+Only one ensemble member can be kept in a store.
+
+A store with pressure levels is converted to ARL format with era5arl.py --store.
+
+    python era5store.py -s ERA5_2017Jan.zarr ERA5_2017.Jan01.3dpl.grib ERA5_2017.Jan01.2dpl.all.grib
+    python era5store.py -s ERA5_2017Jan.zarr          (lists what is in the store)
+    python era5arl.py --store ERA5_2017Jan.zarr -d new_era52arl.cfg -o ERA5_2017Jan.ARL
+"""
+
+# variables on the pressure or model levels.
+ATMVARS = ['TEMP', 'UWND', 'VWND', 'WWND', 'RELH', 'HGTS', 'SPHU', 'ZWND']
+
+
+def name_table(tm=1):
+    """returns dictionary. key is (grib shortName, True for 3d) and value is
+       (HYSPLIT name, conversion factor).
+       tm : hours in the accumulation of the precipitation (TPP1 or TPP3).
+    """
+    table = {}
+    for name, codes in era5utils.getvars(tm=tm).items():
+        if len(codes) < 3 or (name.startswith('TPP') and name != era5utils.precip_name(tm)):
+            continue
+        table[(codes[0], name in ATMVARS)] = (name, float(codes[2]))
+    return table
+
+
+def scan_messages(fname, table, member=None):
+    """returns list of dictionaries with the header information of each message
+       which has a HYSPLIT name.
+    """
+    messages = []
+    with open(fname, 'rb') as fid:
+        while True:
+            offset = fid.tell()
+            gid = eccodes.codes_grib_new_from_file(fid, headers_only=True)
+            if gid is None:
+                break
+            try:
+                ltype = eccodes.codes_get(gid, 'levelType')
+                sname = eccodes.codes_get(gid, 'shortName')
+                # lnsp and z are only on the first model level and are kept as LNSP and SHGT.
+                is3d = ltype in ['pl', 'ml'] and sname not in ['lnsp'] and \
+                       not (ltype == 'ml' and sname == 'z')
+                found = table.get((sname, is3d))
+                if found is None:
+                    continue
+                if member is not None and era5arl.get_member(gid) != member:
+                    continue
+                messages.append({'fname': fname, 'offset': offset, 'kvar': found[0],
+                                 'cnv': found[1], 'is3d': is3d, 'ltype': ltype,
+                                 'level': eccodes.codes_get(gid, 'level') if is3d else 0,
+                                 'date': era5arl.get_date(gid), 'grid': era5arl.get_grid(gid),
+                                 'member': era5arl.get_member(gid)})
+            finally:
+                eccodes.codes_release(gid)
+    return messages
+
+
+def create_array(group, name, shape, chunks, dtype='f4', fill_value=np.nan):
+    # create_array in zarr 3. create_dataset in zarr 2.
+    create = getattr(group, 'create_array', None) or group.create_dataset
+    return create(name, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value)
+
+
+def open_store(path, mode='a'):
+    import zarr
+    return zarr.open_group(path, mode=mode)
+
+
+def encode_time(date):
+    return int((date - datetime.datetime(1970, 1, 1)).total_seconds() // 60)
+
+
+def store_times(group):
+    """returns list of datetimes in the store.
+    """
+    if 'time' not in group:
+        return []
+    return [datetime.datetime(1970, 1, 1) + datetime.timedelta(minutes=int(x))
+            for x in group['time'][:]]
+
+
+def set_grid(group, grid, tile):
+    """writes the latitude and longitude arrays or checks that grid is the same.
+    """
+    nx, ny, clat, clon, dlat, dlon = grid
+    if 'latitude' in group:
+        if tuple(group.attrs['grid']) != tuple(grid):
+            raise ValueError('grid {} is not the same as in the store {}'.format(
+                             grid, tuple(group.attrs['grid'])))
+        return
+    group.attrs['grid'] = list(grid)
+    group.attrs['tile'] = tile
+    create_array(group, 'latitude', (ny,), (ny,), 'f8')[:] = clat + dlat * np.arange(ny)
+    create_array(group, 'longitude', (nx,), (nx,), 'f8')[:] = clon + dlon * np.arange(nx)
+
+
+def set_levels(group, levels, ltype):
+    """writes the level array from the bottom up or checks that levels are in it.
+    """
+    if 'level' in group:
+        stored = [int(x) for x in group['level'][:]]
+        missing = [x for x in levels if x not in stored]
+        if missing or group['level'].attrs['type'] != ltype:
+            raise ValueError('{} levels {} are not in the store'.format(ltype, missing))
+        return stored
+    # pressure and model level numbers both decrease upwards.
+    stored = sorted(set(levels), reverse=True)
+    create_array(group, 'level', (len(stored),), (len(stored),), 'i4', 0)[:] = stored
+    group['level'].attrs['type'] = ltype
+    return stored
+
+
+def time_indices(group, dates):
+    """returns dictionary of date and index in the time array.
+       New dates are put in the time array in order. The times of each variable
+       after them are moved along, one time at a time, and the new times are
+       left empty (nan).
+    """
+    if 'time' not in group:
+        create_array(group, 'time', (0,), (4096,), 'i8', 0)
+        group['time'].attrs['units'] = 'minutes since 1970-01-01 00:00'
+    stored = store_times(group)
+    new = [x for x in sorted(set(dates)) if x not in stored]
+    if new:
+        times = sorted(stored + new)
+        ntimes = len(times)
+        group['time'].resize((ntimes,))
+        for name in group.attrs.get('variables', []):
+            arr = group[name]
+            arr.resize((ntimes,) + arr.shape[1:])
+            # from the last time so nothing is written over before it is moved.
+            for old in range(len(stored) - 1, -1, -1):
+                nnn = times.index(stored[old])
+                if nnn == old:
+                    break
+                arr[nnn] = arr[old]
+            for date in new:
+                if stored and date < stored[-1]:
+                    arr[times.index(date)] = np.nan
+        group['time'][:] = [encode_time(x) for x in times]
+        stored = times
+    return dict((x, stored.index(x)) for x in set(dates))
+
+
+def variable_array(group, msg, ntimes, nlevs, tile):
+    """returns the array for the variable of the message. It is made if it is not in the store.
+    """
+    name = msg['kvar']
+    if name in group:
+        return group[name]
+    nx, ny = msg['grid'][0:2]
+    if msg['is3d']:
+        arr = create_array(group, name, (ntimes, nlevs, ny, nx), (1, 1, min(tile, ny), min(tile, nx)))
+    else:
+        arr = create_array(group, name, (ntimes, ny, nx), (1, min(tile, ny), min(tile, nx)))
+    arr.attrs['cnv'] = msg['cnv']
+    group.attrs['variables'] = group.attrs.get('variables', []) + [name]
+    return arr
+
+
+def ingest(path, fnames, tm=1, member=None, tile=256):
+    """copies the fields in the grib files to the store at path.
+       member : ensemble member to keep. Default is the first one in the files.
+       tile : size of the chunks in latitude and longitude.
+       Returns number of fields written.
+    """
+    table = name_table(tm)
+    messages = []
+    for fname in fnames:
+        messages.extend(scan_messages(fname, table, member))
+    if not messages:
+        raise ValueError('no fields with HYSPLIT names in {}'.format(' '.join(fnames)))
+    members = sorted(set(x['member'] for x in messages))
+    group = open_store(path)
+    if 'member' not in group.attrs:
+        group.attrs['member'] = members[0]
+    if group.attrs['member'] not in members:
+        raise ValueError('the store has member {} which is not in {}'.format(
+                         group.attrs['member'], ' '.join(fnames)))
+    messages = [x for x in messages if x['member'] == group.attrs['member']]
+    if len(members) > 1:
+        print('Warning: several ensemble members in the files. Keeping member {}'.format(
+              group.attrs['member']))
+    grid = messages[0]['grid']
+    if any(x['grid'] != grid for x in messages):
+        raise ValueError('the grids of the messages in {} are not all the same'.format(' '.join(fnames)))
+    set_grid(group, grid, tile)
+    levels = []
+    atm = [x for x in messages if x['is3d']]
+    if atm:
+        levels = set_levels(group, [x['level'] for x in atm], atm[0]['ltype'])
+    tindex = time_indices(group, [x['date'] for x in messages])
+    ntimes = group['time'].shape[0]
+    nx, ny = grid[0:2]
+    fids = dict((x, open(x, 'rb')) for x in fnames)
+    try:
+        for msg in messages:
+            arr = variable_array(group, msg, ntimes, len(levels), group.attrs['tile'])
+            values = era5arl.read_values(fids[msg['fname']], dict(msg, cnv=1.0), nx, ny)
+            if msg['is3d']:
+                arr[tindex[msg['date']], levels.index(msg['level'])] = values
+            else:
+                arr[tindex[msg['date']]] = values
+    finally:
+        for fid in fids.values():
+            fid.close()
+    return len(messages)
+
+
+def area_slices(group, area=None):
+    """returns (jslice, islice) of the rows and columns in area N/W/S/E.
+       The box can not cross the edge of the grid. None is the whole grid.
+    """
+    if not area:
+        return slice(None), slice(None)
+    north, west, south, east = [float(x) for x in area.split('/')]
+    lats = group['latitude'][:]
+    lons = group['longitude'][:]
+    # longitudes from the west edge of the box.
+    jlist = np.where((lats >= south) & (lats <= north))[0]
+    ilist = np.where((lons - west) % 360 <= (east - west) % 360)[0]
+    if len(jlist) == 0 or len(ilist) == 0:
+        raise ValueError('area {} is not in the store'.format(area))
+    return slice(jlist[0], jlist[-1] + 1), slice(ilist[0], ilist[-1] + 1)
+
+
+def read_field(group, name, date, level=None, area=None):
+    """returns the field for date as an array with the first row the southernmost
+       latitude. level is the pressure or model level of a 3d variable.
+       area : N/W/S/E. Only the chunks in the box are read. See area_slices.
+    """
+    tnum = store_times(group).index(date)
+    jslice, islice = area_slices(group, area)
+    if level is None:
+        return group[name][tnum, jslice, islice]
+    levels = [int(x) for x in group['level'][:]]
+    return group[name][tnum, levels.index(level), jslice, islice]
+
+
+def describe(group):
+    """returns list of lines describing what is in the store.
+    """
+    lines = []
+    times = store_times(group)
+    if times:
+        lines.append('{} times {} to {}'.format(len(times), times[0], times[-1]))
+    if 'level' in group:
+        lines.append('{} levels ({}) {}'.format(group['level'].shape[0], group['level'].attrs['type'],
+                     ' '.join(str(x) for x in group['level'][:])))
+    if 'grid' in group.attrs:
+        lines.append('grid nx ny clat clon dlat dlon {}'.format(group.attrs['grid']))
+    for name in group.attrs.get('variables', []):
+        lines.append('{} {} chunks {}'.format(name, group[name].shape, group[name].chunks))
+    return lines
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog -s STORE [GRIBFILES]')
+    parser.add_option("-s", type="string", dest="store", default='',
+                      help="Zarr store (directory) to write to.")
+    parser.add_option("--tile", type="int", dest="tile", default=256,
+                      help="{256} number of grid points in each direction of a chunk. \
+                            Only used when the store is new.")
+    parser.add_option("-p", type="int", dest="member", default=None,
+                      help="ensemble member to keep.")
+    parser.add_option("--tm", type="int", dest="tm", default=1,
+                      help="{1} hours between the times. 3 for the ensemble (TPP3).")
+    (options, args) = parser.parse_args()
+    if not options.store:
+        print('A store must be given with -s')
+        sys.exit()
+    if args:
+        try:
+            nfields = ingest(options.store, args, tm=options.tm, member=options.member,
+                             tile=options.tile)
+        except ValueError as err:
+            print('Error : {}'.format(err))
+            sys.exit(1)
+        print('Wrote {} fields to {}'.format(nfields, options.store))
+    for line in describe(open_store(options.store, mode='r')):
+        print(line)
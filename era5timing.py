@@ -0,0 +1,91 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import json
+import threading
+
+"""
+MODULE: timing records for the retrievals.
+
+PYTHON 3.x
+
+ABSTRACT: one json record is appended to the timing file (json lines) for each
+retrieval. The record has the keys
+    target   : output file.
+    dataset  : name of the CDS dataset.
+    source   : cds, cache or crop (cut out of a larger file in the cache).
+    status   : ok or failed.
+    queued   : time the retrieval was submitted (ISO format).
+    wait     : seconds waiting for a free worker before the first attempt.
+    cds_queue : seconds from sending the request until the result was ready to download.
+                This is the time queued and processed at the CDS.
+    download : seconds to download the file.
+    check    : seconds to check the grib messages, rename and split the file.
+               This is mostly limited by the local disk.
+    bytes    : size of the file.
+    mbps     : MB/s for the download.
+    retries  : number of attempts after the first one.
+cds_queue and download are for the last attempt.
+summarize gives the totals for each dataset so it can be seen whether a run is
+limited by the CDS queue, by the bandwidth or by the local disk.
+"""
+
+
+class TimingLog:
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.records = []
+
+    def write(self, record):
+        with self.lock:
+            self.records.append(record)
+            with open(self.fname, 'a') as fid:
+                fid.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(fname):
+    records = []
+    if not os.path.isfile(fname):
+        return records
+    with open(fname, 'r') as fid:
+        for line in fid:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def summarize(records):
+    """returns list of lines with a summary of the records for each dataset.
+    """
+    datasets = {}
+    for rec in records:
+        datasets.setdefault(rec['dataset'], []).append(rec)
+    lines = []
+    fmt = '{:40s} {:>6s} {:>6s} {:>8s} {:>8s} {:>11s} {:>10s} {:>8s} {:>8s} {:>7s}'
+    lines.append(fmt.format('dataset', 'files', 'failed', 'GB', 'wait s', 'cds_queue s',
+                            'download s', 'check s', 'MB/s', 'retries'))
+    for name in sorted(datasets.keys()):
+        recs = datasets[name]
+        ok = [x for x in recs if x['status'] == 'ok']
+        fromcds = [x for x in ok if x['source'] == 'cds']
+        nbytes = sum(x.get('bytes', 0) for x in ok)
+        dltime = sum(x.get('download', 0) for x in fromcds)
+        dlbytes = sum(x.get('bytes', 0) for x in fromcds)
+        if dltime > 0:
+            mbps = '{:8.2f}'.format(dlbytes / 1e6 / dltime)
+        else:
+            mbps = '-'
+
+        def mean(key, rlist=ok):
+            if not rlist:
+                return '-'
+            return '{:.0f}'.format(sum(x.get(key, 0) for x in rlist) / len(rlist))
+        lines.append(fmt.format(name, str(len(ok)), str(len(recs) - len(ok)),
+                                '{:.2f}'.format(nbytes / 1e9), mean('wait', recs),
+                                mean('cds_queue', fromcds), mean('download', fromcds),
+                                mean('check'), mbps.strip(),
+                                str(sum(x.get('retries', 0) for x in recs))))
+    lines.append('wait, cds_queue, download and check are mean times per file.')
+    return lines
@@ -4,9 +4,11 @@
 #from calendar import monthrange
 #from calendar import month_name
 from optparse import OptionParser
+import os
 import sys
 import datetime
 import string
+import functools
 
 """
 MAIN PROGRAM: retrieves ecmwf ERA5 dataset using the CDS (Copernicus Data Service) API.
@@ -37,14 +39,25 @@ if the -g option is set will write a shell script to run the era52arl utility.
 """
 
 def getvars(means=False, tm=1, levtype='pl',instant=True):
+    """returns dictionary. key is HYSPLIT name and value is list of codes for ERA5.
+       The table is only built once for each set of arguments (vartable) and
+       each caller gets its own copy.
+    """
+    table = vartable(bool(means), int(tm), levtype, bool(instant))
+    return dict((key, list(codes)) for key, codes in table.items())
+
+
+@functools.lru_cache(maxsize=None)
+def vartable(means, tm, levtype, instant):
+    """builds the table for getvars. The result is cached and must not be changed.
+    """
 
     # HYSPLIT convention is that upward sensible heat flux should be positive. 
     # Multiply by -1
+    # the accumulations over tm hours are divided by the number of seconds.
     if int(tm)==1: amult = '-0.00028'  #1/3600 s
     elif int(tm)==3: amult = '-9.26e-5'
-    else: 
-       print('warning tm value not 1 or 3 ...... {}'.format(tm))
-       amult='1'
+    else: amult = '{:.3e}'.format(-1.0/(3600*int(tm)))
     sname={}
     #3d fields. pressure levels. Instantaneous.
     #REQUIRED
@@ -100,6 +113,9 @@ def getvars(means=False, tm=1, levtype='pl',instant=True):
     sname['TPP1'] = ['tp','228','1.0','228.128','total_precipitation']       #Accumulated precipitation. units of m. multiplier is 1.        
     # TPP3 is for the ensemble output which is every 3 hours.
     sname['TPP3'] = ['tp','228','1.0','228.128','total_precipitation']       #Accumulated precipitation. units of m. multiplier is 1.        
+    # precipitation added up over tm hours (get_era5_cds.py --tres). TPP6 is the only other one in HYSPLIT.
+    if int(tm) == 6:
+        sname[precip_name(int(tm))] = ['tp','228','1.0','228.128','total_precipitation']
     sname['RGHS'] = ['fsr','244','1.0', "244.128",'forecast_surface_roughness']   #forecast surface roughnes : units m
 
     #It looks like the means are not output every hour so do not use them.
@@ -122,7 +138,7 @@ def getvars(means=False, tm=1, levtype='pl',instant=True):
         sname['LTHF'] = ['slhf','147', amult,'147.128','surface_latent_heat_flux'] #same as sshf            
 
     # dswf positive in both ERA5 and HYSPLIT
-    sname['DSWF'] = ['ssrd','169', -1*amult,'169.128',
+    sname['DSWF'] = ['ssrd','169', str(-1*float(amult)),'169.128',
                      'surface_solar_radiation_downwards']  #Accumulated. units J/m^2-1* t
     sname['USTR'] = ['zust','3', '1.0','3.228','friction_velocity']      #units of m/s (multiplier should be 1)      
 
@@ -138,18 +154,203 @@ def getvars(means=False, tm=1, levtype='pl',instant=True):
     ### step for forecast are 1 through 18
     return sname
 
+def get_dates(year, month, day, enddate=None, months=None):
+    """returns list of datetime objects, one for each day to retrieve.
+       enddate : string YYYY-MM-DD. last day to retrieve.
+       months  : string with comma separated list of months in year.
+    """
+    startdate = datetime.datetime(year, month, day, 0)
+    if months:
+       dates = []
+       for mnth in months.split(','):
+           dstart = datetime.datetime(year, int(mnth), 1, 0)
+           if int(mnth) == 12:
+              dend = datetime.datetime(year+1, 1, 1, 0)
+           else:
+              dend = datetime.datetime(year, int(mnth)+1, 1, 0)
+           while dstart < dend:
+               dates.append(dstart)
+               dstart += datetime.timedelta(hours=24)
+       return dates
+    if not enddate:
+       return [startdate]
+    dend = datetime.datetime.strptime(enddate, '%Y-%m-%d')
+    if dend < startdate:
+       print('Warning: end date {} is before start date {}'.format(enddate, startdate))
+    dates = []
+    while startdate <= dend:
+        dates.append(startdate)
+        startdate += datetime.timedelta(hours=24)
+    return dates
+
+
+def get_timelist(split=1, stream='oper'):
+    """returns list of strings. Each string has the times which are retrieved
+       into one file. split is the number of time periods to split the day into.
+    """
+    if stream == 'oper':
+    ##need to break each day into four time periods to keep 3d grib files at around 1.6 GB
+        #wtime1 =  "00:00/01:00/02:00/03:00/04:00/05:00"
+        #wtime2 =  "06:00/07:00/08:00/09:00/10:00/11:00"
+        #wtime3 =  "12:00/13:00/14:00/15:00/16:00/17:00"
+        #wtime4 =  "18:00/19:00/20:00/21:00/22:00/23:00"
+
+        wtime1 =  "00:00/01:00/02:00"
+        wtime2 =  "03:00/04:00/05:00"
+        wtime3 =  "06:00/07:00/08:00"
+        wtime4 =  "09:00/10:00/11:00"
+        wtime5 =  "12:00/13:00/14:00"
+        wtime6 =  "15:00/16:00/17:00"
+        wtime7 =  "18:00/19:00/20:00"
+        wtime8 =  "21:00/22:00/23:00"
+        wtimelist = [wtime1, wtime2, wtime3, wtime4,wtime5,wtime6,wtime7,wtime8]
+
+        if split==1:
+           wtimelist = [str.join('/', wtimelist)]
+
+        elif split==4:
+           wt1 = str.join('/', [wtime1,wtime2])
+           wt2 = str.join('/', [wtime3,wtime4])
+           wt3 = str.join('/', [wtime5,wtime6])
+           wt4 = str.join('/', [wtime7,wtime8])
+           wtimelist = [wt1,wt2, wt3, wt4]
+
+        elif split==2:
+           wt1 = str.join('/', [wtime1,wtime2,wtime3,wtime4])
+           wt2 = str.join('/', [wtime5,wtime6,wtime7,wtime8])
+           wtimelist = [wt1,wt2]
+
+        elif split==24:
+           wtimelist = []
+           for iii in range(0,24):
+               wtimelist.append(str(iii).zfill(2) + ':00')
+        else:
+           wtimelist = [wtime1, wtime2, wtime3, wtime4,wtime5,wtime6,wtime7,wtime8]
+
+    #ensemble data only availabe every 3 hours.
+    elif stream == 'enda':
+        wtime1 =  "00:00/03:00/06:00/09:00/12:00/15:00/18:00/21:00"
+        wtimelist = [wtime1]
+    return wtimelist
+
+
+def grid_size(area, grid):
+    """returns number of points (nx, ny) for area North/West/South/East and grid dlon/dlat.
+    """
+    north, west, south, east = [float(x) for x in area.split('/')]
+    dlon, dlat = [float(x) for x in grid.split('/')]
+    nx = int(round((east - west) / dlon)) + 1
+    # global grids do not repeat the first longitude.
+    if (nx - 1) * dlon >= 360:
+        nx = int(round(360 / dlon))
+    ny = int(round((north - south) / dlat)) + 1
+    return nx, ny
+
+
+def estimate_bytes(nfields, nx, ny, bits=16):
+    """estimate of grib file size. ERA5 grib1 fields are packed with 16 bits per value.
+       Allow about 200 bytes for the header sections of each message.
+    """
+    return nfields * (nx * ny * bits // 8 + 200)
+
+
+def choose_chunks(nperhour, nx, ny, maxfields, maxbytes, maxdays=31):
+    """picks the largest request which stays under the limits.
+       nperhour : number of fields for one time (params x levels x members).
+       maxfields : maximum number of fields in one request.
+       maxbytes : maximum size of file for one request.
+       Returns (split, ndays). split is number of time periods per day as used by
+       get_timelist. ndays is number of days which can go in one request when
+       the whole day fits in one request.
+    """
+    for split in [1, 2, 4, 8, 24]:
+        nfields = nperhour * 24 // split
+        if nfields <= maxfields and estimate_bytes(nfields, nx, ny) <= maxbytes:
+            if split == 1:
+                ndays = min(maxdays, maxfields // nfields,
+                            int(maxbytes // estimate_bytes(nfields, nx, ny)))
+                return split, max(1, ndays)
+            return split, 1
+    print('Warning: one time period is larger than the limits. Retrieving one hour per request.')
+    return 24, 1
+
+
 def pressure_levels(toplevel=1):
+    """returns the ERA5 pressure levels (hPa) from the bottom up to toplevel.
+    """
     levs = list(range(750,1025,25)) + list(range(300,750,50)) + list(range(100,275,25)) + [1,2,3,5,7,10,20,30,50,70]
-    levs = sorted(levs, reverse=True)
-    if toplevel != 1: 
-       levs = [y for y in levs if y>=options.toplevel]
-       levs = sorted(levs, reverse=True)
-       levstr = str(levs[0])
+    levs = [y for y in levs if y>=toplevel]
+    return sorted(levs, reverse=True)
+
+
+def catchup_range(lasttime, enddate=None, delay=5, step=1):
+    """returns (start, end) datetimes of the hours which are missing after lasttime
+       or None if there are none.
+       enddate : YYYY-MM-DD. The last hour of this day is the end. If None the end is
+                 the latest hour which is available, delay days ago (ERA5T).
+       step : hours between the times.
+    """
+    start = lasttime + datetime.timedelta(hours=step)
+    if enddate:
+        end = datetime.datetime.strptime(enddate, '%Y-%m-%d') + datetime.timedelta(hours=23)
     else:
-       levstr = ''
-    for lv in levs[1:]:
-       levstr += '/' + str(lv)  
-    return levs
+        end = datetime.datetime.utcnow() - datetime.timedelta(days=delay)
+        end = end.replace(minute=0, second=0, microsecond=0)
+    if start > end:
+        return None
+    return start, end
+
+
+def catchup_times(wtime, day, trange):
+    """keeps only the times in wtime (HH:MM/HH:MM...) on day which are in trange (start, end).
+    """
+    start, end = trange
+    times = []
+    for tstr in wtime.split('/'):
+        date = day + datetime.timedelta(hours=int(tstr[0:2]))
+        if start <= date <= end:
+            times.append(tstr)
+    return '/'.join(times)
+
+
+def precip_name(tres=1):
+    """returns HYSPLIT name of the precipitation accumulated over tres hours.
+    """
+    if tres not in [1, 3, 6]:
+        raise ValueError('HYSPLIT precipitation is over 1, 3 or 6 hours not {}'.format(tres))
+    return 'TPP' + str(tres)
+
+
+def accumulation_times(wtime, tres=1):
+    """returns (times on the day, times on the day before) of the hourly accumulations
+       which are added up for the times in wtime (HH:MM/HH:MM...). The value at time t
+       is over the tres hours before t so the hours t-tres+1 to t are needed.
+    """
+    today = set()
+    before = set()
+    for tstr in wtime.split('/'):
+        hour = int(tstr[0:2])
+        for hhh in range(hour - tres + 1, hour + 1):
+            if hhh < 0:
+                before.add(hhh + 24)
+            else:
+                today.add(hhh)
+    return (['{:02d}:00'.format(x) for x in sorted(today)],
+            ['{:02d}:00'.format(x) for x in sorted(before)])
+
+
+def thin_timelist(wtimelist, tres=1):
+    """returns list of (time period number, times) with only the times which are
+       a multiple of tres hours. Time periods with no times left are removed but
+       the others keep their number (1 is the first) so the file names and -q
+       are the same as without tres.
+    """
+    thinned = []
+    for iii, wtime in enumerate(wtimelist, 1):
+        times = [x for x in wtime.split('/') if int(x[0:2]) % max(tres, 1) == 0]
+        if times:
+            thinned.append((iii, '/'.join(times)))
+    return thinned
 
 
 def model_levels_default():
@@ -260,31 +461,95 @@ def createparamstr(paramlist, means=False, levtype='pl',instant=True):
             print("No code for " , key , " available.") 
     return paramstr
 
-def grib2arlscript(scriptname, shfiles, day, tstr, hname='ERA5'):
+def arlname(gribname, day, hname='ERA5'):
+   """returns name of the daily ARL file e.g. ERA5_20170101.ARL
+      The ensemble member is added if it is in the name of the grib file.
+   """
+   checkens = ['e0', 'e1', 'e2', 'e3', 'e4', 'e5', 'e6', 'e7', 'e8', 'e9']
+   hname2 = hname
+   for ens in checkens:
+       if ens in gribname:
+          hname2 = hname + '_' + ens  
+   return hname2 + day.strftime("_%Y%m%d.ARL")
+
+
+def member_name(fname, member):
+   """returns name of the ARL file for an ensemble member.
+      ERA5_20170101.ARL gives ERA5_e3_20170101.ARL (same as arlname) and T1.ARL gives T1_e3.ARL
+   """
+   dirname, base = os.path.split(fname)
+   if '_' in base:
+      head, tail = base.split('_', 1)
+      base = '{}_e{}_{}'.format(head, member, tail)
+   else:
+      root, ext = os.path.splitext(base)
+      base = '{}_e{}{}'.format(root, member, ext)
+   return os.path.join(dirname, base)
+
+
+def grib2arljobs(jobname, shfiles, day, tstr, hname='ERA5', tres=1, levtype='pl', cfgname=None):
+   """adds the conversions to the job file used by era5convert.py
+   """
+   import era5convert
+   era5convert.add_jobs(jobname, arljobs(shfiles, day, tstr, hname, tres=tres, levtype=levtype,
+                                         cfgname=cfgname))
+
+
+def arljobs(shfiles, day, tstr, hname='ERA5', tres=1, levtype='pl', cfgname=None):
+   """returns list of the conversions in the format used by era5convert.py
+      tres : hours between the times. The accumulations are added up over tres hours.
+      levtype : ml jobs are converted with era5arl.py.
+      cfgname : decoding configuration file written for the files.
+   """
+   jobs = []
+   for files in shfiles:
+       jobs.append({'files': list(files), 'tstr': tstr, 'arl': arlname(files[0], day, hname)})
+       if tres > 1:
+          jobs[-1]['tres'] = tres
+       if levtype == 'ml':
+          jobs[-1]['levtype'] = levtype
+       if cfgname:
+          jobs[-1]['cfg'] = cfgname
+   return jobs
+
+
+def grib2arlscript(scriptname, shfiles, day, tstr, hname='ERA5', members=0, cfgname=None,
+                   tres=1):
    """writes a line in a shell script to run era51arl. $MDL is the location of the era52arl program.
+      members : number of ensemble members. If set all the members are converted in one
+                pass with era5arl.py ($PDL is the location of the python programs).
+      cfgname : decoding configuration file. If set the files are converted with
+                era5arl.py -d cfgname instead of era52arl (model levels, --tres).
+      tres : hours between the times. The forecast files (all after the second) have the
+             hourly accumulations which era5arl.py adds up over tres hours.
    """
    fid = open(scriptname , 'a')
-   checkens = ['e0', 'e1', 'e2', 'e3', 'e4', 'e5', 'e6', 'e7', 'e8', 'e9']
+   if members:
+      ensemblescript(fid, shfiles, day, tstr, hname, members, cfgname)
+      fid.close()
+      return
    for files in shfiles:
        inputstr = []
-       inputstr.append('${MDL}/era52arl')
+       if cfgname:
+          inputstr.append('python ${PDL}/era5arl.py')
+       else:
+          inputstr.append('${MDL}/era52arl')
        inputstr.append('-i' + files[0])
        inputstr.append('-a' + files[1])         #analysis file with 2d fields
-       try:
-          inputstr.append('-f' + files[2]) #file with forecast fields.
-       except:
-          pass
+       for ffile in files[2:]:
+          inputstr.append('-f' + ffile) #file with forecast fields.
+       if cfgname:
+          inputstr.append('-d' + cfgname)
+       if tres > 1:
+          inputstr.append('--tres ' + str(tres))
        for arg in inputstr:
            fid.write(arg + ' ')
        fid.write('\n')
        tempname = tstr + '.ARL'
-       hname2 = hname
-       for ens in checkens:
-           if ens in files[0]:
-              hname2 = hname + '_' + ens  
-       fname = hname2 + day.strftime("_%Y%m%d.ARL")
+       fname = arlname(files[0], day, hname)
        fid.write('mv DATA.ARL ' +  tempname + '\n')
-       fid.write('mv ERA52ARL.MESSAGE MESSAGE.'  +fname + '.' + tstr + ' \n')
+       if not cfgname:
+          fid.write('mv ERA52ARL.MESSAGE MESSAGE.'  +fname + '.' + tstr + ' \n')
        if tstr=='T1':
           fid.write('cat ' + tempname + ' > ' +fname + '\n')
        else:
@@ -294,3 +559,26 @@ def grib2arlscript(scriptname, shfiles, day, tstr, hname='ERA5'):
 
    fid.close()
 
+
+def ensemblescript(fid, shfiles, day, tstr, hname, members, cfgname=None):
+   """writes lines in a shell script to convert all the ensemble members with era5arl.py
+      cfgname : decoding configuration file (-d option).
+   """
+   for files in shfiles:
+       inputstr = ['python ${PDL}/era5arl.py', '-i' + files[0], '-a' + files[1]]
+       if len(files) > 2:
+          inputstr.append('-f' + files[2])
+       if cfgname:
+          inputstr.append('-d' + cfgname)
+       tempname = tstr + '.ARL'
+       inputstr.append('-o' + tempname)
+       inputstr.append('--members')
+       fid.write(' '.join(inputstr) + '\n')
+       fname = hname + day.strftime("_%Y%m%d.ARL")
+       fid.write('for ens in {}; do\n'.format(' '.join(map(str, range(members)))))
+       redirect = '>' if tstr == 'T1' else '>>'
+       fid.write('  cat {} {} {}\n'.format(member_name(tempname, '${ens}'), redirect,
+                                          member_name(fname, '${ens}')))
+       fid.write('  rm {}\n'.format(member_name(tempname, '${ens}')))
+       fid.write('done\n')
+       fid.write('\n')
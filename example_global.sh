@@ -22,19 +22,12 @@ outdir='./'
 # smaller files are usually retrieved faster with less download errors.
 splitnum=8
 
-for month in '01'
-do
-     for day  in   $(seq 1  31)
-     do
-       # retrieves daily surface data files with all variables
-       $MDL ${PDL}/get_era5_cds.py  --2da  -y $year -m $month  -d $day --dir $outdir  -g 
-       for tm in $(seq 1 $splitnum)
-       do
-          # retrieve pressure level data in 3 hour increments (1-8). 
-          $MDL ${PDL}/get_era5_cds.py  --3d   -y $year -m $month  -d $day --dir $outdir  --split $splitnum -g -q$tm
-       done
-     done
-done
+# retrieves the whole month in one run.
+# pressure level data in 3 hour increments (T1-T8) and the surface data
+# with all variables for the same time periods.
+# all the requests are sent to the CDS together. --concurrent sets
+# how many are queued or downloading at the same time.
+$MDL ${PDL}/get_era5_cds.py  --3d --2da  -y $year --months 1 --dir $outdir  --split $splitnum -g --concurrent 8
 
 mv new_era52arl.cfg era52arl.cfg
 
@@ -48,24 +41,9 @@ mv new_era52arl.cfg era52arl.cfg
 
 #location of era52arl executable
 MDL=$HOME/hysplit/data2arl/era52arl/
-monthname='Jan'
-for month in '01'
-do
-     for day  in   {01..31}
-     do
-     dailyfile=ERA5_${year}${month}${day}.ARL
-     for tm in $(seq 1 $splitnum)
-       do
-       echo '---------------------------------------------------------------------------------'
-       echo $MDL/era52arl -i${outdir}ERA5_$year.${monthname}${day}.3dpl.T${tm}.grib -a${outdir}ERA5_${year}.${monthname}${day}.2dpl.all.grib
-       $MDL/era52arl -i${outdir}ERA5_$year.${monthname}${day}.3dpl.T${tm}.grib -a${outdir}ERA5_${year}.${monthname}${day}.2dpl.all.grib
-       # if you want to keep separate ARL files
-       mv DATA.ARL ERA5_${year}${month}${day}.T${tm}.ARL
-       # if you want to create a daily ARL file.
-       cat DATA.ARL >> $dailyfile 
-       echo 'DONE ---------------------------------------------------------------------------------'
-       done
-     done
-done
-
 
+# -g writes the conversions for the month to 2017Jan_ecm2arl.json.
+# era5convert.py runs era52arl for each time period in its own directory
+# using all the cores and then writes the daily files ERA5_YYYYMMDD.ARL
+# with the time periods in order.
+python ${PDL}/era5convert.py -j ${outdir}${year}Jan_ecm2arl.json --exe $MDL/era52arl --outdir $outdir
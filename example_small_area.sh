@@ -20,17 +20,10 @@ area="50/-85/30/-70"
 #directory to write files to.
 outdir='./'
 
-for month in '01'
-do
-     for day  in   $(seq 1  31)
-     do
-              echo "RETRIEVING  month $month day $day"
-              # retrieves pressure level files
-              $MDL ${PDL}/get_era5_cds.py  --3d   -y $year -m $month  -d $day --dir $outdir  -g  --area $area
-              # retrieves surface data files with all variables
-              $MDL ${PDL}/get_era5_cds.py  --2da  -y $year -m $month  -d $day --dir $outdir  -g  --area $area
-     done
-done
+echo "RETRIEVING  month 01"
+# retrieves pressure level files and surface data files with all variables
+# for every day of the month in one run.
+$MDL ${PDL}/get_era5_cds.py  --3d --2da  -y $year --months 1 --dir $outdir  -g  --area $area
 
 # use the cfg file created for the conversion.
 mv new_era52arl.cfg era52arl.cfg
@@ -5,10 +5,20 @@ import cdsapi
 #from calendar import monthrange
 #from calendar import month_name
 from optparse import OptionParser
+import os
 import sys
 import datetime
 import string
 import era5utils
+import era5retrieve
+import era5manifest
+import era5cache
+import era5timing
+import era5convert
+import era5pipeline
+import era5profile
+import era5plan
+import arlreader
 
 """
 MAIN PROGRAM: retrieves ecmwf ERA5 dataset using the CDS (Copernicus Data Service) API.
@@ -47,6 +57,14 @@ parser.add_option("-m", type="int" , dest="month" , default=1,
                   help = "{1} Month to retrieve. type integer")
 parser.add_option("-d", type="int" , dest="day" , default='1',
                   help = "Default is to retrieve one day split into four files. ")
+parser.add_option("--end", type="string" , dest="enddate" , default=None,
+                  help = "Last day to retrieve. Format is YYYY-MM-DD. \
+                          If set then all days from the day given by -y -m -d \
+                          through this day are retrieved in one run.")
+parser.add_option("--months", type="string" , dest="months" , default=None,
+                  help = "Comma separated list of months to retrieve for the year \
+                          given by -y. e.g. 1,2,3. All days of each month are retrieved \
+                          in one run. -m and -d are ignored.")
 parser.add_option("-f", type="int" , dest="placeholder" , default='1',
                   help = "Does not do anything.")
 parser.add_option("--dir", type="string" , dest="dir" , default='./',
@@ -79,8 +97,8 @@ parser.add_option("-l", type="int" , dest="toplevel" , default= 1,
 #                          Can also choose model levels (ml). There are 137 model levels. This will retrieve grib2 file.") 
 parser.add_option("-t", type="string" , dest="leveltype" , default= "pl" ,
                   help='default is pl retrieve pressure levels. Can also use ml\
-                        for model levels. Converter for model levels is\
-                        currently not available.')
+                        for model levels. Model levels are converted with\
+                        era5arl.py and mlnew_era52arl.cfg.')
 parser.add_option("--area", type="string" , dest="area" , default= "90/-180/-90/180", 
                   help = "choose the area to extract. Format is North/West/South/East \
                           North/West gives the upper left corner of the bounding box. \
@@ -104,6 +122,9 @@ parser.add_option("--split", type="int" , dest="getfullday" , default=1,
                           4 will split the files into 6 hour increments, T1 to T4.\
                           2 will split the files into 12 hour increments, T1 to T2.\
                           If a non-valid value is entered, then 8 will be used.\
+                          0 will pick the split from the estimated size of the \
+                          requests (see --maxfields and --maxsize). Small areas may \
+                          then be retrieved with many days in one request.\
                           The reason for this is that full day grib files for\
                           the global or large area datasets may \
                           be too large to download." )
@@ -114,13 +135,98 @@ parser.add_option("-q", type="int" , dest="timeperiod" , default=-99,
 parser.add_option("--test", action="store_true" , dest="test" , default=False, 
                   help = "run tests. \
                           " )
-
+parser.add_option("--concurrent", type="int" , dest="concurrent" , default=4, 
+                  help = "{4} Maximum number of requests which are sent to the CDS \
+                          at the same time. All the retrievals for a run are \
+                          submitted at once and this limits how many are queued \
+                          or downloading together. 1 retrieves them one after another." )
+parser.add_option("--permember", action="store_true" , dest="permember" , default=False, 
+                  help = "With -s enda, retrieve each ensemble member in its own request \
+                          and file (e.g. ERA5_2017.Jan01.3denda.e3.T1.grib). The requests \
+                          run at the same time (see --concurrent) and a failed request \
+                          only affects one member." )
+parser.add_option("--maxfields", type="int" , dest="maxfields" , default=120000, 
+                  help = "{120000} Used with --split 0. Maximum number of fields \
+                          (parameters x levels x times) in one request." )
+parser.add_option("--maxsize", type="float" , dest="maxsize" , default=2000, 
+                  help = "{2000} Used with --split 0. Maximum estimated size in MB \
+                          of the file for one request." )
+parser.add_option("--coalesce", type="string" , dest="coalesce" , default='', 
+                  help = "Retrieve the surface data (--2d, --2da, --2df) for several \
+                          days in one request and split it into the daily files \
+                          afterwards. Value is number of days per request or month \
+                          for one request per month. Use with --end or --months." )
+parser.add_option("--nomanifest", action="store_false" , dest="manifest" , default=True, 
+                  help = "If set then do not use the manifest file, era5_manifest.json, \
+                          in the output directory. By default files which the manifest \
+                          shows are already complete are not retrieved again." )
+parser.add_option("--retries", type="int" , dest="retries" , default=5, 
+                  help = "{5} Maximum number of times a request is sent to the CDS. \
+                          Failed requests are sent again after a wait which doubles \
+                          after each attempt (see --backoff)." )
+parser.add_option("--backoff", type="float" , dest="backoff" , default=60, 
+                  help = "{60} Wait in seconds after the first failed attempt." )
+parser.add_option("--timeout", type="float" , dest="timeout" , default=0, 
+                  help = "{0} Maximum time in hours for one attempt including the time \
+                          waiting in the CDS queue. 0 for no limit." )
+parser.add_option("--report", action="store_true" , dest="report" , default=False, 
+                  help = "Print a summary of the timing records, era5_timing.jsonl, \
+                          in the output directory for each dataset and exit." )
+parser.add_option("--cache", type="string" , dest="cache" , default='', 
+                  help = "Directory for a cache of retrieved grib files which can be \
+                          shared between runs and users. Requests which are found in the \
+                          cache are linked or copied from it instead of retrieved from the CDS." )
+parser.add_option("--cachesize", type="float" , dest="cachesize" , default=500, 
+                  help = "{500} Maximum size of the cache in GB. The least recently \
+                          used files are removed when it is larger." )
+
+parser.add_option("--pipeline", action="store_true" , dest="pipeline" , default=False, 
+                  help = "Convert each day to ARL format with era52arl as soon as its files \
+                          are retrieved instead of after all the retrievals. \
+                          The daily ARL files are written to the --dir directory." )
+parser.add_option("--maxdays", type="int" , dest="maxdays" , default=2, 
+                  help = "{2} With --pipeline, number of days which are retrieved or converted \
+                          at the same time. This limits the disk space used by the grib files." )
+parser.add_option("--cleanup", type="string" , dest="cleanup" , default='keep', 
+                  help = "{keep} With --pipeline, what to do with the grib files of a day after \
+                          it is converted. keep, delete or gzip." )
+parser.add_option("--exe", type="string" , dest="exe" , default='', 
+                  help = "With --pipeline, the era52arl executable. Default is $MDL/era52arl \
+                          if MDL is set otherwise era52arl." )
+parser.add_option("--nproc", type="int" , dest="nproc" , default=0, 
+                  help = "With --pipeline, number of conversions at once. Default is number of cores." )
+parser.add_option("--plan", action="store_true" , dest="plan" , default=False, 
+                  help = "Print the number of requests, the fields in each request, the \
+                          size of the grib and ARL files and the disk space needed and \
+                          exit without retrieving anything. Use with --end or --months." )
+parser.add_option("--profile", type="string" , dest="profile" , default='', 
+                  help = "FILE:NAME. Profile (TOML or YAML) with the variables, levels and \
+                          time resolution to retrieve. See era5_profiles.toml and era5profile.py." )
+parser.add_option("--catchup", type="string" , dest="catchup" , default='', 
+                  help = "ARLFILE. Retrieve only the hours after the last time in ARLFILE \
+                          up to the end of the --end day or up to the latest ERA5T data \
+                          (5 days ago), convert them and append them to ARLFILE. \
+                          -y -m -d are not used. Only for the oper stream." )
+parser.add_option("--tres", type="int" , dest="tres" , default=0, 
+                  help = "Hours between the times retrieved. 1, 3 or 6. The accumulated \
+                          fields (precipitation, fluxes) are retrieved for every hour in a \
+                          separate file and added up over the tres hours by era5arl.py. \
+                          Default is the tres of the --profile or 1. Only for the oper stream." )
+parser.add_option("--store", type="string" , dest="store" , default='', 
+                  help = "Zarr store to copy the retrieved fields to (see era5store.py). \
+                          Needs zarr. Only for the oper stream." )
 
 #If no retrieval options are set then retrieve 2d data and 2d data in one file.
 (options, args) = parser.parse_args()
 if not(options.retrieve3d) and not(options.retrieve2d) and not(options.retrieve2da) and not(options.retrieve2df):
    options.retrieve3d=True
    options.retrieve2da=True
+if options.plan:
+   # nothing is written for the conversions or the messages.
+   options.grib2arl=False
+if options.cleanup not in ['keep', 'delete', 'gzip']:
+   print('--cleanup must be keep, delete or gzip')
+   sys.exit()
 if options.test:
    # do not do any retrievals.
    #options.retrieve3d=False
@@ -132,27 +238,34 @@ if options.test:
 means=False #if true retrieve mean fluxes instead of accumulated when possible.
             #some means are not available every hour so set to False.
 
+# the variables, levels and times can be set by a profile (see era5profile.py).
+profile = None
+if options.profile:
+   try:
+      pname, pdict = era5profile.get_profile(options.profile)
+      profile = era5profile.compile_profile(pdict, levtype=options.leveltype, means=means)
+   except (IOError, ValueError) as err:
+      print('Error in profile {} : {}'.format(options.profile, err))
+      sys.exit()
+   print('Using profile ' + pname)
+   options.leveltype = profile['levtype']
+
 
 #mid = open('recmwf.txt','w')
 mfilename = 'get_era5_message.txt'
+# --plan only prints. The message file of the last run is kept.
+if options.plan: mfilename = os.devnull
 
-year = options.year
-month = options.month
-day = options.day
 #monthstr = '%0*d' % (2, month)
 #daystr = '%0*d' % (2, day)
 dataset = 'era5'
 area = options.area
 grid=options.grid
-startdate = datetime.datetime(year, month, day, 0)
+# all the days to retrieve. One day unless --end or --months is set.
+datelist = era5utils.get_dates(options.year, options.month, options.day,
+                               enddate=options.enddate, months=options.months)
 #tpptstart = startdate - datetime.timedelta(hours=24)  #need to retrieve forecast variables from previous day.
 
-#tppt_datestr = tpptstart.strftime('%Y-%m-%d') 
-datestr = startdate.strftime('%Y-%m-%d') 
-yearstr = startdate.strftime('%Y')
-monthstr = startdate.strftime('%m')
-daystr = startdate.strftime('%d')
-
 ###"137 hybrid sigma/pressure (model) levels in the vertical with the top level at 0.01hPa. Atmospheric data are
 ###available on these levels and they are also interpolated to 37 pressure, 16 potential temperature and 1 potential vorticity level(s).
 ##model level fields are in grib2. All other fields (including pressure levels) are in grib1 format.
@@ -176,46 +289,88 @@ else:
    wtype="reanalysis" 
    precip='TPP1'  #normally precip accumulated over 1 hour.
 
+# hours between the times. The accumulated fields are added up over tres hours.
+tres = options.tres
+if not tres:
+   tres = profile['tres'] if profile else 1
+if tres > 1:
+   if stream != 'oper':
+      print('--tres is only for the oper stream')
+      sys.exit()
+   try:
+      precip = era5utils.precip_name(tres)
+   except ValueError as err:
+      print(err)
+      sys.exit()
+   if options.retrieve2da:
+      # the accumulations are needed for every hour so they are in their own file.
+      options.retrieve2da = False
+      options.retrieve2d = True
+      options.retrieve2df = True
+
+# with --catchup only the hours missing from the end of an ARL file are retrieved.
+catchup = None
+if options.catchup:
+   if stream != 'oper':
+      print('--catchup is only for the oper stream')
+      sys.exit()
+   if not os.path.isfile(options.catchup):
+      print('--catchup file not found ' + options.catchup)
+      sys.exit()
+   lasttime = arlreader.last_time(options.catchup)
+   if lasttime is None:
+      print('No time periods in ' + options.catchup)
+      sys.exit()
+   catchup = era5utils.catchup_range(lasttime, enddate=options.enddate, step=tres)
+   if catchup is None:
+      print('{} is up to date. Last time {}'.format(options.catchup, lasttime))
+      sys.exit()
+   print('Catching up {} from {} to {}'.format(options.catchup, catchup[0], catchup[1]))
+   datelist = era5utils.get_dates(catchup[0].year, catchup[0].month, catchup[0].day,
+                                  enddate=catchup[1].strftime('%Y-%m-%d'))
+   # the new hours are appended to the file after they are all converted.
+   options.pipeline = False
+
+if not datelist:
+   print('No days to retrieve. Check --end and the start date.')
+   sys.exit(1)
+
+if options.store:
+   if stream != 'oper':
+      print('--store is only for the oper stream')
+      sys.exit()
+   if options.pipeline and options.cleanup != 'keep':
+      print('--store can not be used with --cleanup {}'.format(options.cleanup))
+      sys.exit()
+   import era5store
+
 
 ##Pick pressure levels to retrieve. ################################################################
 ##Can only pick a top level 
 if levtype == "pl" or levtype=='enda':
-    levs = list(range(750,1025,25)) + list(range(300,750,50)) + list(range(100,275,25)) + [1,2,3,5,7,10,20,30,50,70]
-    levs = sorted(levs, reverse=True)
-    if options.toplevel != 1: 
-       levs = [y for y in levs if y>=options.toplevel]
-       levs = sorted(levs, reverse=True)
-       levstr = str(levs[0])
-    else:
-       levstr = ''
-    for lv in levs[1:]:
-       levstr += '/' + str(lv)  
+    levs = era5utils.pressure_levels(options.toplevel)
 #Retrieve all model levels. Modify this if need only certain model levels.
 #May need level one since it has geopotential.
 elif levtype=='ml':
-    ##pakset header will not work with 137 levels right now.
-    ##use every other level.
-    #step=2
-    step=1
-    ##level 40 is about 24.5 km. Level 137 is 10 m
-    ##level 49 is about 20 km.
-    ##level 67 is about 14 km.
-    ##level 80 is about 10 km.
-    ##level 60 is about 16km or 100mb.
-    #levstart = 60
-    levstart = 1
-    ##HYSPLIT cannot currently handle more than 74 levels due to
-    ##limitations in the length of the header file.   
-    #levstart = 64   
-    
-    levstr = "/".join(map(str, list(range(levstart,138,1))))
-    #levstr = "/".join(map(str, list(range(1,137,1))))
-    levs = list(range(levstart,138,1))
-    cfglevs = list(range(levstart,138,step))
+    ##HYSPLIT cannot use all 137 levels because of the length of the index record.
+    ##model_levels_default is every level from 137 (about 10 m) to 26 and
+    ##a few levels up to about 1 hPa.
+    cfglevs = era5utils.model_levels_default()
+    ##lnsp and z are only on level 1 and are needed to compute pressure and heights.
+    levs = sorted(set(cfglevs + [1]))
     # need to be written from bottom level (137) to top for era52arl.cfg
-    cfglevs = cfglevs[::-1]
+    cfglevs = sorted(cfglevs, reverse=True)
 else:
     levs = []
+if profile and profile['levs']:
+    if levtype=='ml':
+       cfglevs = profile['levs']
+       levs = sorted(set(cfglevs + [1]))
+    else:
+       levs = profile['levs']
+# decoding configuration file written by era5utils.write_cfg.
+cfgname = 'new_era52arl.cfg'
+if levtype=='ml': cfgname = 'mlnew_era52arl.cfg'
 ##########################################################################################
 
 
@@ -223,77 +378,21 @@ else:
 options.dir = options.dir.replace('\"', '')
 if options.dir[-1] != '/':
    options.dir += '/'
-
-if options.fname =='':
-   dstr = startdate.strftime('%Y.%b%d')
-   dstr2 = startdate.strftime('%Y%b')
-   f3d = dataset.upper() + '_' + dstr +  '.3d'
-   f2d = dataset.upper() + '_' + dstr +  '.2d'
-   ftppt = dataset.upper() + '_' + dstr +   '.2df'
-else:    
-   f3d = options.dir + options.fname  + '.3d'
-   f2d = options.dir + options.fname  + '.2d'
-   ftppt = options.dir + options.fname  + '.2df'
-   
-if levtype == 'ml':
-   f3d += '.ml'
- 
-file3d = options.dir + f3d
-file2d = options.dir + f2d
-filetppt = options.dir + ftppt
-
-#server = ECMWFDataServer(verbose=False)
-server=cdsapi.Client()
+if not os.path.isdir(options.dir) and not options.plan:
+   os.makedirs(options.dir)
+
+# one json record with the timing of each retrieval is written here.
+timingfile = options.dir + 'era5_timing.jsonl'
+if options.report:
+   for line in era5timing.summarize(era5timing.read_records(timingfile)):
+       print(line)
+   sys.exit()
 
 ##wtype = "4v"   ##4D variational analysis is available as well as analysis.
 
 #wtype="an" 
 #wtype="reanalysis" 
 
-if stream == 'oper':
-##need to break each day into four time periods to keep 3d grib files at around 1.6 GB
-    #wtime1 =  "00:00/01:00/02:00/03:00/04:00/05:00"
-    #wtime2 =  "06:00/07:00/08:00/09:00/10:00/11:00"
-    #wtime3 =  "12:00/13:00/14:00/15:00/16:00/17:00"
-    #wtime4 =  "18:00/19:00/20:00/21:00/22:00/23:00"
-
-    wtime1 =  "00:00/01:00/02:00"
-    wtime2 =  "03:00/04:00/05:00"
-    wtime3 =  "06:00/07:00/08:00"
-    wtime4 =  "09:00/10:00/11:00"
-    wtime5 =  "12:00/13:00/14:00"
-    wtime6 =  "15:00/16:00/17:00"
-    wtime7 =  "18:00/19:00/20:00"
-    wtime8 =  "21:00/22:00/23:00"
-    wtimelist = [wtime1, wtime2, wtime3, wtime4,wtime5,wtime6,wtime7,wtime8]
-
-    if options.getfullday==1:
-       wtimelist = [str.join('/', wtimelist)]
-
-    elif options.getfullday==4:
-       wt1 = str.join('/', [wtime1,wtime2])  
-       wt2 = str.join('/', [wtime3,wtime4])  
-       wt3 = str.join('/', [wtime5,wtime6])  
-       wt4 = str.join('/', [wtime7,wtime8])  
-       wtimelist = [wt1,wt2, wt3, wt4]
-
-    elif options.getfullday==2:
-       wt1 = str.join('/', [wtime1,wtime2,wtime3,wtime4])  
-       wt2 = str.join('/', [wtime5,wtime6,wtime7,wtime8])  
-       wtimelist = [wt1,wt2]
-
-    elif options.getfullday==24:
-       wtimelist = []
-       for iii in range(0,24):
-           wtimelist.append(str(iii).zfill(2) + ':00')
-    else:
-       wtimelist = [wtime1, wtime2, wtime3, wtime4,wtime5,wtime6,wtime7,wtime8]
-
-    #wtimelist = [wtime1]
-#ensemble data only availabe every 3 hours.
-elif stream == 'enda':
-    wtime1 =  "00:00/03:00/06:00/09:00/12:00/15:00/18:00/21:00"
-    wtimelist = [wtime1]
 
 #print(options.getfullday)
 #print(wtimelist)
@@ -335,256 +434,474 @@ elif stream == 'enda':
 
 
 #grid: 0.3/0.3: "For era5 data, the point interval on the native Gaussian grid is about 0.3 degrees. 
-#You should set the horizontal resolution no higher than 0.3x0.3 degrees (about 30 km), approximating the irregular grid spacing
 #on the native Gaussian grid.
 
-f3list =[]
-f2list =[]
-f2flist = []
-
-iii=1
-###SPLIT retrieval into four time periods so files will be smaller.
-for wtime in wtimelist:
-    if options.getfullday!=1 and options.timeperiod!=-99 and options.timeperiod!=iii: 
-       print('Skipping time period T', str(iii))
-       iii+=1
-       continue
-    print("Retrieve for: " , datestr, wtime)
-    #print wtime
-    if options.getfullday==1:
-        tstr =  '.grib'
-    else:
-        tstr = '.T' + str(iii) + '.grib'
-    timelist = wtime.split('/')
-    ###need to set the grid parameter otherwise will not be on regular grid and converter will not handle.
-    ####retrieving 3d fields
-    if levtype=='pl':
-       param3d = ['TEMP' , 'UWND', 'VWND' , 'WWND' , 'RELH','HGTS' ]
-       rstr = 'reanalysis-era5-pressure-levels'
-       estr='pl'
-    elif levtype=='ml':
-       param3d = ['TEMP' , 'UWND', 'VWND' , 'WWND' , 'SPHU', 'HGTS','LNSP']
-       rstr = 'reanalysis-era5-complete'
-       estr='ml'
-    elif levtype=='enda':
-       param3d = ['TEMP' , 'UWND', 'VWND' , 'WWND' , 'RELH' , 'HGTS' ]
-       rstr = 'reanalysis-era5-complete'
-       estr='enda'
-    f3list.append(file3d+ estr + tstr)
-    if options.retrieve3d:
-        print( 'RETRIEVING 3d {} {}'.format(levtype, ' '.join(param3d)))
-        levs = list(map(str, levs))
-        print('Retrieve levels ' , levs)
-        paramstr = era5utils.createparamstr(param3d, means=means, levtype=levtype)
-        with open(mfilename, 'w') as mid: 
-            mid.write('retrieving 3d data \n')
-            mid.write(paramstr + '\n')
-            mid.write('time ' + wtime + '\n')
-            mid.write('type ' + wtype + '\n')
-            mid.write('date ' + datestr + '\n')
-            mid.write('-------------------\n')
-        if options.run and levtype=='pl':
-            server.retrieve(rstr,
-                    {
-                    'variable'      :  paramstr.split('/'),
-                    'pressure_level':  levs,
-                    'product_type'  :  wtype,
-                    'year'          : yearstr,
-                    'month'         : monthstr,
-                    'day'           : daystr,
-                    'time'          : timelist,
-                    'grid'    : grid,
-                    'area'    : area,
-                    'format'        : 'grib'
-                    },
-                     file3d + estr + tstr)
-        if options.run and levtype=='ml':
-            rstr = 'reanalysis-era5-complete'
-            #paramstr='129/130/131/132/135'
-            print(paramstr)
-            print(datestr)
-            #wtime = '09:00:00/21:00:00'
-            print(wtime)
-            levs = '/'.join(levs) 
-            print(levs)
-            print('---------------------')
-            server.retrieve(rstr,
-                    {
-                    'class'    : 'ea',
-                    'date'     :  datestr,
-                    'levtype'  : 'ml',    
-                    'expver'   : '1',
-                    'area'     : area,
-                    'grid'    : grid,
-                    'levelist' :  levs,
-                    'stream'   : 'oper',
-                    'type'     : 'an',
-                    'param'    :  paramstr,
-                    'time'     :  wtime,
-                    'step'     : '0',
-                    },
-                     'out.grib')
-
-            #server.retrieve('reanalysis-era5-complete', {
-            #    'class': 'ea',
-            #    'date': '2022-08-01',
-            #    'expver': '1',
-            #    'levelist': '1/2/3/4/5/6/7/8/9/10/11/12/13/14/15/16/17/18/19/20/21/22/23/24/25/26/27/28/29/30/31/32/33/34/35/36/37/38/39/40/41/42/43/44/45/46/47/48/49/50/51/52/53/54/55/56/57/58/59/60/61/62/63/64/65/66/67/68/69/70/71/72/73/74/75/76/77/78/79/80/81/82/83/84/85/86/87/88/89/90/91/92/93/94/95/96/97/98/99/100/101/102/103/104/105/106/107/108/109/110/111/112/113/114/115/116/117/118/119/120/121/122/123/124/125/126/127/128/129/130/131/132/133/134/135/136/137',
-            #    'levtype': 'ml',
-            #    'param': paramstr,
-            #    'step': '0',
-            #    'stream': 'oper',
-            #    'time': wtime,
-            #    'type': 'an',
-            #}, 'output')
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-        if options.run and levtype=='enda':
-            paramstr = era5utils.createparamstr(param3d, means=means, levtype='enda')
-            server.retrieve(rstr,
-                    {
-                    'class'    : 'ea',
-                    'expver'   : 'l',
-                    'dataset'  : 'era5',
-                    'stream'   : 'enda',
-                    'type'     : 'an',
-                    'levtype'  : 'pl',    #TODO is there ensemble data on ml?
-                    'param'    : paramstr,
-                    'origin'   : "all",
-                    'levelist' :  levs,
-                    'date'     : datestr,
-                    'time'     : wtime,
-                    'grid'     : grid,
-                    'area'     : area,
-                    'format'   : 'grib',
-                    'number'   : '0/1/2/3/4/5/6/7/8/9'
-                    },
-                     file3d + estr + tstr)
-                 
-                 
-    ##The surface variables can be retrieved in the same file with CDS.
-    ##This was not the case with the ecmwf api.
-    ##For CDSAPI the year month day and time are the validityDate and validityTime.
-    # moved USTR to the extra variables. There is something a bit odd about it. 
-    # seems to undermix - too small in the daytime.
-    pextra = ['UMOF','VMOF','DP2M','TCLD','USTR']
-    pextraf = ['RGHS']
-    #param2da = ['T02M', 'V10M', 'U10M', 'PRSS','PBLH', 'CAPE', 'SHGT']
-    # need 'SHGT' for model levels.
-    param2da = ['T02M', 'V10M', 'U10M', 'PRSS','PBLH', 'CAPE','SHGT','MSLP']
-    param2df = [precip, 'SHTF' , 'DSWF', 'LTHF']
-   
-    if options.extra:
-       param2da.extend(pextra)
-       param2df.extend(pextraf)
-    if options.retrieve2da: 
-       param2da.extend(param2df)
-       estr += '.all'
-    ####retrieving 2d fields
-    f2list.append(file2d+estr+tstr)
-    if options.retrieve2d or options.retrieve2da:
-        print( 'RETRIEVING 2d ' + ' '.join(param2da) )
-        ##levtype for 2d is always pl for creating paramstr purposes.
-        ##levtype for 2d is always pl for creating paramstr purposes.
-        #paramstr = createparamstr(param2da, means=means, levtype=levtype)
-        if options.run and levtype!='enda':
-            paramstr = era5utils.createparamstr(param2da, means=means, levtype='pl')
-            print('Retrieving surface data')
-            server.retrieve('reanalysis-era5-single-levels',
-                        {
-                         'product_type' : wtype,
-                         'variable' : paramstr.split('/'),
-                         'year'     : yearstr,
-                         'month'    : monthstr,
-                         'day'      : daystr,
-                         'time'     : timelist,
-                         'area'     : area,
-                         'format'   : 'grib',
-                         'grid'    :grid 
-                         },
-                          file2d + estr + tstr)
-        if options.run and levtype=='enda':
+###need to set the grid parameter otherwise will not be on regular grid and converter will not handle.
+####3d fields
+if levtype=='pl':
+   param3d = ['TEMP' , 'UWND', 'VWND' , 'WWND' , 'RELH','HGTS' ]
+   rstr = 'reanalysis-era5-pressure-levels'
+   estr='pl'
+elif levtype=='ml':
+   param3d = ['TEMP' , 'UWND', 'VWND' , 'WWND' , 'SPHU', 'HGTS','LNSP']
+   rstr = 'reanalysis-era5-complete'
+   estr='ml'
+elif levtype=='enda':
+   param3d = ['TEMP' , 'UWND', 'VWND' , 'WWND' , 'RELH' , 'HGTS' ]
+   rstr = 'reanalysis-era5-complete'
+   estr='enda'
+# levels as strings for the requests.
+levlist = list(map(str, levs))
+
+##The surface variables can be retrieved in the same file with CDS.
+##This was not the case with the ecmwf api.
+##For CDSAPI the year month day and time are the validityDate and validityTime.
+# moved USTR to the extra variables. There is something a bit odd about it. 
+# seems to undermix - too small in the daytime.
+pextra = ['UMOF','VMOF','DP2M','TCLD','USTR']
+pextraf = ['RGHS']
+#param2da = ['T02M', 'V10M', 'U10M', 'PRSS','PBLH', 'CAPE', 'SHGT']
+# need 'SHGT' for model levels.
+param2da = ['T02M', 'V10M', 'U10M', 'PRSS','PBLH', 'CAPE','SHGT','MSLP']
+param2df = [precip, 'SHTF' , 'DSWF', 'LTHF']
+if profile:
+   if profile['param3d'] is not None: param3d = profile['param3d']
+   if profile['param2da'] is not None: param2da = profile['param2da']
+   if profile['param2df'] is not None:
+      # TPP1 is the precipitation over the time resolution (TPP3 for the ensemble).
+      param2df = [precip if x in ['TPP1', 'TPP3'] else x for x in profile['param2df']]
+
+if options.extra:
+   param2da.extend(pextra)
+   param2df.extend(pextraf)
+estr2d = estr
+if options.retrieve2da: 
+   param2da.extend(param2df)
+   estr2d += '.all'
+
+# the parameter strings only need to be created once.
+paramstr3d = era5utils.createparamstr(param3d, means=means, levtype=levtype)
+if levtype == 'enda':
+   ##levtype for 2d is always pl for creating paramstr purposes except for the ensemble.
+   paramstr2d = era5utils.createparamstr(param2da, means=False, instant=True,levtype='enda')
+else:
+   paramstr2d = era5utils.createparamstr(param2da, means=means, levtype='pl')
+paramstr2df = era5utils.createparamstr(param2df, means=means,levtype='pl')
+
+
+def request_templates():
+    """returns dictionary with the parts of the requests which are the same for
+       every day and time period. The variables and levels (from the profile or
+       the defaults) are compiled into them once. day_retrievals adds the date,
+       the times and the ensemble member to a copy.
+    """
+    sfc = {'product_type': wtype, 'area': area, 'format': 'grib', 'grid': grid}
+    templates = {'2d' : dict(sfc, variable=paramstr2d.split('/')),
+                 '2df': dict(sfc, variable=paramstr2df)}
+    if levtype == 'pl':
+       templates['3d'] = dict(sfc, variable=paramstr3d.split('/'), pressure_level=levlist)
+    elif levtype == 'ml':
+       templates['3d'] = {'class': 'ea', 'levtype': 'ml', 'expver': '1', 'area': area,
+                          'grid': grid, 'levelist': '/'.join(levlist), 'stream': 'oper',
+                          'type': 'an', 'param': paramstr3d, 'step': '0'}
+    elif levtype == 'enda':
+       enda = {'class': 'ea', 'expver': 'l', 'dataset': 'era5', 'stream': 'enda', 'type': 'an',
+               'origin': 'all', 'levelist': levlist, 'grid': grid, 'area': area, 'format': 'grib'}
+       templates['3d'] = dict(enda, levtype='pl', param=paramstr3d)
+       templates['2d'] = dict(enda, levtype='sfc', param=paramstr2d)
+    return templates
+
+templates = request_templates()
+
+##Pick how the retrievals are split. ###################################################
+# number of days retrieved in one request for the 3d and the surface files.
+days3d = 1
+days2d = 1
+if options.coalesce == 'month':
+   days2d = 31
+elif options.coalesce:
+   days2d = int(options.coalesce)
+nx, ny = era5utils.grid_size(area, grid)
+nmembers = 1
+if stream == 'enda': nmembers = 10
+# number of ensemble members in one request.
+rmembers = nmembers
+if options.permember: rmembers = 1
+if options.getfullday == 0:
+   # estimate the size of each request and pick the largest one which is
+   # under the limits.
+   maxbytes = options.maxsize * 1e6
+   options.getfullday, days3d = era5utils.choose_chunks(len(param3d)*len(levs)*rmembers,
+                                nx, ny, options.maxfields, maxbytes)
+   nsfc = len(param2da)
+   if options.retrieve2df and not options.retrieve2da: nsfc = max(nsfc, len(param2df))
+   split2d, ndays = era5utils.choose_chunks(nsfc*rmembers, nx, ny, options.maxfields, maxbytes)
+   if not options.coalesce: days2d = ndays
+   # only the pressure level and single level datasets can retrieve several days at once.
+   if levtype != 'pl':
+      days3d = 1
+      days2d = 1
+   print('Grid {} x {}. Splitting day into {} time periods. {} days per 3d request. {} days per 2d request'.format(
+          nx, ny, options.getfullday, days3d, days2d))
+wtimelist = era5utils.get_timelist(options.getfullday, stream)
+wtimelist = era5utils.thin_timelist(wtimelist, tres)
+
+
+def expected(paramstr, nlevs, ntimes, ndays=1):
+    """returns the number of messages and the grid size expected in the file
+       for a request. Each file is checked against this when it is downloaded.
+    """
+    nmsg = len(paramstr.split('/')) * nlevs * rmembers * ntimes * ndays
+    return {'messages': nmsg, 'nx': nx, 'ny': ny}
+
+
+def expected_ml(paramstr, nlevs, ntimes):
+    """same as expected for the model levels. lnsp and z are only on level 1.
+    """
+    nparam = len(paramstr.split('/'))
+    nsingle = len([x for x in paramstr.split('/') if x in ['152', '129']])
+    nmsg = ((nparam - nsingle) * nlevs + nsingle) * ntimes
+    return {'messages': nmsg, 'nx': nx, 'ny': ny}
+
+
+def enda_members():
+    """returns list of (number, string added to the file name) for the ensemble requests.
+       With --permember there is one request for each member.
+    """
+    numbers = list(map(str, range(nmembers)))
+    if options.permember:
+        return [(x, '.e' + x) for x in numbers]
+    return [('/'.join(numbers), '')]
+
+
+def get_filenames(startdate):
+    """returns the file name stems for the 3d, 2d and 2df files and the
+       string used to name the shell script.
+    """
+    dstr = startdate.strftime('%Y.%b%d')
+    dstr2 = startdate.strftime('%Y%b')
+    if options.fname =='':
+       f3d = dataset.upper() + '_' + dstr +  '.3d'
+       f2d = dataset.upper() + '_' + dstr +  '.2d'
+       ftppt = dataset.upper() + '_' + dstr +   '.2df'
+    else:    
+       fname = options.fname
+       # need a different name for each day when retrieving more than one day.
+       if len(datelist) > 1: fname += '.' + dstr
+       f3d = fname  + '.3d'
+       f2d = fname  + '.2d'
+       ftppt = fname  + '.2df'
+    file3d = options.dir + f3d
+    file2d = options.dir + f2d
+    filetppt = options.dir + ftppt
+    return file3d, file2d, filetppt, dstr2
+
+
+def day_retrievals(startdate):
+    """adds the retrievals for one day to the retrievals list.
+    """
+    datestr = startdate.strftime('%Y-%m-%d') 
+    yearstr = startdate.strftime('%Y')
+    monthstr = startdate.strftime('%m')
+    daystr = startdate.strftime('%d')
+    file3d, file2d, filetppt, dstr2 = get_filenames(startdate)
+
+    ###SPLIT retrieval into four time periods so files will be smaller.
+    # iii is the number of the time period in the day. See era5utils.thin_timelist.
+    for iii, wtime in wtimelist:
+        if options.getfullday!=1 and options.timeperiod!=-99 and options.timeperiod!=iii: 
+           print('Skipping time period T', str(iii))
+           continue
+        if catchup:
+           # only the hours which are not in the ARL file yet.
+           wtime = era5utils.catchup_times(wtime, startdate, catchup)
+           if not wtime:
+              continue
+        print("Retrieve for: " , datestr, wtime)
+        #print wtime
+        if options.getfullday==1:
+            tstr =  '.grib'
+        else:
+            tstr = '.T' + str(iii) + '.grib'
+        timelist = wtime.split('/')
+        ####retrieving 3d fields
+        if options.retrieve3d:
+            print( 'RETRIEVING 3d {} {}'.format(levtype, ' '.join(param3d)))
+            print('Retrieve levels ' , levlist)
+            with open(mfilename, 'a') as mid: 
+                mid.write('retrieving 3d data \n')
+                mid.write(paramstr3d + '\n')
+                mid.write('time ' + wtime + '\n')
+                mid.write('type ' + wtype + '\n')
+                mid.write('date ' + datestr + '\n')
+                mid.write('-------------------\n')
+            if options.run and levtype=='pl' and days3d > 1:
+                # retrieved with the other days in coalesced_retrievals.
+                coalesce_days.append({'name':rstr, 'request':templates['3d'],
+                                      'kind':'3d', 'date':startdate, 'time':timelist, 'ndays':days3d,
+                                      'target':file3d + estr + tstr, 'stem':file3d + estr,
+                                      'expect':expected(paramstr3d, len(levlist), 1)})
+            elif options.run and levtype=='pl':
+                retrievals.append(era5retrieve.make_retrieval(rstr,
+                        dict(templates['3d'], year=yearstr, month=monthstr, day=daystr,
+                             time=timelist),
+                         file3d + estr + tstr,
+                         expect=expected(paramstr3d, len(levlist), len(timelist))))
+            if options.run and levtype=='ml':
+                #paramstr='129/130/131/132/135'
+                print(paramstr3d)
+                print(datestr)
+                #wtime = '09:00:00/21:00:00'
+                print(wtime)
+                print('---------------------')
+                retrievals.append(era5retrieve.make_retrieval(rstr,
+                        dict(templates['3d'], date=datestr, time=wtime),
+                         file3d + estr + tstr,
+                         expect=expected_ml(paramstr3d, len(levlist), len(timelist))))
+
+            if options.run and levtype=='enda':
+                for number, mstr in enda_members():
+                    #TODO is there ensemble data on ml?
+                    retrievals.append(era5retrieve.make_retrieval(rstr,
+                            dict(templates['3d'], date=datestr, time=wtime, number=number),
+                             file3d + estr + mstr + tstr,
+                             expect=expected(paramstr3d, len(levlist), len(timelist))))
+
+        ####retrieving 2d fields
+        if options.retrieve2d or options.retrieve2da:
             print( 'RETRIEVING 2d ' + ' '.join(param2da) )
-            ### TESTING HERE
-            #paramstr =\
-            #         createparamstr(['LTHF','SHTF','TPP3'],means=True,levtype='enda',instant=False)  
-            paramstr = era5utils.createparamstr(param2da, means=False, instant=True,levtype='enda')
-            print('Retrieving ensemble. heat fluxes and precip not available.')
-            print( paramstr )
-            rstr = 'reanalysis-era5-complete'
-            server.retrieve(rstr,
-                    {
-                    'class'    : 'ea',
-                    'expver'   : 'l',
-                    'dataset'  : 'era5',
-                    'stream'   : 'enda',
-                    'type'     : 'an',
-                    'levtype'  : 'sfc',    
-                    'param'    : paramstr,
-                    'origin'   : "all",
-                    'levelist' :  levs,
-                    'date'     : datestr,
-                    'time'     : wtime,
-                    'grid'     : grid,
-                    'area'     : area,
-                    'format'   : 'grib',
-                    'number'   : '0/1/2/3/4/5/6/7/8/9'
-                    },
-                     file2d + estr + tstr)
-        with open(mfilename, 'a') as mid: 
-            mid.write('retrieving 2d data \n')
-            mid.write(paramstr + '\n')
-            mid.write('time ' + wtime + '\n')
-            mid.write('type ' + wtype + '\n')
-            mid.write('date ' + datestr + '\n')
-            mid.write('-------------------\n')
-                 
-    if options.retrieve2df:
-        paramstr = era5utils.createparamstr(param2df, means=means,levtype='pl')
-        if options.run:
-            server.retrieve('reanalysis-era5-single-levels',
-                        {
-                         'product_type' : wtype,
-                         'variable' : paramstr,
-                         'year'     : yearstr,
-                         'month'    : monthstr,
-                         'day'      : daystr,
-                         'time'     : timelist,
-                         'area'     : area,
-                         'format'   : 'grib',
-                         'grid'    : grid
-                         },
-                          filetppt + estr + tstr)
-
-    shfiles = list(zip(f3list, f2list)) 
-    if options.grib2arl:
-       sname = options.dir + dstr2 + '_ecm2arl.sh'
-       era5utils.grib2arlscript(sname, shfiles, startdate, 'T'+str(iii)) 
-    iii+=1
-
-
-#param2da.extend(param2df)
+            if options.run and levtype!='enda' and days2d > 1:
+                # retrieved with the other days in coalesced_retrievals.
+                coalesce_days.append({'name':'reanalysis-era5-single-levels',
+                                      'request':templates['2d'],
+                                      'kind':'2d', 'date':startdate, 'time':timelist, 'ndays':days2d,
+                                      'target':file2d + estr2d + tstr, 'stem':file2d + estr2d,
+                                      'expect':expected(paramstr2d, 1, 1)})
+            elif options.run and levtype!='enda':
+                print('Retrieving surface data')
+                retrievals.append(era5retrieve.make_retrieval('reanalysis-era5-single-levels',
+                            dict(templates['2d'], year=yearstr, month=monthstr, day=daystr,
+                                 time=timelist),
+                              file2d + estr2d + tstr,
+                              expect=expected(paramstr2d, 1, len(timelist))))
+            if options.run and levtype=='enda':
+                ### TESTING HERE
+                #paramstr =\
+                #         createparamstr(['LTHF','SHTF','TPP3'],means=True,levtype='enda',instant=False)  
+                print('Retrieving ensemble. heat fluxes and precip not available.')
+                print( paramstr2d )
+                for number, mstr in enda_members():
+                    retrievals.append(era5retrieve.make_retrieval('reanalysis-era5-complete',
+                            dict(templates['2d'], date=datestr, time=wtime, number=number),
+                             file2d + estr2d + mstr + tstr,
+                             expect=expected(paramstr2d, 1, len(timelist))))
+            with open(mfilename, 'a') as mid: 
+                mid.write('retrieving 2d data \n')
+                mid.write(paramstr2d + '\n')
+                mid.write('time ' + wtime + '\n')
+                mid.write('type ' + wtype + '\n')
+                mid.write('date ' + datestr + '\n')
+                mid.write('-------------------\n')
+                     
+        # hours of the accumulations on this day and on the day before.
+        ftimes, prevtimes = timelist, []
+        if options.retrieve2df and tres > 1:
+            ftimes, prevtimes = era5utils.accumulation_times(wtime, tres)
+        if options.retrieve2df:
+            if options.run and days2d > 1:
+                coalesce_days.append({'name':'reanalysis-era5-single-levels',
+                                      'request':templates['2df'],
+                                      'kind':'2df', 'date':startdate, 'time':ftimes, 'ndays':days2d,
+                                      'target':filetppt + estr2d + tstr, 'stem':filetppt + estr2d,
+                                      'expect':expected(paramstr2df, 1, 1)})
+            elif options.run:
+                retrievals.append(era5retrieve.make_retrieval('reanalysis-era5-single-levels',
+                            dict(templates['2df'], year=yearstr, month=monthstr, day=daystr,
+                                 time=ftimes),
+                              filetppt + estr2d + tstr,
+                              expect=expected(paramstr2df, 1, len(ftimes))))
+            if options.run and prevtimes:
+                # the hours before 00 are on the day before.
+                prevday = startdate - datetime.timedelta(days=1)
+                retrievals.append(era5retrieve.make_retrieval('reanalysis-era5-single-levels',
+                            dict(templates['2df'], year=prevday.strftime('%Y'),
+                                 month=prevday.strftime('%m'), day=prevday.strftime('%d'),
+                                 time=prevtimes),
+                              filetppt + estr2d + '.prev' + tstr,
+                              expect=expected(paramstr2df, 1, len(prevtimes))))
+
+        shfiles = [(file3d + estr + tstr, file2d + estr2d + tstr)]
+        if levtype=='enda':
+           # one pair of files for each member with --permember.
+           shfiles = [(file3d + estr + mstr + tstr, file2d + estr2d + mstr + tstr)
+                      for number, mstr in enda_members()]
+        if options.retrieve2df and tres > 1:
+           # era5arl.py adds up the hourly accumulations in the forecast files.
+           ffiles = [filetppt + estr2d + tstr]
+           if prevtimes: ffiles.append(filetppt + estr2d + '.prev' + tstr)
+           shfiles = [tuple(list(shfiles[0]) + ffiles)]
+        if options.pipeline or catchup or options.store:
+           jobs.extend(era5utils.arljobs(shfiles, startdate, 'T'+str(iii), tres=tres,
+                                         levtype=levtype, cfgname=cfgname))
+        if options.grib2arl:
+           sname = options.dir + dstr2 + '_ecm2arl.sh'
+           # all the ensemble members are converted in one pass with era5arl.py.
+           # files with one member (--permember) are converted with era52arl.
+           era5utils.grib2arlscript(sname, shfiles, startdate, 'T'+str(iii),
+                                    members=nmembers if rmembers > 1 else 0,
+                                    cfgname=cfgname if levtype=='ml' or tres > 1 or rmembers > 1 else None,
+                                    tres=tres)
+           # same conversions for era5convert.py which runs them in parallel.
+           era5utils.grib2arljobs(options.dir + dstr2 + '_ecm2arl.json', shfiles, startdate, 'T'+str(iii),
+                                  tres=tres, levtype=levtype, cfgname=cfgname)
+
+
+def coalesced_retrievals(coalesce_days):
+    """combines the retrievals for several days into one request.
+       The days are grouped by month and then into chunks of ndays days.
+       The combined file is split into the daily files after it is retrieved.
+    """
+    groups = {}
+    for cds in coalesce_days:
+        sdate = cds['date']
+        key = (cds['kind'], cds['name'], sdate.year, sdate.month,
+               (sdate.day-1)//cds['ndays'])
+        groups.setdefault(key, []).append(cds)
+    rlist = []
+    for key in sorted(groups.keys()):
+        days = sorted(set(x['date'] for x in groups[key]))
+        times = sorted(set(t for x in groups[key] for t in x['time']))
+        split = {}
+        for cds in groups[key]:
+            for tm in cds['time']:
+                split[cds['date'].strftime('%Y%m%d') + tm[0:2]] = cds['target']
+        # stem of first day with the last day added.
+        first = [x for x in groups[key] if x['date'] == days[0]][0]
+        target = first['stem'] + '.' + days[0].strftime('%d') + '-' + days[-1].strftime('%d') + '.grib'
+        print('Retrieving {} days in one request {}'.format(len(days), target))
+        request = dict(first['request'])
+        request['year'] = days[0].strftime('%Y')
+        request['month'] = days[0].strftime('%m')
+        request['day'] = [x.strftime('%d') for x in days]
+        request['time'] = times
+        # expect holds the number of messages for one time of one day.
+        expect = dict(first['expect'])
+        expect['pertime'] = expect['messages']
+        expect['messages'] *= len(days) * len(times)
+        rlist.append(era5retrieve.make_retrieval(first['name'], request, target, split=split,
+                                                 expect=expect))
+    return rlist
+
+
+# start a new message file for this run.
+with open(mfilename, 'w') as mid:
+    mid.write('retrieving {} days {} to {}\n'.format(len(datelist),
+              datelist[0].strftime('%Y-%m-%d'), datelist[-1].strftime('%Y-%m-%d')))
+
+#server = ECMWFDataServer(verbose=False)
+# list of retrievals which are all submitted to the server at the end.
+retrievals = []
+# retrievals which are combined into one request for several days.
+coalesce_days = []
+# conversions for --pipeline and --catchup. files for --store.
+jobs = []
+for startdate in datelist:
+    day_retrievals(startdate)
+if coalesce_days:
+    retrievals.extend(coalesced_retrievals(coalesce_days))
+
 #write a cfg file for the converter.
+#written before the retrievals since --pipeline uses it.
 tm=1
 if stream=='enda': tm=3
+if tres > 1: tm=tres
 if options.retrieve2df and not options.retrieve2da:
    param2da.extend(param2df)
 if levtype=='ml': levs=cfglevs
+
+if options.plan:
+   # print the size of the run and stop before anything is retrieved.
+   ptimes = [wtime for iii, wtime in wtimelist]
+   if options.getfullday!=1 and options.timeperiod!=-99:
+      ptimes = [wtime for iii, wtime in wtimelist if iii==options.timeperiod]
+   ntimes = sum(len(x.split('/')) for x in ptimes)
+   nrec = era5plan.arl_records(param3d, param2da, len(levs))
+   arlbytes = era5plan.arl_bytes(nrec, nx, ny, ntimes) * nmembers
+   for line in era5plan.plan(retrievals, len(datelist), arlbytes, options.maxfields,
+                             options.maxsize*1e6, pipeline=options.pipeline,
+                             maxdays=options.maxdays):
+       print(line)
+   sys.exit()
+
 era5utils.write_cfg(param3d, param2da, levs, tm=tm, levtype=levtype)
 
+# one client is used for all the retrievals.
+server=cdsapi.Client()
+# the manifest records which files are complete so that reruns skip them.
+if options.manifest:
+   manifest = era5manifest.Manifest(options.dir + 'era5_manifest.json')
+else:
+   manifest = None
+if options.cache:
+   cache = era5cache.GribCache(options.cache, maxsize=options.cachesize*1e9)
+else:
+   cache = None
+timing = era5timing.TimingLog(timingfile)
+# every attempt is logged in the message file.
+retry = era5retrieve.Retry(attempts=options.retries, backoff=options.backoff,
+                           timeout=options.timeout*3600, logname=mfilename)
+if options.pipeline:
+   # retrieve and convert one day at a time.
+   exe = options.exe
+   if not exe: exe = era5convert.default_exe()
+   # era52arl can not convert model levels or add up the accumulations.
+   if (levtype=='ml' or tres > 1) and not options.exe: exe = era5convert.python_exe()
+   pipeline = era5pipeline.Pipeline(jobs, exe=exe, cfgname=cfgname, outdir=options.dir,
+                                    maxdays=options.maxdays, nproc=options.nproc,
+                                    cleanup=options.cleanup)
+   failed = pipeline.run(server, retrievals, maxworkers=options.concurrent,
+                         manifest=manifest, cache=cache, retry=retry, timing=timing)
+else:
+   # send all the requests to the server at once.
+   failed = era5retrieve.retrieve_all(server, retrievals, maxworkers=options.concurrent,
+                                      manifest=manifest, cache=cache, retry=retry,
+                                      timing=timing)
+if catchup and not failed:
+   # convert the new hours and add them to the end of the ARL file.
+   exe = options.exe
+   if not exe: exe = era5convert.default_exe()
+   if (levtype=='ml' or tres > 1) and not options.exe: exe = era5convert.python_exe()
+   try:
+      cfailed = era5convert.catchup_jobs(jobs, options.catchup, exe=exe, cfgname=cfgname,
+                                        nproc=options.nproc or None)
+   except ValueError as err:
+      print('Nothing appended to {} : {}'.format(options.catchup, err))
+      cfailed = []
+   for job in cfailed:
+      print('FAILED conversion {} {}'.format(job['arl'], job['tstr']))
+elif catchup:
+   print('Nothing appended to {}. Some retrievals failed.'.format(options.catchup))
+if options.store:
+   # copy the fields of the time periods which were retrieved to the store.
+   ftargets = set(rtv['target'] for rtv in failed)
+   for job in jobs:
+       if any(x in ftargets or not os.path.isfile(x) for x in job['files']):
+          print('Not in store {} {}'.format(job['arl'], job['tstr']))
+          continue
+       try:
+          # the store has the hourly accumulations.
+          nfields = era5store.ingest(options.store, job['files'], tm=3 if stream=='enda' else 1)
+          print('Stored {} fields from {}'.format(nfields, ' '.join(job['files'])))
+       except ValueError as err:
+          print('Not in store {} {} : {}'.format(job['arl'], job['tstr'], err))
+with open(mfilename, 'a') as mid:
+   for rtv in failed:
+       mid.write('FAILED ' + rtv['target'] + '\n')
+   if timing.records:
+       for line in era5timing.summarize(timing.records):
+           print(line)
+           mid.write(line + '\n')
+
 #Notes on the server.retrieve function.
 #Seperate lists with a /
 #indicate a range by value/to/value/by/step
@@ -595,4 +912,3 @@ era5utils.write_cfg(param3d, param2da, levs, tm=tm, levtype=levtype)
 #Area : four values : North West South East
 #Grid : two values  : West-East   North-South increments
 #could use 'format' : 'netcdf' if want netcdf files.
-
@@ -0,0 +1,381 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import datetime
+
+"""
+MODULE: tools for checking and handling the grib files retrieved from the CDS.
+
+PYTHON 3.x
+
+ABSTRACT: The functions which only need the message structure read the
+section headers directly and do not need eccodes. They read a few bytes
+from the start of each message and seek past the data so they are fast
+even for very large files.
+crop_file needs eccodes and numpy which are only imported when it is used.
+
+grib1 is used for the pressure level and surface files.
+grib2 is used for the model level files.
+"""
+
+
+def _int(bytestr):
+    return int.from_bytes(bytestr, 'big')
+
+
+def _grib1_length(fid, offset, head):
+    """returns the total length of a grib1 message.
+       ECMWF uses a special encoding of the length for messages larger than
+       0x7fffff bytes. The real length is then found from the section 4 length.
+    """
+    length = _int(head[4:7])
+    if not length & 0x800000:
+        return length
+    # large message. need to walk the section headers to find section 4.
+    fid.seek(offset + 8)
+    sec1 = fid.read(8)
+    sec1len = _int(sec1[0:3])
+    flag = sec1[7]
+    pos = offset + 8 + sec1len
+    # grid description section
+    if flag & 0x80:
+        fid.seek(pos)
+        pos += _int(fid.read(3))
+    # bit map section
+    if flag & 0x40:
+        fid.seek(pos)
+        pos += _int(fid.read(3))
+    fid.seek(pos)
+    sec4len = _int(fid.read(3))
+    length = (length & 0x7fffff) * 120
+    length = length - sec4len + 4
+    return length
+
+
+def iter_messages(fname):
+    """generator which yields (offset, length, edition) for each message
+       in the grib file. Raises IOError if the file is truncated or a
+       message is not terminated by 7777.
+    """
+    fsize = os.path.getsize(fname)
+    with open(fname, 'rb') as fid:
+        offset = 0
+        while offset < fsize:
+            fid.seek(offset)
+            head = fid.read(16)
+            if head[0:4] != b'GRIB':
+                # allow padding between messages.
+                idx = _find_grib(fid, offset)
+                if idx < 0:
+                    if head.strip(b'\x00 \n'):
+                        raise IOError('{} : data after last grib message at {}'.format(fname, offset))
+                    return
+                offset = idx
+                continue
+            edition = head[7]
+            if edition == 1:
+                length = _grib1_length(fid, offset, head)
+            elif edition == 2:
+                length = _int(head[8:16])
+            else:
+                raise IOError('{} : unknown grib edition {} at {}'.format(fname, edition, offset))
+            if offset + length > fsize:
+                raise IOError('{} : truncated grib message at {}'.format(fname, offset))
+            fid.seek(offset + length - 4)
+            if fid.read(4) != b'7777':
+                raise IOError('{} : grib message at {} does not end with 7777'.format(fname, offset))
+            yield offset, length, edition
+            offset += length
+
+
+def _find_grib(fid, offset, blocksize=65536):
+    fid.seek(offset)
+    pos = offset
+    while True:
+        block = fid.read(blocksize)
+        if not block:
+            return -1
+        idx = block.find(b'GRIB')
+        if idx >= 0:
+            return pos + idx
+        # GRIB may be split across two blocks.
+        pos += len(block) - 3
+        fid.seek(pos)
+        if len(block) < blocksize:
+            return -1
+
+
+def count_messages(fname):
+    """returns number of messages in a grib file. Raises IOError if the
+       file is not complete.
+    """
+    nnn = 0
+    for msg in iter_messages(fname):
+        nnn += 1
+    return nnn
+
+
+# units of time range used in grib1 and grib2 in hours.
+_TIME_UNITS = {0: 1.0/60, 1: 1, 2: 24, 10: 3, 11: 6, 12: 12, 13: 1.0/3600}
+
+
+def _grib1_validity(head):
+    """returns validity time of a grib1 message from section 1 (PDS).
+       head contains the message from the start.
+    """
+    pds = head[8:]
+    century = pds[24]
+    year = (century - 1) * 100 + pds[12]
+    reftime = datetime.datetime(year, pds[13], pds[14], pds[15], pds[16])
+    unit = _TIME_UNITS[pds[17]]
+    p1 = pds[18]
+    p2 = pds[19]
+    tri = pds[20]
+    if tri == 10:
+        step = _int(pds[18:20])
+    elif tri in [2, 3, 4, 5]:
+        # accumulations, averages and differences are valid at the end of the period.
+        step = p2
+    elif tri == 1:
+        step = 0
+    else:
+        step = p1
+    return reftime + datetime.timedelta(hours=step * unit)
+
+
+def _grib2_section(fid, offset, snum):
+    """returns section snum of the grib2 message at offset. The first 5
+       octets (length and section number) are included.
+    """
+    pos = offset + 16
+    while True:
+        fid.seek(pos)
+        shead = fid.read(5)
+        slen = _int(shead[0:4])
+        if shead[4] == snum:
+            return shead + fid.read(slen - 5)
+        if shead[4] > snum or slen == 0:
+            raise IOError('no section {} in grib2 message at {}'.format(snum, offset))
+        pos += slen
+
+
+def _grib2_validity(fid, offset):
+    """returns validity time of a grib2 message from section 1 and section 4.
+    """
+    sec1 = _grib2_section(fid, offset, 1)
+    reftime = datetime.datetime(_int(sec1[12:14]), sec1[14], sec1[15], sec1[16],
+                                sec1[17], sec1[18])
+    # index in sec4 is octet number - 1.
+    sec4 = _grib2_section(fid, offset, 4)
+    template = _int(sec4[7:9])
+    if template in [8, 11, 12]:
+        # statistically processed. valid at end of overall time interval.
+        # octet where the end time starts for templates 4.8, 4.11 and 4.12.
+        start = {8: 35, 11: 38, 12: 37}[template] - 1
+        endtime = sec4[start:start + 7]
+        return datetime.datetime(_int(endtime[0:2]), endtime[2], endtime[3], endtime[4],
+                                 endtime[5], endtime[6])
+    unit = _TIME_UNITS[sec4[18 - 1]]
+    step = _int(sec4[19 - 1:23 - 1])
+    return reftime + datetime.timedelta(hours=step * unit)
+
+
+def _grid_shape(fid, offset, edition):
+    """returns (Ni, Nj) of a regular latitude longitude grid from the grid
+       description section. Returns None for other grids.
+    """
+    if edition == 1:
+        fid.seek(offset + 8)
+        sec1 = fid.read(8)
+        if not sec1[7] & 0x80:
+            return None
+        fid.seek(offset + 8 + _int(sec1[0:3]))
+        gds = fid.read(10)
+        if gds[5] != 0:
+            return None
+        return _int(gds[6:8]), _int(gds[8:10])
+    sec3 = _grib2_section(fid, offset, 3)
+    if _int(sec3[12:14]) != 0:
+        return None
+    return _int(sec3[30:34]), _int(sec3[34:38])
+
+
+def iter_grids(fname):
+    """generator which yields (offset, length, (Ni, Nj)) for each message.
+       (Ni, Nj) is None if the grid is not a regular latitude longitude grid.
+    """
+    with open(fname, 'rb') as fid:
+        for offset, length, edition in iter_messages(fname):
+            yield offset, length, _grid_shape(fid, offset, edition)
+
+
+def iter_validity(fname):
+    """generator which yields (offset, length, validity time) for each
+       message in the grib file. The validity time is a datetime object and
+       is the same as the validityDate and validityTime keys in eccodes.
+    """
+    with open(fname, 'rb') as fid:
+        for offset, length, edition in iter_messages(fname):
+            if edition == 1:
+                fid.seek(offset)
+                head = fid.read(8 + 28)
+                vtime = _grib1_validity(head)
+            else:
+                vtime = _grib2_validity(fid, offset)
+            yield offset, length, vtime
+
+
+def copy_message(fid, outfid, offset, length, blocksize=2**24):
+    fid.seek(offset)
+    while length > 0:
+        block = fid.read(min(blocksize, length))
+        outfid.write(block)
+        length -= len(block)
+
+
+def split_by_validity(fname, targets):
+    """splits a grib file into several files according to the validity time
+       of the messages.
+       targets : dictionary. key is validity time as string YYYYMMDDHH.
+                 value is name of file the message should be written to.
+       Messages with a validity time not in targets are not written.
+       Files are written to name.part and renamed when complete.
+       Returns dictionary with number of messages written to each file.
+    """
+    outfiles = {}
+    counts = {}
+    try:
+        with open(fname, 'rb') as fid:
+            for offset, length, vtime in iter_validity(fname):
+                outname = targets.get(vtime.strftime('%Y%m%d%H'))
+                if not outname:
+                    continue
+                if outname not in outfiles:
+                    outfiles[outname] = open(outname + '.part', 'wb')
+                    counts[outname] = 0
+                copy_message(fid, outfiles[outname], offset, length)
+                counts[outname] += 1
+    finally:
+        for outname in outfiles:
+            outfiles[outname].close()
+    for outname in outfiles:
+        os.replace(outname + '.part', outname)
+    return counts
+
+
+def _grid_indices(first, inc, npts, start, step, nnn, wrap=False):
+    """returns indices of the points start, start+step, ... (nnn points) on
+       the grid first, first+inc, ... (npts points).
+       Raises ValueError if the points are not on the grid.
+    """
+    import numpy as np
+    pos = (start - first) / inc + np.arange(nnn) * (step / inc)
+    if wrap:
+        pos = np.mod(pos, 360.0 / abs(inc))
+    idx = np.round(pos).astype(int)
+    if np.any(np.abs(pos - idx) > 1e-3):
+        raise ValueError('requested points are not on the grid of the file')
+    if wrap:
+        idx = np.mod(idx, npts)
+    if idx.min() < 0 or idx.max() >= npts:
+        raise ValueError('requested area is not inside the area of the file')
+    return idx
+
+
+def _crop_geometry(gid, area, grid):
+    """returns the latitude and longitude indices for the area and grid and
+       the grid keys for the cropped message.
+    """
+    import numpy as np
+    import eccodes
+    if eccodes.codes_get(gid, 'gridType') != 'regular_ll':
+        raise ValueError('can only crop regular latitude longitude grids')
+    north, west, south, east = [float(x) for x in area.split('/')]
+    dlon, dlat = [float(x) for x in grid.split('/')]
+    ni = eccodes.codes_get(gid, 'Ni')
+    nj = eccodes.codes_get(gid, 'Nj')
+    lat1 = eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees')
+    lon1 = eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees')
+    di = eccodes.codes_get(gid, 'iDirectionIncrementInDegrees')
+    dj = eccodes.codes_get(gid, 'jDirectionIncrementInDegrees')
+    jpos = eccodes.codes_get(gid, 'jScansPositively')
+    if eccodes.codes_get(gid, 'iScansNegatively'):
+        raise ValueError('can only crop grids which scan west to east')
+    # same calculation of number of points as era5utils.grid_size
+    nx = int(round((east - west) / dlon)) + 1
+    if (nx - 1) * dlon >= 360:
+        nx = int(round(360 / dlon))
+    ny = int(round((north - south) / dlat)) + 1
+    if jpos:
+        jidx = _grid_indices(lat1, dj, nj, south, dlat, ny)
+        newlat1 = south
+    else:
+        jidx = _grid_indices(lat1, -dj, nj, north, -dlat, ny)
+        newlat1 = north
+    wrap = ni * di >= 360 - 1e-3
+    iidx = _grid_indices(lon1, di, ni, west, dlon, nx, wrap=wrap)
+    keys = {'Ni': nx, 'Nj': ny,
+            'iDirectionIncrementInDegrees': dlon,
+            'jDirectionIncrementInDegrees': dlat,
+            'latitudeOfFirstGridPointInDegrees': newlat1,
+            'latitudeOfLastGridPointInDegrees': lat1 + jidx[-1] * dj * (1 if jpos else -1),
+            'longitudeOfFirstGridPointInDegrees': np.mod(lon1 + iidx[0] * di, 360.0),
+            'longitudeOfLastGridPointInDegrees': np.mod(lon1 + iidx[-1] * di, 360.0)}
+    return (ni, nj), jidx, iidx, keys
+
+
+def crop_file(fname, outname, area, grid, batch=100):
+    """writes the messages in fname cropped to area and grid to outname.
+       area : North/West/South/East as in the CDS request.
+       grid : dlon/dlat as in the CDS request. Must be a multiple of the
+              grid spacing of the file and the points must be on its grid.
+       Messages are read in batches which are stacked into one array and
+       cropped with one indexing operation.
+       Raises ValueError if the area or grid can not be cut out of the file.
+       Needs eccodes and numpy.
+    """
+    import numpy as np
+    import eccodes
+    geometry = {}
+    with open(fname, 'rb') as fid, open(outname, 'wb') as outfid:
+        done = False
+        while not done:
+            gids = []
+            for iii in range(batch):
+                gid = eccodes.codes_grib_new_from_file(fid)
+                if gid is None:
+                    done = True
+                    break
+                gids.append(gid)
+            try:
+                # group the messages of the batch by grid.
+                groups = {}
+                for gid in gids:
+                    shape = (eccodes.codes_get(gid, 'Ni'), eccodes.codes_get(gid, 'Nj'),
+                             eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees'),
+                             eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees'))
+                    if shape not in geometry:
+                        geometry[shape] = _crop_geometry(gid, area, grid)
+                    groups.setdefault(shape, []).append(gid)
+                cropped = {}
+                for shape in groups:
+                    (ni, nj), jidx, iidx, keys = geometry[shape]
+                    values = np.stack([eccodes.codes_get_values(gid) for gid in groups[shape]])
+                    values = values.reshape(len(groups[shape]), nj, ni)
+                    values = values[:, jidx[:, None], iidx[None, :]]
+                    for gid, val in zip(groups[shape], values):
+                        cropped[gid] = (keys, val.ravel())
+                # write in the same order as the input file.
+                for gid in gids:
+                    keys, val = cropped[gid]
+                    newid = eccodes.codes_clone(gid)
+                    for key in ['Ni', 'Nj']:
+                        eccodes.codes_set(newid, key, keys[key])
+                    for key in keys:
+                        if key not in ['Ni', 'Nj']:
+                            eccodes.codes_set(newid, key, float(keys[key]))
+                    eccodes.codes_set_values(newid, val)
+                    eccodes.codes_write(newid, outfid)
+                    eccodes.codes_release(newid)
+            finally:
+                for gid in gids:
+                    eccodes.codes_release(gid)
@@ -0,0 +1,62 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import arlsubset
+
+"""
+MODULE: tests of the box cropping in arlsubset.py.
+
+PYTHON 3.x
+
+ABSTRACT: the columns and rows kept by crop_indices are checked for regional
+and global 0.25 degree grids.
+
+    python -m unittest discover tests
+"""
+
+
+def latlon_grids(lon0, nx, ny=721, lat0=-90.0, dlon=0.25):
+    """grids array of a regular latitude longitude grid (see arlwriter.latlon_grids).
+    """
+    grids = np.zeros(12)
+    grids[0] = lat0 + dlon * (ny - 1)
+    grids[2], grids[3] = dlon, dlon
+    grids[7], grids[8] = 1.0, 1.0
+    grids[9], grids[10] = lat0, lon0
+    return grids
+
+
+class TestCrop(unittest.TestCase):
+
+    def test_box_west_of_grid(self):
+        # grid 0..60E. The box 10W..20E keeps 0..20E.
+        ilist, jlist, clat, clon = arlsubset.crop_indices(latlon_grids(0.0, 241), 241, 721,
+                                                          '60/-10/30/20')
+        np.testing.assert_array_equal(ilist, np.arange(0, 81))
+        np.testing.assert_array_equal(jlist, np.arange(480, 601))
+        self.assertEqual((clat, clon), (30.0, 0.0))
+
+    def test_box_east_of_grid(self):
+        # grid 0..60E. The box 50E..70E keeps 50..60E.
+        ilist, jlist, clat, clon = arlsubset.crop_indices(latlon_grids(0.0, 241), 241, 721,
+                                                          '60/50/30/70')
+        np.testing.assert_array_equal(ilist, np.arange(200, 241))
+        self.assertEqual(clon, 50.0)
+
+    def test_box_outside_grid(self):
+        with self.assertRaises(ValueError):
+            arlsubset.crop_indices(latlon_grids(0.0, 241), 241, 721, '60/100/30/120')
+
+    def test_global_wraps(self):
+        ilist, jlist, clat, clon = arlsubset.crop_indices(latlon_grids(0.0, 1440), 1440, 721,
+                                                          '60/-10/30/20')
+        np.testing.assert_array_equal(ilist, np.arange(1400, 1521) % 1440)
+        self.assertEqual(clon, 350.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
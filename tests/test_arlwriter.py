@@ -0,0 +1,72 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+import os
+import sys
+import datetime
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import arlreader
+import arlwriter
+
+"""
+MODULE: tests of the ARL packing in arlwriter.py against PAKREC.
+
+PYTHON 3.x
+
+ABSTRACT: the packed bytes and the label of a small record are worked out by
+hand with the steps of PAKREC. The packing is also checked by unpacking
+larger records.
+
+    python -m unittest discover tests
+"""
+
+# 2 x 2 record. rmax is 2 so nexp is 2 and the values are scaled by 2**5.
+RVAR = [[0.0, 1.0], [2.0, 3.0]]
+# first column 127, (2-0)*32+127.5. second column (1-0)*32+127.5, (3-2)*32+127.5.
+CVAR = bytes([127, 159, 191, 159])
+LABEL = '17 1 1 6 0 599TEMP   2 0.1574803E-01 0.0000000E+00'
+
+
+class TestPack(unittest.TestCase):
+
+    def test_known_record(self):
+        cvar, prec, nexp, var1, ksum = arlwriter.pack(np.array(RVAR))
+        self.assertEqual(cvar, CVAR)
+        self.assertEqual(nexp, 2)
+        self.assertEqual(var1, 0.0)
+        # 636 - 2 * 255
+        self.assertEqual(ksum, 126)
+        np.testing.assert_array_equal(arlwriter.unpack(cvar, 2, 2, nexp, var1), RVAR)
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(1)
+        rvar = (250.0 + np.cumsum(rng.normal(0, 0.5, (15, 20)), axis=1)).astype(np.float32)
+        cvar, prec, nexp, var1, ksum = arlwriter.pack(rvar)
+        values = arlwriter.unpack(cvar, 20, 15, nexp, var1)
+        self.assertLessEqual(np.abs(values - rvar).max(), prec)
+
+
+class TestLabel(unittest.TestCase):
+
+    def test_label(self):
+        date = datetime.datetime(2017, 1, 1, 6)
+        label = arlwriter.make_label(date, 0, 5, arlwriter.grid_str(2, 2), 'TEMP', 2,
+                                     2.0**2 / 254.0, 0.0)
+        self.assertEqual(label, LABEL)
+        parsed = arlreader.parse_label(label)
+        self.assertEqual(parsed['date'], date)
+        self.assertEqual(parsed['level'], 5)
+        self.assertEqual(parsed['kvar'], 'TEMP')
+
+    def test_model_level(self):
+        # I2 in PAKREC writes ** for levels from 100 up.
+        label = arlwriter.make_label(datetime.datetime(2017, 1, 1, 6), 0, 120, '99', 'TEMP',
+                                     2, 0.0, 0.0)
+        self.assertEqual(len(label), arlwriter.LABEL_LENGTH)
+        self.assertEqual(label[10:12], '**')
+        self.assertIsNone(arlreader.parse_label(label)['level'])
+
+
+if __name__ == '__main__':
+    unittest.main()